@@ -213,6 +213,1185 @@ def test_diagnostic_tool():
             os.remove(test_db)
             print(f"\n🧹 Cleaned up test database: {test_db}")
 
+def test_risk_engine_scenarios():
+    """Risk engine reports per-symbol notional and liquidations per shock"""
+    from trading_fix import RiskEngine
+    import trading_fix
+    
+    rows = [
+        (1, 'user1', 'BTCUSDT', 1, 1.0, 45000, 46000, 1000),
+        (2, 'user2', 'ETHUSDT', -1, 10.0, 3000, 2900, 500),
+        (3, 'user3', 'BTCUSDT', 1, 0.5, 44000, 44500, 0),
+    ]
+    engine = RiskEngine(shocks=(-0.1, 0.1))
+    result = engine.evaluate(rows)
+    
+    btc = result["exposure_by_symbol"]["BTCUSDT"]
+    assert abs(btc["long_notional"] - (46000 + 0.5 * 44500)) < 1e-6
+    assert abs(result["exposure_by_symbol"]["ETHUSDT"]["net_notional"] + 29000) < 1e-6
+    assert abs(result["house_net_exposure"] + (46000 + 22250 - 29000)) < 1e-6
+    assert list(result["under_collateralized"]) == [3]
+    assert set(result["high_leverage"]) == {1, 2}
+    down, up = result["scenarios"]
+    assert down["positions_liquidated"] == 2  # user1 long and zero-margin user3
+    assert up["positions_liquidated"] == 1    # user2 short; user3 gains on the way up
+    
+    # The pure Python fallback must agree with the vectorized path
+    numpy_module, trading_fix.np = trading_fix.np, None
+    try:
+        fallback = engine.evaluate(rows)
+    finally:
+        trading_fix.np = numpy_module
+    for vectorized, python in zip(result["scenarios"], fallback["scenarios"]):
+        assert vectorized["positions_liquidated"] == python["positions_liquidated"]
+        assert abs(vectorized["bad_debt"] - python["bad_debt"]) < 1e-6
+        assert abs(vectorized["user_losses"] - python["user_losses"]) < 1e-6
+
+def test_liquidation_index():
+    """Liquidation index answers crossing queries and tracks position changes"""
+    from trading_fix import LiquidationIndex, Position, liquidation_price
+    
+    def position(key, side, quantity, entry, margin):
+        return Position('user%d' % key, 'BTCUSDT', side, quantity, entry, entry, 0, margin,
+                        liquidation_price(side, quantity, entry, margin), key)
+    
+    index = LiquidationIndex()
+    index.upsert(position(1, 'buy', 1.0, 45000, 4500))    # liquidates around 40.7k
+    index.upsert(position(2, 'buy', 1.0, 45000, 9000))    # around 36.2k
+    index.upsert(position(3, 'sell', 1.0, 45000, 4500))   # around 49.3k
+    
+    assert [p.key for p in index.crossed('BTCUSDT', 45000)] == []
+    assert [p.key for p in index.crossed('BTCUSDT', 40000)] == [1]
+    assert [p.key for p in index.crossed('BTCUSDT', 30000)] == [2, 1]
+    assert [p.key for p in index.crossed('BTCUSDT', 50000)] == [3]
+    assert index.crossed('ETHUSDT', 1) == []
+    
+    # Margin top-up moves position 1 below position 2; closing 3 removes it
+    index.upsert(position(1, 'buy', 1.0, 45000, 20000))
+    index.remove(3)
+    assert [p.key for p in index.crossed('BTCUSDT', 30000)] == [2]
+    assert index.crossed('BTCUSDT', 50000) == []
+    assert len(index) == 2
+
+def test_near_liquidation_uses_index():
+    """_check_positions populates liquidation prices and near-liquidation rows"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair
+        repair = TradingSystemRepair(test_db)
+        status = repair._check_positions()
+        # All sample positions are within 5% of liquidation except after the margin top-up below
+        assert sorted(p['id'] for p in status["near_liquidation"]) == ['pos1', 'pos2', 'pos3']
+        assert len(repair.liquidation_index) == 3
+        crossing = repair.positions_crossing('ETHUSDT', 3100)
+        assert [p.user_id for p in crossing] == ['user2']
+        assert abs(crossing[0].liquidation_price - 30500 / 10 / 1.005) < 1e-6
+        
+        repair.conn.execute("DELETE FROM positions WHERE id = 'pos2'")
+        repair.conn.execute("UPDATE positions SET margin = 10000 WHERE id = 'pos1'")
+        status = repair._check_positions()
+        assert [p['id'] for p in status["near_liquidation"]] == ['pos3']
+        assert repair.positions_crossing('ETHUSDT', 3100) == []
+        assert len(repair.liquidation_index) == 2
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_check_cache_skips_unchanged_checks():
+    """Unchanged checks are served from cache; writes invalidate only affected checks"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair
+        repair = TradingSystemRepair(test_db)
+        first = repair.diagnose_system()
+        assert first["cache"] == {"hits": 0, "misses": 6}
+        second = repair.diagnose_system()
+        assert second["cache"] == {"hits": 6, "misses": 0}
+        assert second["issues_found"] == first["issues_found"]
+        
+        # With counters installed, a positions write only invalidates position checks
+        repair.install_change_tracking()
+        repair.diagnose_system()
+        repair.conn.execute("UPDATE positions SET margin = margin + 1 WHERE id = 'pos1'")
+        repair.conn.commit()
+        third = repair.diagnose_system()
+        assert third["cache"] == {"hits": 4, "misses": 2}
+        repair.conn.close()
+        
+        # Counter-keyed results persist for the next process
+        fresh = TradingSystemRepair(test_db)
+        assert fresh.diagnose_system()["cache"] == {"hits": 6, "misses": 0}
+        # The cached position check skipped the scan; the liquidation index is loaded on demand
+        assert len(fresh.liquidation_index) == 0
+        assert [p.user_id for p in fresh.positions_crossing('ETHUSDT', 3100)] == ['user2']
+        fresh.conn.execute("DELETE FROM positions WHERE id = 'pos2'")
+        fresh.conn.commit()
+        assert fresh.positions_crossing('ETHUSDT', 3100) == []
+        fresh.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_export_diagnosis_ndjson_gzip():
+    """NDJSON export writes one record per line and round-trips through gzip"""
+    import gzip
+    import json
+    test_db = create_test_database()
+    report = "test_diagnosis.ndjson.gz"
+    try:
+        from trading_fix import TradingSystemRepair
+        repair = TradingSystemRepair(test_db)
+        diagnosis = repair.diagnose_system()
+        assert repair.export_diagnosis(diagnosis, "ndjson", report, compress=True) == report
+        
+        with gzip.open(report, 'rt') as f:
+            records = [json.loads(line) for line in f]
+        assert records[0]["record"] == "diagnosis"
+        assert records[0]["issues_found"] == len(diagnosis["issues_found"])
+        issues = [r for r in records if r["record"] == "issue"]
+        assert [r["type"] for r in issues] == [i["type"] for i in diagnosis["issues_found"]]
+        orphaned = [r for r in records if r.get("issue") == "ORPHANED_LEDGER_ENTRIES"]
+        assert sorted(r["data"]["id"] for r in orphaned) == ['tx1', 'tx2']
+        # Issue rows are not repeated under their section
+        assert not [r for r in records if r.get("field") == "orphaned_entries"]
+        assert {r["key"] for r in records if r.get("field") == "exposure_by_symbol"} == {'BTCUSDT', 'ETHUSDT'}
+        
+        # Streamed: rows are written while their check runs, ahead of the section summary and the issues
+        repair.conn.close()
+        repair = TradingSystemRepair(test_db, use_cache=False)
+        streamed, report = repair.stream_diagnosis(report, compress=True)
+        with gzip.open(report, 'rt') as f:
+            records = [json.loads(line) for line in f]
+        assert records[0]["record"] == "diagnosis" and records[-1]["record"] == "summary"
+        assert records[-1]["issues_found"] == len(streamed["issues_found"])
+        kinds = [(r["record"], r.get("section"), r.get("field")) for r in records]
+        orphan_row = kinds.index(("row", "ledger_integrity", "orphaned_entries"))
+        assert orphan_row < kinds.index(("section", "ledger_integrity", None))
+        assert sorted(r["data"]["id"] for r in records
+                  if r["record"] == "row" and r.get("field") == "orphaned_entries") == ['tx1', 'tx2']
+        issue = next(r for r in records if r.get("type") == "ORPHANED_LEDGER_ENTRIES")
+        assert (issue["section"], issue["field"], issue["rows"]) == ("ledger_integrity", "orphaned_entries", 2)
+        assert records.index(issue) > orphan_row
+        # Position rows are expanded after their check, so they are written in full from the result
+        assert all("symbol" in r["data"] for r in records if r["record"] == "row" and r.get("field") == "high_risk_positions")
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+        if os.path.exists(report):
+            os.remove(report)
+
+def test_dry_run_reports_exact_change_set():
+    """Dry run reports per-table row counts and samples, then rolls everything back"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair
+        repair = TradingSystemRepair(test_db)
+        diagnosis = repair.diagnose_system()
+        before = repair._execute_query("SELECT * FROM wallet_balances ORDER BY id")
+        
+        preview = repair.fix_issues(diagnosis, dry_run=True)
+        assert preview["dry_run"]
+        assert {t: c["rows"] for t, c in preview["changes"].items()} == {
+            "positions": 3, "wallet_balances": 3, "orders": 1, "wallet_transactions": 2
+        }
+        sample = preview["changes"]["orders"]["samples"][0]
+        assert (sample["before"]["status"], sample["after"]["status"]) == ('open', 'cancelled')
+        assert repair._execute_query("SELECT * FROM wallet_balances ORDER BY id") == before
+        assert repair._execute_query("SELECT status FROM orders WHERE id = 'order1'")[0]["status"] == 'open'
+        
+        # The real run writes exactly what the preview reported
+        applied = repair.fix_issues(diagnosis)
+        assert {t: c["rows"] for t, c in applied["changes"].items()} == \
+            {t: c["rows"] for t, c in preview["changes"].items()}
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_audit_log_hash_chain():
+    """Audit entries are written with the repair and verified incrementally"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair
+        repair = TradingSystemRepair(test_db)
+        diagnosis = repair.diagnose_system()
+        
+        repair.fix_issues(diagnosis, dry_run=True)
+        assert not repair._execute_query(
+            "SELECT name FROM sqlite_master WHERE name = 'audit_log'"
+        ), "dry run must not leave audit entries behind"
+        
+        fixes = repair.fix_issues(diagnosis)
+        entries = repair._execute_query("SELECT * FROM audit_log ORDER BY id")
+        assert [e["action"] for e in entries] == ["NEGATIVE_BALANCE_FIX"]
+        assert entries[0]["run_id"] == fixes["run_id"]
+        
+        assert repair.verify_audit() == {"verified": 1, "valid": True, "broken_at": None, "last_id": 1}
+        repair._add_audit_entry("user2", "MANUAL", "second")
+        repair._add_audit_entry("user3", "MANUAL", "third")
+        assert repair.verify_audit()["verified"] == 2
+        
+        # Two writers append to one chain: each flush links to the current tail
+        other = TradingSystemRepair(test_db)
+        other._add_audit_entry("user1", "MANUAL", "from B")
+        repair._add_audit_entry("user1", "MANUAL", "from A again")
+        assert repair.verify_audit(full=True) == {"verified": 5, "valid": True, "broken_at": None, "last_id": 5}
+        other.conn.close()
+        
+        repair.conn.execute("UPDATE audit_log SET details = 'tampered' WHERE id = 2")
+        repair.conn.commit()
+        assert repair.verify_audit()["valid"]  # incremental: entry 2 was already verified
+        assert repair.verify_audit(full=True)["broken_at"] == 2
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_fleet_diagnosis_aggregates_members():
+    """Fleet mode diagnoses databases in parallel and lists failures"""
+    import json
+    import shutil
+    test_db = create_test_database()
+    members = ["fleet_a.db", "fleet_b.db"]
+    report = "test_fleet.ndjson"
+    try:
+        from trading_fix import resolve_fleet_paths, run_fleet
+        for member in members:
+            shutil.copy(test_db, member)
+        paths = resolve_fleet_paths(["fleet_*.db", "missing.db"])
+        assert paths == members + ["missing.db"]
+        
+        fleet = run_fleet(paths, workers=2, report_path=report)
+        assert fleet["succeeded"] == 2
+        assert [f["db"] for f in fleet["failed"]] == ["missing.db"]
+        assert not os.path.exists("missing.db")
+        assert fleet["issues_by_type"]["ORPHANED_LEDGER_ENTRIES"] == {
+            "severity": "MEDIUM", "databases": 2, "count": 4
+        }
+        with open(report) as f:
+            records = [json.loads(line) for line in f]
+        assert [r["record"] for r in records] == ["database"] * 3 + ["fleet_summary"]
+    finally:
+        for path in [test_db, report] + members:
+            if os.path.exists(path):
+                os.remove(path)
+
+def test_top_k_offenders_with_spill():
+    """Checks keep exact totals but only the K most severe rows, optionally spilling all"""
+    import json
+    import shutil
+    import sqlite3
+    test_db = create_test_database()
+    spill_dir = "test_spill"
+    try:
+        conn = sqlite3.connect(test_db)
+        conn.executemany(
+            "INSERT INTO wallet_balances (id, user_id, currency, balance, frozen_balance) VALUES (?, ?, 'USDT', ?, 0)",
+            [(f"neg{i}", f"bulk{i}", -float(i)) for i in range(1, 101)]
+        )
+        conn.commit()
+        conn.close()
+        
+        from trading_fix import TradingSystemRepair
+        repair = TradingSystemRepair(test_db, top_k=3, spill_dir=spill_dir)
+        diagnosis = repair.diagnose_system()
+        issue = next(i for i in diagnosis["issues_found"] if i["type"] == "NEGATIVE_BALANCE")
+        assert issue["count"] == 101
+        assert issue["description"] == "Found 101 users with negative balances"
+        assert abs(issue["sum"] - (-5050 - 0.5)) < 1e-9
+        assert [row["balance"] for row in issue["details"]] == [-100, -99, -98]
+        with open(issue["spill_file"]) as f:
+            assert len([json.loads(line) for line in f]) == 101
+        
+        # Partial diagnoses spill to their own scope and leave the full run's files alone
+        user = repair.diagnose_user("bulk7")
+        assert user["wallet_status"]["totals"]["negative_balances"]["spill_file"] == \
+            os.path.join(spill_dir, "user-bulk7", "negative_balances.ndjson")
+        repair.diagnose_sample(0.5, seed=1)
+        assert os.path.exists(os.path.join(spill_dir, "sample", "negative_balances.ndjson"))
+        with open(issue["spill_file"]) as f:
+            assert len(f.readlines()) == 101
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+        shutil.rmtree(spill_dir, ignore_errors=True)
+
+def test_snapshot_and_undo_rollback():
+    """Repairs can be reverted from an online-backup snapshot or from audit-log undo images"""
+    test_db = create_test_database()
+    snapshot = "test_trading.snapshot.db"
+    tables = ("wallet_balances", "orders", "positions", "wallet_transactions")
+    try:
+        from trading_fix import TradingSystemRepair
+        repair = TradingSystemRepair(test_db)
+        state = lambda: {t: repair._execute_query(f"SELECT * FROM {t} ORDER BY rowid") for t in tables}
+        original = state()
+        
+        # Small change set: snapshot skipped, undo images recorded instead
+        diagnosis = repair.diagnose_system()
+        # Sized from the diagnosis counts, without a dry run (an upper bound: one balance breaks two rules)
+        fix_issues, repair.fix_issues = repair.fix_issues, None
+        protection = repair.protect_repair(diagnosis, snapshot_path=snapshot, undo_threshold=100)
+        repair.fix_issues = fix_issues
+        assert protection["snapshot"] is None and protection["record_undo"]
+        assert protection["estimated_rows"] == 10
+        fixes = repair.fix_issues(diagnosis, record_undo=True)
+        assert state() != original
+        assert repair.undo_run(fixes["run_id"])["rows_restored"] == 9
+        assert state() == original
+        assert repair.verify_audit()["valid"]
+        
+        # Table and column names in undo images are checked before anything is written
+        import json
+        for forged in ({"table": "orders SET status = 'x' --", "row": {"rowid": 1, "status": "open"}},
+                       {"table": "orders", "row": {"rowid": 1, "status = 'x', id": "open"}}):
+            repair.conn.execute("INSERT INTO audit_log (action, details, run_id) VALUES ('UNDO_IMAGE', ?, 'forged')",
+                                (json.dumps(forged),))
+            try:
+                repair.undo_run("forged")
+                assert False, "forged undo image accepted"
+            except ValueError:
+                pass
+            repair.conn.execute("DELETE FROM audit_log WHERE run_id = 'forged'")
+        repair.conn.commit()
+        assert state() == original
+        
+        # Over the threshold: a consistent snapshot is taken and restored
+        protection = repair.protect_repair(repair.diagnose_system(), snapshot_path=snapshot, undo_threshold=1)
+        assert protection["snapshot"]["path"] == snapshot and protection["snapshot"]["bytes"] > 0
+        repair.fix_issues(repair.diagnose_system())
+        assert state() != original
+        repair.restore_snapshot(snapshot)
+        assert state() == original
+        repair.conn.close()
+    finally:
+        for path in (test_db, snapshot):
+            if os.path.exists(path):
+                os.remove(path)
+
+def test_incremental_diagnosis_revisits_dirty_keys():
+    """Incremental diagnosis only re-evaluates queued rows and matches a full diagnosis"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair
+        repair = TradingSystemRepair(test_db, use_cache=False)
+        repair.install_change_tracking(dirty_keys=True)
+        sections = ("wallet_status", "position_status")
+        same = lambda a, b: all(a[s]["totals"] == b[s]["totals"] for s in sections)
+        
+        baseline = repair.diagnose_system(incremental=True)
+        assert same(baseline, repair.diagnose_system())
+        assert repair.dirty_keys.pending("wallet_status", repair.dirty_keys.head())["wallet_balances"]["keys"] == set()
+        
+        repair.conn.execute("UPDATE wallet_balances SET balance = 1 WHERE id = 'wb1'")
+        repair.conn.execute("UPDATE positions SET margin = -1 WHERE id = 'pos1'")
+        repair.conn.execute("DELETE FROM positions WHERE id = 'pos2'")
+        repair.conn.commit()
+        queued = repair.dirty_keys.pending("position_status", repair.dirty_keys.head())
+        assert len(queued["positions"]["keys"]) == 2 and queued["wallet_balances"]["users"] == {"user1"}
+        
+        incremental = repair.diagnose_system(incremental=True)
+        full = repair.diagnose_system()
+        assert same(incremental, full)
+        assert incremental["position_status"]["totals"]["negative_margin"]["count"] == 1
+        assert incremental["wallet_status"]["totals"]["negative_balances"]["count"] == 0
+        assert sorted(p['id'] for p in incremental["position_status"]["near_liquidation"]) == \
+            sorted(p['id'] for p in full["position_status"]["near_liquidation"])
+        # Every consumer has passed the queue, so it is pruned
+        assert repair._execute_query("SELECT COUNT(*) AS n FROM repair_dirty_keys")[0]['n'] == 0
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_online_repair_commits_in_throttled_chunks():
+    """Online repair commits small chunks, adapts chunk size and matches a one-shot repair"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair, RepairThrottle
+        conn = sqlite3.connect(test_db)
+        conn.executemany(
+            "INSERT INTO wallet_balances (id, user_id, currency, balance, frozen_balance) VALUES (?, ?, 'USDT', ?, 0)",
+            [(f"neg{i}", f"bulk{i}", -float(i)) for i in range(1, 101)]
+        )
+        conn.commit()
+        conn.close()
+        
+        repair = TradingSystemRepair(test_db)
+        diagnosis = repair.diagnose_system()
+        expected = repair.fix_issues(diagnosis, dry_run=True)["changes"]
+        
+        throttle = RepairThrottle(initial_chunk=10, min_chunk=5)
+        fixes = repair.fix_issues(diagnosis, record_undo=True, throttle=throttle)
+        assert {t: c["rows"] for t, c in fixes["changes"].items()} == {t: c["rows"] for t, c in expected.items()}
+        # Stale-order cancellation and its fund release commit together, outside the chunking
+        stale = next(fix for fix in fixes["fixes"] if fix["type"] == "STALE_ORDER_FIX")
+        total_rows = sum(c["rows"] for c in expected.values())
+        assert fixes["throttle"]["chunks"] > 5
+        assert fixes["throttle"]["rows"] == total_rows - stale["orders_cancelled"] - stale["accounts_released"]
+        assert fixes["throttle"]["final_chunk_size"] > 10
+        assert repair.diagnose_system()["wallet_status"]["totals"]["negative_balances"]["count"] == 0
+        assert repair.undo_run(fixes["run_id"])["rows_restored"] == total_rows
+        
+        # An overrun shrinks the next chunk towards the lock budget
+        throttle = RepairThrottle(max_lock_ms=50, initial_chunk=1000)
+        throttle.record(1000, lock_wait_ms=0, hold_ms=200)
+        assert throttle.chunk_size == 200
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_duplicate_ledger_entries_detected_in_one_pass():
+    """Identical entries within the window form clusters; spaced-out repeats do not"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair
+        conn = sqlite3.connect(test_db)
+        conn.executemany(
+            "INSERT INTO wallet_transactions (id, user_id, type, amount, currency, balance_before, balance_after, "
+            "reference_id, created_at) VALUES (?, ?, 'trade', ?, 'USDT', 0, 0, ?, ?)",
+            [
+                ("d1", "user1", -50, "order1", "2026-01-01 10:00:00"),
+                ("d2", "user1", -50, "order1", "2026-01-01 10:00:20"),
+                ("d3", "user1", -50, "order1", "2026-01-01 10:01:10"),  # chained to d2
+                ("d4", "user1", -50, "order1", "2026-01-01 11:00:00"),  # outside the window
+                ("d5", "user1", -50, "order2", "2026-01-01 10:00:05"),  # other reference
+                ("d6", "user2", -50, "order1", "2026-01-01 10:00:01"),  # other user
+                ("d7", "user2", 10, "order2", "2026-01-01 10:00:00"),
+                ("d8", "user2", 10, "order2", "2026-01-01 10:00:00.500"),
+                # Mixed timestamp formats are ordered by time, not by their text
+                ("m1", "user3", -20, "order1", "2026-01-01 10:00:30"),
+                ("m2", "user3", -20, "order2", "2026-01-01 23:00:00"),
+                ("m3", "user3", -20, "order1", "2026-01-01T10:00:00"),
+                ("m4", "user3", -20, "order1", "2026-01-01T10:00:50"),
+                ("m5", "user3", -20, "order1", "2026-01-01 10:00:45+02:00"),  # zoned: not comparable
+            ]
+        )
+        conn.commit()
+        conn.close()
+        
+        repair = TradingSystemRepair(test_db, duplicate_window=60)
+        # The candidates stream in (user_id, created_at) index order, without a sort
+        repair.install_indexes()
+        statements = []
+        repair.conn.set_trace_callback(statements.append)
+        diagnosis = repair.diagnose_system()
+        repair.conn.set_trace_callback(None)
+        duplicate_sql = [sql for sql in statements if "substr(created_at, 11, 1)" in sql]
+        assert len(duplicate_sql) == 2
+        for sql in duplicate_sql:
+            plan = " | ".join(row["detail"] for row in repair.conn.execute("EXPLAIN QUERY PLAN " + sql))
+            assert "idx_repair_wallet_transactions_user" in plan and "TEMP B-TREE" not in plan, plan
+        clusters = diagnosis["ledger_integrity"]["duplicate_entries"]
+        assert [c["entry_ids"] for c in clusters] == [["d1", "d2", "d3"], ["m3", "m1", "m4"], ["d7", "d8"]]
+        assert diagnosis["ledger_integrity"]["totals"]["duplicate_entries"]["sum"] == -130
+        assert diagnosis["ledger_integrity"]["unparsed_timestamps"] == 1
+        assert "DUPLICATE_LEDGER_ENTRIES" in [i["type"] for i in diagnosis["issues_found"]]
+        repair.conn.close()
+        
+        narrow = TradingSystemRepair(test_db, duplicate_window=10)
+        clusters = narrow.diagnose_system()["ledger_integrity"]["duplicate_entries"]
+        assert [c["entry_ids"] for c in clusters] == [["d7", "d8"]]
+        narrow.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_diagnose_user_restricts_every_check():
+    """Per-user drill-down sees only that user's rows, uses indexes and is LRU-cached"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair
+        repair = TradingSystemRepair(test_db)
+        repair.install_indexes()
+        plan = " ".join(row["detail"] for row in repair._execute_query(
+            "EXPLAIN QUERY PLAN SELECT rowid, * FROM positions WHERE 1 = 1 AND user_id = ?", ("user1",)))
+        assert "idx_repair_positions_user" in plan
+        from trading_fix import ORPHANED_REFERENCE_SQL
+        plan = " | ".join(row["detail"] for row in repair._execute_query(
+            f"EXPLAIN QUERY PLAN SELECT * FROM wallet_transactions WHERE {ORPHANED_REFERENCE_SQL} AND user_id = ?",
+            ("user1",)))
+        assert "SEARCH wallet_transactions USING INDEX idx_repair_wallet_transactions_user" in plan, plan
+        assert "SEARCH o USING COVERING INDEX" in plan and "SEARCH r USING COVERING INDEX" in plan, plan
+        
+        user1 = repair.diagnose_user("user1")
+        assert user1["user_id"] == "user1"
+        assert {row["user_id"] for row in user1["wallet_status"]["negative_balances"]} == {"user1"}
+        assert [r["position"]["id"] for r in user1["position_status"]["incorrect_pnl"]] == ["pos1"]
+        assert [tx["id"] for tx in user1["ledger_integrity"]["orphaned_entries"]] == ["tx1"]
+        assert "NEGATIVE_BALANCE" in [i["type"] for i in user1["issues_found"]]
+        assert "NEGATIVE_BALANCE" not in [i["type"] for i in repair.diagnose_user("user3")["issues_found"]]
+        
+        # Repeated lookups are served from the LRU until the data changes
+        assert repair.diagnose_user("user1") is user1
+        repair.conn.execute("UPDATE wallet_balances SET balance = 1 WHERE id = 'wb1'")
+        repair.conn.commit()
+        refreshed = repair.diagnose_user("user1")
+        assert refreshed is not user1
+        assert refreshed["wallet_status"]["negative_balances"] == []
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_diagnostics_service_shares_inflight_scans():
+    """The HTTP service dedupes concurrent scans, caches until data changes and serves reports"""
+    import json
+    import threading
+    import time
+    import urllib.request
+    test_db = create_test_database()
+    try:
+        import trading_fix
+        from trading_fix import make_service_server
+        server = make_service_server(test_db, port=0, max_scans=1)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base = f"http://127.0.0.1:{server.server_port}"
+        get = lambda path: urllib.request.urlopen(base + path).read()
+        
+        original = trading_fix.TradingSystemRepair._check_wallets
+        def slow_check(self, user_id=None):
+            time.sleep(0.2)
+            return original(self, user_id)
+        trading_fix.TradingSystemRepair._check_wallets = slow_check
+        try:
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(json.loads(get("/checks/wallet_status"))))
+                       for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            trading_fix.TradingSystemRepair._check_wallets = original
+        assert len(results) == 5 and all(r == results[0] for r in results)
+        stats = json.loads(get("/stats"))
+        assert stats["computations"] == 1 and stats["shared_inflight"] == 4
+        
+        # Cached until the data changes
+        get("/checks/wallet_status")
+        assert json.loads(get("/stats"))["computations"] == 1
+        conn = sqlite3.connect(test_db)
+        conn.execute("UPDATE wallet_balances SET balance = 1 WHERE id = 'wb1'")
+        conn.commit()
+        conn.close()
+        assert json.loads(get("/checks/wallet_status"))["negative_balances"] == []
+        
+        summary = json.loads(get("/summary"))
+        assert "INCORRECT_PNL_CALCULATION" in [i["type"] for i in summary["issues"]]
+        # Dashboard polling: one scan, then cache hits (diagnosing must not move the token itself)
+        before = json.loads(get("/stats"))
+        for _ in range(3):
+            assert json.loads(get("/summary")) == summary
+        after = json.loads(get("/stats"))
+        assert after["computations"] == before["computations"]
+        assert after["cache_hits"] == before["cache_hits"] + 3
+        assert json.loads(get("/users/user2"))["user_id"] == "user2"
+        # The result cache is an LRU: per-user lookups cannot grow it without bound
+        cache_size = trading_fix.SERVICE_CACHE_SIZE
+        trading_fix.SERVICE_CACHE_SIZE = 3
+        try:
+            for user in ("user1", "user3", "user4", "user5"):
+                get(f"/users/{user}")
+            assert json.loads(get("/stats"))["cached_results"] == 3
+            hits = json.loads(get("/stats"))["cache_hits"]
+            get("/users/user5")
+            assert json.loads(get("/stats"))["cache_hits"] == hits + 1
+        finally:
+            trading_fix.SERVICE_CACHE_SIZE = cache_size
+        assert get("/report?format=ndjson").splitlines()[0].startswith(b'{"record":"diagnosis"')
+        try:
+            get("/checks/nope")
+            assert False, "expected 404"
+        except urllib.error.HTTPError as e:
+            assert e.code == 404
+        server.shutdown()
+        server.server_close()
+        server.service.close()
+        
+        # One memory budget split across the pool; close() reaches instances lent to a request too
+        from trading_fix import DiagnosticsService
+        service = DiagnosticsService(test_db, max_scans=1, max_memory=4000)
+        assert {repair.memory_budget.max_bytes for repair in service._repairs + [service._probe]} == {1000}
+        lent = service._pool.get()
+        service.close()
+        try:
+            lent.conn.execute("SELECT 1")
+            assert False, "lent connection left open"
+        except sqlite3.ProgrammingError:
+            pass
+    finally:
+        os.remove(test_db)
+
+def test_balance_at_uses_ledger_checkpoints():
+    """balance_at replays only the delta after the nearest checkpoint and matches a full replay"""
+    test_db = create_test_database()
+    try:
+        import trading_fix
+        from trading_fix import TradingSystemRepair
+        start = datetime(2026, 1, 1)
+        at = lambda i: (start + timedelta(minutes=i)).strftime('%Y-%m-%d %H:%M:%S')
+        conn = sqlite3.connect(test_db)
+        conn.executemany(
+            "INSERT INTO wallet_transactions (id, user_id, type, amount, currency, balance_before, balance_after, "
+            "reference_id, created_at) VALUES (?, 'user3', 'trade', ?, 'ETH', 0, 0, 'order3', ?)",
+            [(f"eth{i}", float(i % 7) - 2.5, at(i)) for i in range(95)]
+        )
+        conn.commit()
+        conn.close()
+        
+        interval = trading_fix.LEDGER_CHECKPOINT_INTERVAL
+        trading_fix.LEDGER_CHECKPOINT_INTERVAL = 10
+        try:
+            repair = TradingSystemRepair(test_db)
+            build = repair.build_ledger_checkpoints()
+            assert build["rows"] == 97 and build["checkpoints_written"] == 9
+            assert repair.build_ledger_checkpoints()["rows"] == 0
+            
+            for i in (0, 9, 10, 47, 94):
+                expected = sum(float(j % 7) - 2.5 for j in range(i + 1))
+                balance = repair.balance_at("user3", "ETH", at(i))
+                assert abs(balance["balance"] - expected) < 1e-9
+                assert balance["entries"] == i + 1 and balance["replayed"] < 10
+            assert repair.balance_at("user3", "ETH", "2025-12-31 00:00:00")["balance"] == 0
+            
+            # Reconciliation reads the heads; new entries only extend them
+            reconciliation = repair.reconcile_wallets()
+            eth = [r for r in reconciliation["balance_mismatches"] if r["user_id"] == "user3"]
+            assert eth[0]["wallet_balance"] == 10.0 and abs(eth[0]["ledger_balance"] - (-2.5 * 95 + sum(j % 7 for j in range(95)))) < 1e-9
+            assert reconciliation["checkpoints"]["rows"] == 0
+            assert {(r["user_id"], r["currency"]) for r in reconciliation["balance_mismatches"]} >= {("user1", "BTC"), ("user2", "USDT")}
+            assert ("user1", "USDT") not in {(r["user_id"], r["currency"]) for r in reconciliation["balance_mismatches"]}
+            repair.conn.close()
+        finally:
+            trading_fix.LEDGER_CHECKPOINT_INTERVAL = interval
+    finally:
+        os.remove(test_db)
+
+def test_double_entry_groups_by_reference_and_currency():
+    """Transfers must net to zero and trades net of fees; incremental mode re-checks new references only"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair
+        legs = [
+            ("t1", "user1", "transfer", -100, "USDT", "xfer1"), ("t2", "user2", "transfer", 100, "USDT", "xfer1"),
+            ("t3", "user1", "transfer", -100, "USDT", "xfer2"), ("t4", "user2", "transfer", 90, "USDT", "xfer2"),
+            ("t5", "user1", "trade", -45000, "USDT", "order1"), ("t6", "user2", "trade", 45000, "USDT", "order1"),
+            ("t7", "user1", "fee", -45, "USDT", "order1"),
+            ("t8", "user1", "trade", 1, "BTC", "order1"), ("t9", "user2", "trade", -1, "BTC", "order1"),
+        ]
+        insert = ("INSERT INTO wallet_transactions (id, user_id, type, amount, currency, balance_before, "
+                  "balance_after, reference_id) VALUES (?, ?, ?, ?, ?, 0, 0, ?)")
+        conn = sqlite3.connect(test_db)
+        conn.executemany(insert, legs)
+        conn.commit()
+        
+        repair = TradingSystemRepair(test_db, use_cache=False)
+        repair.install_indexes()
+        plan = " ".join(row["detail"] for row in repair._execute_query(
+            "EXPLAIN QUERY PLAN SELECT reference_id, currency, SUM(amount) FROM wallet_transactions "
+            "GROUP BY reference_id, currency"))
+        assert "idx_repair_wallet_transactions_reference" in plan and "TEMP B-TREE" not in plan
+        
+        groups = lambda d: {(g["reference_id"], g["currency"]): g["imbalance"]
+                            for g in d["ledger_integrity"]["unbalanced_transactions"]}
+        full = repair.diagnose_system()
+        assert groups(full) == {("xfer2", "USDT"): -10, ("missing_order_id", "USDT"): -50}
+        assert "UNBALANCED_LEDGER_TRANSACTIONS" in [i["type"] for i in full["issues_found"]]
+        assert groups(repair.diagnose_system(incremental=True)) == groups(full)
+        assert repair._execute_query("SELECT value FROM repair_state WHERE key = 'ledger_balance_rowid'")
+        
+        # New legs: xfer2 gets its missing part, order1's BTC side gets a stray extra leg
+        conn.executemany(insert, [("t10", "user2", "transfer", 10, "USDT", "xfer2"),
+                                  ("t11", "user3", "trade", 0.5, "BTC", "order1")])
+        conn.commit()
+        conn.close()
+        incremental = repair.diagnose_system(incremental=True)
+        assert groups(incremental) == {("order1", "BTC"): 0.5, ("missing_order_id", "USDT"): -50}
+        assert groups(incremental) == groups(repair.diagnose_system())
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_memory_budget_spools_offender_rows():
+    """Past --max-memory, offender rows stream from a disk spool in the same order"""
+    import json
+    test_db = create_test_database()
+    export = "test_spooled.ndjson"
+    try:
+        from trading_fix import TradingSystemRepair, SpooledRows, parse_size
+        assert parse_size("256M") == 256 << 20 and parse_size("512k") == 512 << 10 and parse_size("1000") == 1000
+        conn = sqlite3.connect(test_db)
+        conn.executemany(
+            "INSERT INTO wallet_balances (id, user_id, currency, balance, frozen_balance) VALUES (?, ?, 'USDT', ?, 0)",
+            [(f"neg{i}", f"bulk{i}", -float(i)) for i in range(1, 301)]
+        )
+        conn.commit()
+        conn.close()
+        
+        unbounded = TradingSystemRepair(test_db, top_k=None)
+        expected = unbounded.diagnose_system()
+        unbounded.conn.close()
+        
+        repair = TradingSystemRepair(test_db, top_k=None, max_memory=20000)
+        diagnosis = repair.diagnose_system()
+        rows = diagnosis["wallet_status"]["negative_balances"]
+        assert isinstance(rows, SpooledRows) and len(rows) == 301
+        assert list(rows) == expected["wallet_status"]["negative_balances"]
+        assert rows and list(rows) == list(rows)
+        memory = diagnosis["memory"]
+        assert memory["spooled_rows"] >= 301 and memory["peak_retained_bytes"] <= 20000
+        assert [i["count"] for i in diagnosis["issues_found"]] == [i["count"] for i in expected["issues_found"]]
+        
+        repair.export_diagnosis(diagnosis, "ndjson", export)
+        with open(export) as f:
+            records = [json.loads(line) for line in f]
+        negative = [r["data"] for r in records if r.get("issue") == "NEGATIVE_BALANCE"]
+        assert negative == expected["wallet_status"]["negative_balances"]
+        
+        spool = repair.memory_budget.spool_path
+        repair.memory_budget.close()
+        assert not os.path.exists(spool)
+        repair.conn.close()
+        
+        # The CLI removes its spool even when the action fails part-way
+        import shutil
+        import signal
+        import sys
+        import tempfile
+        import trading_fix
+        spill_dir = tempfile.mkdtemp()
+        handlers = {signum: signal.getsignal(signum) for signum in (signal.SIGINT, signal.SIGTERM)}
+        argv, export_diagnosis = sys.argv, TradingSystemRepair.export_diagnosis
+        def failing_export(self, *args, **kwargs):
+            raise RuntimeError("disk full")
+        try:
+            sys.argv = ["trading_fix.py", "diagnose", "--db", test_db, "--no-cache", "--max-memory", "20000",
+                        "--spill-dir", spill_dir, "--report"]
+            TradingSystemRepair.export_diagnosis = failing_export
+            try:
+                trading_fix.main()
+                assert False, "export failure should propagate"
+            except RuntimeError:
+                pass
+            assert not [name for name in os.listdir(spill_dir) if name.startswith("diagnosis_spool_")]
+        finally:
+            sys.argv, TradingSystemRepair.export_diagnosis = argv, export_diagnosis
+            for signum, handler in handlers.items():
+                signal.signal(signum, handler)
+            shutil.rmtree(spill_dir)
+    finally:
+        for path in (test_db, export):
+            if os.path.exists(path):
+                os.remove(path)
+
+def test_archive_ledger_scans_only_disagreeing_partitions():
+    """Settled months are staged, verified, purged, summarised; diagnosis opens an archive only once it stops matching"""
+    import shutil
+    import tempfile
+    test_db = create_test_database()
+    archive_dir = tempfile.mkdtemp()
+    try:
+        from trading_fix import TradingSystemRepair
+        start = datetime(2026, 1, 1)
+        at = lambda i: (start + timedelta(days=i)).strftime('%Y-%m-%d %H:%M:%S')
+        conn = sqlite3.connect(test_db)
+        conn.execute("INSERT INTO orders (id, user_id, symbol, type, side, amount, price, status) "
+                     "VALUES ('order3', 'user3', 'ETHUSDT', 'limit', 'buy', 1.0, 100, 'filled')")
+        ledger = ("INSERT INTO wallet_transactions (id, user_id, type, amount, currency, balance_before, "
+                  "balance_after, reference_id, created_at) VALUES (?, 'user3', 'trade', ?, 'ETH', 0, 0, ?, ?)")
+        conn.executemany(ledger, [(f"old{i}", float(i % 5) - 1.5, "order3", at(i)) for i in range(40)])
+        # Still pending, and reversed by a current entry: neither is archived
+        conn.execute(ledger, ("pend1", 0.0, "order2", at(3)))
+        conn.execute(ledger, ("rev5", 0.0, "old5", "2099-01-01 00:00:00"))
+        conn.commit()
+        conn.close()
+        
+        repair = TradingSystemRepair(test_db)
+        live_count = lambda: repair.conn.execute("SELECT COUNT(*) FROM wallet_transactions").fetchone()[0]
+        archived = repair.archive_ledger(older_than_months=3, archive_dir=archive_dir)
+        assert archived["entries_staged"] == 39 and not archived["failed"]
+        assert [(p["partition"], p["staged"]) for p in archived["partitions"]] == [("2026-01", 30), ("2026-02", 9)]
+        assert live_count() == 44
+        
+        # A live row edited after staging holds back its month until it verifies again
+        repair.conn.execute("UPDATE wallet_transactions SET amount = amount + 1 WHERE id = 'old0'")
+        repair.conn.commit()
+        purged = repair.purge_archived_ledger()
+        assert [p["partition"] for p in purged["skipped"]] == ["2026-01"]
+        assert purged["entries_moved"] == 9 and live_count() == 35
+        repair.conn.execute("UPDATE wallet_transactions SET amount = amount - 1 WHERE id = 'old0'")
+        repair.conn.commit()
+        purged = repair.purge_archived_ledger()
+        assert not purged["skipped"] and purged["entries_moved"] == 30
+        assert sorted(row[0] for row in repair.conn.execute("SELECT id FROM wallet_transactions")) == \
+            ["old5", "pend1", "rev5", "tx1", "tx2"]
+        assert repair.purge_archived_ledger()["entries_moved"] == 0
+        
+        status = repair.diagnose_system()["archive_status"]
+        assert status["partitions"] == 2 and status["archived_entries"] == 39
+        assert status["archives_scanned"] == 0 and not status["archive_mismatches"]
+        
+        # Point-in-time balances still see the archived entries
+        for i in (10, 35):
+            expected = sum(float(j % 5) - 1.5 for j in range(i + 1))
+            assert abs(repair.balance_at("user3", "ETH", at(i))["balance"] - expected) < 1e-9
+        
+        # Editing an archive is caught and only that archive is scanned
+        tampered = sqlite3.connect(archived["partitions"][1]["path"])
+        tampered.execute("UPDATE wallet_transactions SET amount = amount + 100, reference_id = 'gone' WHERE id = 'old35'")
+        tampered.commit()
+        tampered.close()
+        diagnosis = repair.diagnose_system()
+        status = diagnosis["archive_status"]
+        assert status["archives_scanned"] == 1
+        assert [m["partition"] for m in status["archive_mismatches"]] == ["2026-02"]
+        assert [o["id"] for o in status["archived_orphans"]] == ["old35"]
+        assert "ARCHIVE_PARTITION_MISMATCH" in {issue["type"] for issue in diagnosis["issues_found"]}
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+        shutil.rmtree(archive_dir)
+
+def test_reconcile_fills_hash_and_sort_merge_agree():
+    """Fill files reconcile the same whether joined in memory or by merging sorted runs"""
+    import tempfile
+    test_db = create_test_database()
+    fills = tempfile.NamedTemporaryFile("w", suffix=".csv", delete=False)
+    try:
+        from trading_fix import TradingSystemRepair
+        conn = sqlite3.connect(test_db)
+        conn.executemany(
+            "INSERT INTO orders (id, user_id, symbol, type, side, amount, price, status) "
+            "VALUES (?, 'user1', 'BTCUSDT', 'limit', 'buy', ?, 100, 'filled')",
+            [(f"ord{i:02d}", float(i + 1)) for i in range(50)]
+        )
+        conn.commit()
+        conn.close()
+        
+        # Two partial fills per order; ord07 is short, ghost has no order, ord40+ have no fills
+        fills.write("order_id,amount\n")
+        for i in reversed(range(40)):
+            for _ in range(2):
+                fills.write(f"ord{i:02d},{(i + 1) / 2 - (0.25 if i == 7 else 0)}\n")
+        fills.write("ghost,3\n")
+        fills.write(",1\n")
+        fills.close()
+        
+        repair = TradingSystemRepair(test_db, top_k=None)
+        hashed = repair.reconcile_fills(fills.name)
+        merged = repair.reconcile_fills(fills.name, max_keys=8)
+        assert hashed["mode"] == "hash" and merged["mode"] == "sort-merge" and merged["runs"] == 6
+        for result in (hashed, merged):
+            assert result["source"] == "orders" and result["rows"] == 82 and result["skipped"] == 1
+            assert result["matched"] == 40 and result["keys"] == 41
+            assert [r["order_id"] for r in result["missing_records"]] == ["ghost"]
+            assert {r["order_id"] for r in result["extra_records"]} == \
+                {f"ord{i}" for i in range(40, 50)} | {"order1", "order2"}
+            assert [(r["order_id"], r["difference"]) for r in result["amount_mismatches"]] == [("ord07", -0.5)]
+            assert result["rows_per_sec"] > 0
+        repair.conn.close()
+        
+        # INTEGER ids: the merge join compares keys in the file's (text) order
+        int_db = test_db + ".int"
+        conn = sqlite3.connect(int_db)
+        conn.execute("CREATE TABLE orders (id INTEGER PRIMARY KEY, amount REAL NOT NULL, created_at TEXT)")
+        conn.executemany("INSERT INTO orders (id, amount) VALUES (?, ?)", [(i, float(i)) for i in range(1, 31)])
+        conn.commit()
+        conn.close()
+        with open(fills.name, "w") as f:
+            f.write("order_id,amount\n" + "".join(f"{i},{float(i)}\n" for i in range(1, 31)))
+        repair = TradingSystemRepair(int_db, top_k=None)
+        try:
+            for result in (repair.reconcile_fills(fills.name), repair.reconcile_fills(fills.name, max_keys=4)):
+                assert result["matched"] == 30, result["mode"]
+                assert not result["missing_records"] and not result["extra_records"]
+        finally:
+            repair.conn.close()
+            os.remove(int_db)
+    finally:
+        os.remove(test_db)
+        os.remove(fills.name)
+
+def test_sampled_diagnosis_estimates_and_escalates():
+    """Sampling estimates rule counts within its interval and escalates hot rules to exact counts"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair
+        conn = sqlite3.connect(test_db)
+        conn.executemany(
+            "INSERT INTO wallet_balances (id, user_id, currency, balance, frozen_balance) VALUES (?, ?, 'USDT', ?, 0)",
+            [(f"bulk{i}", f"bulk_user{i}", -1.0 if i % 50 == 0 else 100.0) for i in range(20000)]
+        )
+        conn.commit()
+        conn.close()
+        
+        repair = TradingSystemRepair(test_db)
+        sampled = repair.diagnose_sample(0.1, seed=7)
+        wallets = sampled["tables"]["wallet_balances"]
+        assert not wallets["exact"] and 1500 < wallets["rows_sampled"] < 2500
+        negative = sampled["rules"]["negative_balances"]
+        assert negative["ci_low"] <= 401 <= negative["ci_high"] and not negative["escalated"]
+        assert negative["sample_offenders"] and all(r["balance"] < 0 for r in negative["sample_offenders"])
+        # Small tables are read in full
+        assert sampled["rules"]["incorrect_pnl"]["exact"]
+        assert sampled["rules"]["orphaned_entries"]["estimate"] == 2
+        # The orphan rule probes order/request ids per entry instead of rebuilding their id set per block
+        from trading_fix import ORPHANED_REFERENCE_SQL
+        plan = " | ".join(row["detail"] for row in repair.conn.execute(
+            f"EXPLAIN QUERY PLAN SELECT *, ({ORPHANED_REFERENCE_SQL}) FROM wallet_transactions WHERE rowid BETWEEN 1 AND 64"
+        ))
+        assert "SCAN o" not in plan and "SCAN r" not in plan and "SEARCH o" in plan, plan
+        
+        escalated = repair.diagnose_sample(0.1, escalate_above=0.005, seed=7)["rules"]
+        assert escalated["negative_balances"]["escalated"] and escalated["negative_balances"]["estimate"] == 401
+        # Negative balances also hold more than their (zero) frozen amount
+        assert escalated["locked_exceeds_available"]["estimate"] == 402
+        assert not escalated["stale_orders"]["escalated"]
+        
+        # Sampled reports honour the requested format
+        import json
+        report = repair.export_diagnosis(sampled, "ndjson", test_db + ".ndjson")
+        with open(report) as f:
+            records = [json.loads(line) for line in f]
+        os.remove(report)
+        assert records[0]["mode"] == "sample"
+        rule = next(r for r in records if r.get("rule") == "negative_balances" and r["record"] == "rule")
+        assert rule["estimate"] == negative["estimate"]
+        assert len([r for r in records if r.get("rule") == "negative_balances" and r["record"] == "row"]) == \
+            len(negative["sample_offenders"])
+        report = repair.export_diagnosis(sampled, "html", test_db + ".html")
+        with open(report) as f:
+            assert "negative_balances" in f.read()
+        os.remove(report)
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_stale_order_fix_releases_frozen_funds():
+    """Stale orders are cancelled and their frozen funds released per account in two UPDATEs"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair
+        conn = sqlite3.connect(test_db)
+        conn.executemany(
+            "INSERT INTO wallet_balances (id, user_id, currency, balance, frozen_balance) VALUES (?, 'user5', ?, ?, ?)",
+            [("w5u", "USDT", 5000.0, 2000.0), ("w5e", "ETH", 10.0, 3.0)]
+        )
+        conn.executemany(
+            "INSERT INTO orders (id, user_id, symbol, type, side, amount, price, status, created_at) "
+            "VALUES (?, 'user5', ?, 'limit', ?, ?, ?, 'open', ?)",
+            [(f"s{i}", "BTCUSDT", "buy", 0.01, 40000, "2026-01-01 00:00:00") for i in range(30)] +
+            [("s_eth", "ETH/USDT", "sell", 2.0, 3000, "2026-01-01 00:00:00"),
+             ("fresh", "BTCUSDT", "buy", 0.01, 40000, "2099-01-01 00:00:00")]
+        )
+        conn.commit()
+        conn.close()
+        
+        repair = TradingSystemRepair(test_db)
+        statements = []
+        repair.conn.set_trace_callback(statements.append)
+        fix = repair._fix_stale_orders()
+        repair.conn.set_trace_callback(None)
+        assert fix["orders_cancelled"] == 32  # plus order1 from the fixture
+        assert abs(fix["frozen_released"]["USDT"] - (30 * 400 + 45000)) < 1e-6
+        assert fix["frozen_released"]["ETH"] == 2.0
+        assert len([sql for sql in statements if sql.lstrip().upper().startswith("UPDATE")]) == 2
+        
+        frozen = dict(repair.conn.execute(
+            "SELECT currency, frozen_balance FROM wallet_balances WHERE user_id = 'user5'").fetchall())
+        assert frozen == {"USDT": 0.0, "ETH": 1.0}
+        assert repair.conn.execute("SELECT status FROM orders WHERE id = 'fresh'").fetchone()[0] == "open"
+        assert repair.conn.execute("SELECT frozen_balance FROM wallet_balances WHERE id = 'wb2'").fetchone()[0] == 0
+        
+        # Where-clause parameters are bound in the chunked (online) path as well
+        from trading_fix import RepairThrottle
+        repair._throttle = RepairThrottle(initial_chunk=1, min_chunk=1)
+        assert repair._apply_change("orders", "status = ?", "user_id = ? AND status = ?",
+                                    ("open",), ("user5", "cancelled")) == 31
+        assert repair._throttle.chunks > 1
+        repair._throttle = None
+        assert repair.conn.execute("SELECT COUNT(*) FROM orders WHERE user_id = 'user5' AND status = 'open'"
+                                   ).fetchone()[0] == 32
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_user_risk_summary_maintained_from_dirty_keys():
+    """The risk summary is refreshed for changed users only and agrees with a bulk rebuild"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair
+        repair = TradingSystemRepair(test_db, use_cache=False)
+        raw = repair._assess_risk()
+        repair.install_change_tracking(dirty_keys=True)
+        assert not repair._risk_summary_current()
+        assert repair.refresh_risk_summary()["mode"] == "rebuild"
+        assert repair._risk_summary_current()
+        summarised = repair._assess_risk()
+        assert sorted(r["id"] for r in summarised["high_risk_positions"]) == \
+            sorted(r["id"] for r in raw["high_risk_positions"])
+        assert summarised["net_exposure_by_user"].keys() == raw["net_exposure_by_user"].keys()
+        assert all(abs(net - raw["net_exposure_by_user"][user]) < 1e-6
+                   for user, net in summarised["net_exposure_by_user"].items())
+        
+        repair.conn.execute("UPDATE positions SET margin = 5000 WHERE id = 'pos3'")
+        repair.conn.execute(
+            "INSERT INTO positions (id, user_id, symbol, side, quantity, entry_price, current_price, margin, "
+            "leverage, unrealized_pnl, status) VALUES ('pos4', 'user4', 'ETHUSDT', 'sell', 2, 3000, 3100, 100, 60, 0, 'open')"
+        )
+        repair.conn.commit()
+        # A stale summary is not read (nor refreshed) by the check: it aggregates positions itself
+        assert not repair._risk_summary_current()
+        changes = repair.conn.total_changes
+        assert "pos4" in {r["id"] for r in repair._assess_risk()["high_risk_positions"]}
+        assert repair.conn.total_changes == changes
+        refresh = repair.refresh_risk_summary()
+        assert refresh == {"mode": "incremental", "users_refreshed": 2, "seconds": refresh["seconds"]}
+        incremental = repair._execute_query("SELECT * FROM user_risk_summary ORDER BY user_id")
+        assert repair.refresh_risk_summary(rebuild=True)["users_refreshed"] == 4
+        rebuilt = repair._execute_query("SELECT * FROM user_risk_summary ORDER BY user_id")
+        strip = lambda rows: [{k: v for k, v in row.items() if k != "updated_at"} for row in rows]
+        assert strip(incremental) == strip(rebuilt)
+        user4 = next(row for row in rebuilt if row["user_id"] == "user4")
+        assert user4["max_leverage"] == 62.0 and user4["net_notional"] == -6200.0 and user4["net_pnl"] == -200.0
+        
+        assert repair.refresh_risk_summary()["users_refreshed"] == 0
+        high = {r["id"] for r in repair._assess_risk()["high_risk_positions"]}
+        assert "pos4" in high and "pos3" not in high
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_metrics_history_rolls_up_and_answers_trends():
+    """Each diagnosis appends metrics; old points fold into hourly and daily buckets"""
+    import time
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair
+        # Off by default: a plain diagnosis leaves the database untouched
+        plain = TradingSystemRepair(test_db, use_cache=False)
+        plain.diagnose_system()
+        assert not plain._execute_query("SELECT name FROM sqlite_master WHERE name = 'repair_metrics'")
+        plain.conn.close()
+        
+        repair = TradingSystemRepair(test_db, keep_metrics=True)
+        diagnosis = repair.diagnose_system()
+        assert "wallet_status" in diagnosis["durations"]
+        # Recording does not invalidate the cached checks
+        assert repair.diagnose_system()["cache"]["misses"] == 0
+        
+        now = int(time.time())
+        day = 86400
+        for offset in (100 * day, 100 * day - 60, 40 * day, 40 * day - 7200, day, 0):
+            repair.record_metrics(diagnosis, at=now - offset)
+        resolutions = dict(repair.conn.execute("""
+            SELECT resolution, COUNT(*) FROM repair_metrics
+            WHERE metric = 'wallet_status.negative_balances.count' GROUP BY resolution
+        """).fetchall())
+        # Runs within the same second share one raw point
+        assert resolutions["day"] == 1 and resolutions["hour"] == 2 and resolutions["raw"] >= 2
+        
+        trend = repair.metric_trend("negative_balances", days=120)
+        assert trend["metric"] == "wallet_status.negative_balances.count" and trend["step"] == "day"
+        assert sum(p["samples"] for p in trend["points"]) == 8
+        assert all(p["average"] == 1 and p["maximum"] == 1 for p in trend["points"])
+        assert repair.metric_trend("negative_balances", days=1)["step"] == "hour"
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_fixed_point_comparisons_ignore_float_noise():
+    """Money is compared in integer minor units, so float noise neither offends nor triggers writes"""
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair, calculate_pnl, symbol_base, to_minor
+        assert symbol_base("BTCUSDT") == "BTC" and symbol_base("ETH/USDT") == "ETH"
+        assert to_minor(0.1 + 0.2, "BTC") == to_minor(0.3, "BTC") == 30000000
+        assert to_minor(-0.005, "USDT") == -1 and to_minor(1.004, "USDT") == 100
+        
+        conn = sqlite3.connect(test_db)
+        conn.execute("INSERT INTO wallet_balances (id, user_id, currency, balance, frozen_balance) "
+                     "VALUES ('noise', 'user9', 'BTC', 0.3, ?)", (0.1 + 0.2,))
+        conn.commit()
+        conn.close()
+        
+        repair = TradingSystemRepair(test_db, use_cache=False)
+        diagnosis = repair.diagnose_system()
+        assert "user9" not in {r["user_id"] for r in diagnosis["wallet_status"]["locked_exceeds_available"]}
+        
+        fixes = repair.fix_issues(diagnosis)
+        assert repair.conn.execute("SELECT frozen_balance FROM wallet_balances WHERE id = 'noise'").fetchone()[0] == 0.1 + 0.2
+        pnl_fix = next(fix for fix in fixes["fixes"] if fix["type"] == "PNL_FIX")
+        assert pnl_fix["positions_updated"] == 3
+        
+        # Repaired PnL is the exact recomputed value, not rounded to the quote currency
+        stored = {row["id"]: dict(row) for row in repair.conn.execute("SELECT * FROM positions")}
+        for row in stored.values():
+            assert abs(row["unrealized_pnl"] - calculate_pnl(row)) < 1e-12
+        assert abs(stored["pos1"]["unrealized_pnl"] - 0.0222222) < 1e-6
+        assert abs(stored["pos3"]["unrealized_pnl"] - 0.0056818) < 1e-6
+        after = repair.diagnose_system()
+        assert after["position_status"]["totals"]["incorrect_pnl"]["count"] == 0
+        assert repair._fix_pnl_calculations()["positions_updated"] == 0
+        repair.conn.execute("UPDATE positions SET unrealized_pnl = unrealized_pnl + 1e-9")
+        repair.conn.commit()
+        assert repair.diagnose_system()["position_status"]["totals"]["incorrect_pnl"]["count"] == 0
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_progress_reporting_and_cancellation_rolls_back():
+    """Checks report rows and rate; a cancel aborts the repair and rolls its transaction back"""
+    import signal
+    test_db = create_test_database()
+    try:
+        from trading_fix import TradingSystemRepair, OperationCancelled, install_cancel_handlers
+        repair = TradingSystemRepair(test_db, use_cache=False, keep_metrics=True)
+        diagnosis = repair.diagnose_system()
+        assert diagnosis["progress"]["position_status"]["rows"] == diagnosis["progress"]["position_status"]["total"] == 3
+        assert diagnosis["progress"]["wallet_status"]["rows"] > 0
+        assert repair.metric_trend("check.wallet_status.rows", days=1)["points"]
+        
+        pnl_before = repair.conn.execute("SELECT id, unrealized_pnl FROM positions ORDER BY id").fetchall()
+        previous = install_cancel_handlers(repair.progress)
+        try:
+            # PnL fix runs first; the signal arrives before the balance fixes
+            fix_balances = repair._fix_negative_balances
+            def interrupted():
+                os.kill(os.getpid(), signal.SIGTERM)
+                # Check the handler on every VM step so the next statement is aborted
+                repair.conn.set_progress_handler(repair.progress.on_vm_step, 1)
+                return fix_balances()
+            repair._fix_negative_balances = interrupted
+            try:
+                repair.fix_issues(diagnosis)
+                assert False, "repair was not cancelled"
+            except OperationCancelled:
+                pass
+        finally:
+            for signum, handler in previous.items():
+                signal.signal(signum, handler)
+        assert repair.progress.cancel_requested
+        repair.conn.set_progress_handler(None, 0)
+        assert repair.conn.execute("SELECT id, unrealized_pnl FROM positions ORDER BY id").fetchall() == pnl_before
+        assert not repair.conn.in_transaction
+        repair.conn.close()
+    finally:
+        os.remove(test_db)
+
+def test_backend_script_runs_trading_fix():
+    """backend/scripts/trading_system_repair.py is a launcher for trading_fix, runnable from any directory"""
+    import subprocess
+    test_db = os.path.abspath(create_test_database())
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "backend", "scripts", "trading_system_repair.py")
+    try:
+        with open(script) as f:
+            assert len(f.read().splitlines()) < 30
+        result = subprocess.run([sys.executable, script, "diagnose", "--db", test_db, "--no-cache"],
+                                cwd=os.path.dirname(script), capture_output=True, text=True, timeout=60)
+        assert result.returncode == 0, result.stderr
+        assert "SYSTEM DIAGNOSIS RESULTS" in result.stdout
+    finally:
+        os.remove(test_db)
+        log = os.path.join(os.path.dirname(script), "trading_fix.log")
+        if os.path.exists(log):
+            os.remove(log)
+
 def main():
     print("=" * 60)
     print("Trading System Diagnostic Tool - Test Suite")
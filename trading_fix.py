@@ -5,16 +5,44 @@ Professional tool for analyzing and fixing trading page wallet integration issue
 """
 
 import argparse
-import sys
+import bisect
+import csv
+import glob
+import gzip
+import hashlib
+import heapq
 import json
 import logging
+import math
+import os
+import queue
+import random
+import re
+import signal
 import sqlite3
+import sys
+import tempfile
+import threading
 import time
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional, Tuple
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor, as_completed
+from contextlib import contextmanager
 from dataclasses import dataclass, asdict
+from datetime import datetime, timedelta, timezone
 from enum import Enum
-import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs, unquote, urlparse
+
+try:
+    import numpy as np
+except ImportError:  # numpy is optional; the risk engine falls back to pure Python
+    np = None
+
+try:
+    import resource
+except ImportError:  # not available on Windows; peak memory is then not reported
+    resource = None
 
 # Configure logging
 logging.basicConfig(
@@ -67,20 +95,1574 @@ class Position:
     unrealized_pnl: float
     margin: float
     liquidation_price: float
+    key: Optional[int] = None
+
+    @property
+    def is_long(self) -> bool:
+        return self.side in ('buy', 'long')
+
+    @classmethod
+    def from_row(cls, row: Dict) -> "Position":
+        """Build a position from a positions table row, computing its liquidation price"""
+        mark = row['current_price'] if row.get('current_price') is not None else row['entry_price']
+        return cls(
+            user_id=row['user_id'],
+            symbol=row['symbol'],
+            side=row['side'],
+            size=row['quantity'],
+            entry_price=row['entry_price'],
+            mark_price=mark,
+            unrealized_pnl=row.get('unrealized_pnl') or 0,
+            margin=row['margin'],
+            liquidation_price=liquidation_price(row['side'], row['quantity'], row['entry_price'], row['margin']),
+            key=row.get('rowid', row.get('id'))
+        )
+
+# Price shocks evaluated by the risk engine: -50% .. +50% in 1% steps
+DEFAULT_SHOCKS = tuple(step / 100 for step in range(-50, 51) if step != 0)
+MAINTENANCE_MARGIN_RATE = 0.005
+HIGH_LEVERAGE_THRESHOLD = 20
+# Positions whose liquidation price is within this fraction of the mark are near liquidation
+NEAR_LIQUIDATION_BUFFER = 0.05
+
+def liquidation_price(side: str, quantity: float, entry_price: float, margin: float,
+                      maintenance_margin_rate: float = MAINTENANCE_MARGIN_RATE) -> float:
+    """Price at which margin + PnL falls to the maintenance margin (same rule as RiskEngine)"""
+    if quantity <= 0:
+        return float('nan')
+    if side in ('buy', 'long'):
+        return (quantity * entry_price - margin) / (quantity * (1 - maintenance_margin_rate))
+    return (quantity * entry_price + margin) / (quantity * (1 + maintenance_margin_rate))
+
+# Online repair: longest a chunk may hold the write lock, and chunk size bounds
+DEFAULT_MAX_LOCK_MS = 50.0
+MIN_REPAIR_CHUNK = 10
+MAX_REPAIR_CHUNK = 50000
+
+# Progress: SQLite VM instructions between progress-handler calls, seconds between log lines
+PROGRESS_HANDLER_OPS = 10000
+PROGRESS_LOG_SECONDS = 5.0
+# Checks that stream a whole table through Python, whose size then gives the ETA
+# (the others only fetch SQL-prefiltered candidates, so report rows and rate only)
+PROGRESS_SCANNED_TABLES = {"position_status": "positions", "ledger_integrity": "wallet_transactions"}
+
+class OperationCancelled(Exception):
+    """A scan or repair was cancelled (SIGINT/SIGTERM); any open repair transaction was rolled back"""
+
+class ProgressTracker:
+    """Rows processed, rate and ETA of the running stage (one diagnosis check or a repair)
+
+    Chunked iteration (_iter_query, repair chunks) reports rows as they
+    are fetched; the SQLite progress handler fires every
+    PROGRESS_HANDLER_OPS VM instructions, so long single statements
+    (aggregates, set-based updates) still log and can be interrupted.
+    After cancel() the next batch raises OperationCancelled and the
+    running statement is aborted.
+    """
+
+    def __init__(self, log_interval: float = PROGRESS_LOG_SECONDS):
+        self.log_interval = log_interval
+        self.cancel_requested = False
+        self.stage = None
+        self.total = None
+        self.rows = 0
+        self.started = 0.0
+        self._last_log = 0.0
+
+    def start(self, stage: str, total: Optional[int] = None):
+        self.stage, self.total, self.rows = stage, total, 0
+        self.started = self._last_log = time.perf_counter()
+
+    def advance(self, rows: int):
+        self.rows += rows
+        self.check()
+        self._maybe_log()
+
+    def on_vm_step(self) -> int:
+        """sqlite3 progress handler; a non-zero return aborts the running statement"""
+        if self.cancel_requested:
+            return 1
+        self._maybe_log()
+        return 0
+
+    def cancel(self):
+        self.cancel_requested = True
+
+    def check(self):
+        if self.cancel_requested:
+            raise OperationCancelled(f"cancelled during {self.stage or 'run'}")
+
+    def finish(self) -> Dict:
+        snapshot = self.snapshot()
+        self.stage = None
+        return snapshot
+
+    def snapshot(self) -> Dict:
+        elapsed = time.perf_counter() - self.started if self.stage else 0.0
+        rate = self.rows / elapsed if elapsed > 0 else 0.0
+        eta = max(0.0, (self.total - self.rows) / rate) if self.total and rate > 0 else None
+        return {
+            "stage": self.stage,
+            "rows": self.rows,
+            "total": self.total,
+            "seconds": elapsed,
+            "rows_per_sec": rate,
+            "eta_seconds": eta
+        }
+
+    def _maybe_log(self):
+        now = time.perf_counter()
+        if self.stage is None or now - self._last_log < self.log_interval:
+            return
+        self._last_log = now
+        progress = self.snapshot()
+        total = f"/~{progress['total']:,}" if progress['total'] else ""
+        eta = f", ETA {progress['eta_seconds']:.0f}s" if progress['eta_seconds'] is not None else ""
+        logger.info(f"{self.stage}: {progress['rows']:,}{total} rows "
+                    f"({progress['rows_per_sec']:,.0f} rows/s{eta})")
+
+def install_cancel_handlers(progress: ProgressTracker) -> Dict:
+    """Route SIGINT/SIGTERM to progress.cancel(); a second signal aborts at once
+
+    Returns the previous handlers (signal -> handler) for restoring.
+    """
+    def handle(signum, frame):
+        if progress.cancel_requested:
+            raise KeyboardInterrupt
+        logger.warning(f"{signal.Signals(signum).name} received, cancelling "
+                       f"(open repair transaction will be rolled back; repeat to abort immediately)")
+        progress.cancel()
+
+    previous = {}
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        previous[signum] = signal.signal(signum, handle)
+    return previous
+
+class RepairThrottle:
+    """Chunk sizing and pacing for online (throttled) repairs
+
+    Each chunk is its own short write transaction. After every chunk the
+    size is adapted so the write lock is held for about max_lock_ms:
+    scaled down in proportion when a chunk overran (or when acquiring the
+    lock took longer than the budget, i.e. the app is busy), grown by half
+    otherwise. rows_per_sec, if set, caps overall throughput; the pause
+    between chunks is when the application gets the lock.
+    """
+
+    def __init__(self, max_lock_ms: float = DEFAULT_MAX_LOCK_MS, rows_per_sec: Optional[float] = None,
+                 initial_chunk: int = 500, min_chunk: int = MIN_REPAIR_CHUNK, max_chunk: int = MAX_REPAIR_CHUNK):
+        self.max_lock_ms = max_lock_ms
+        self.rows_per_sec = rows_per_sec
+        self.min_chunk = min_chunk
+        self.max_chunk = max_chunk
+        self.chunk_size = max(min_chunk, min(initial_chunk, max_chunk))
+        self.chunks = 0
+        self.rows = 0
+        self.hold_ms_total = 0.0
+        self.max_hold_ms = 0.0
+        self.max_lock_wait_ms = 0.0
+        self.started = None
+
+    def record(self, rows: int, lock_wait_ms: float, hold_ms: float):
+        """Account for one committed chunk and adapt the next chunk's size"""
+        self.chunks += 1
+        self.rows += rows
+        self.hold_ms_total += hold_ms
+        self.max_hold_ms = max(self.max_hold_ms, hold_ms)
+        self.max_lock_wait_ms = max(self.max_lock_wait_ms, lock_wait_ms)
+        if hold_ms > self.max_lock_ms or lock_wait_ms > self.max_lock_ms:
+            # Aim just under the budget at the rate this chunk achieved
+            scale = 0.8 * self.max_lock_ms / max(hold_ms, lock_wait_ms)
+            self.chunk_size = int(self.chunk_size * scale)
+        elif rows >= self.chunk_size:
+            self.chunk_size = int(self.chunk_size * 1.5)
+        self.chunk_size = max(self.min_chunk, min(self.chunk_size, self.max_chunk))
+
+    def pause(self) -> float:
+        """Seconds to wait before the next chunk so rows_per_sec is not exceeded"""
+        if self.started is None:
+            self.started = time.perf_counter()
+        if not self.rows_per_sec:
+            return 0.0
+        return max(0.0, self.rows / self.rows_per_sec - (time.perf_counter() - self.started))
+
+    def stats(self) -> Dict:
+        elapsed = time.perf_counter() - self.started if self.started is not None else 0.0
+        return {
+            "chunks": self.chunks,
+            "rows": self.rows,
+            "seconds": elapsed,
+            "rows_per_sec": self.rows / elapsed if elapsed else None,
+            "max_hold_ms": self.max_hold_ms,
+            "avg_hold_ms": self.hold_ms_total / self.chunks if self.chunks else 0.0,
+            "max_lock_wait_ms": self.max_lock_wait_ms,
+            "final_chunk_size": self.chunk_size
+        }
+
+DEFAULT_TOP_K = 500
+
+# Retained rows are costed at their JSON size times this (Python objects are larger than their JSON)
+MEMORY_ESTIMATE_FACTOR = 3
+SPOOL_BATCH_ROWS = 1000
+# Spilled offender rows are appended to their NDJSON file this many at a time
+SPILL_BATCH_ROWS = 1000
+
+def parse_size(text: str) -> int:
+    """Parse a byte size such as 268435456, 512K, 256M or 2G"""
+    text = text.strip().upper().rstrip("B")
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+def peak_rss_bytes() -> Optional[int]:
+    """Peak resident set size of this process (None where the platform cannot tell)"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == "darwin" else peak * 1024
+
+class MemoryBudget:
+    """Byte budget for offender rows retained in memory, with a SQLite spool for the overflow
+
+    Trackers reserve an estimate for every row they keep. Once a tracker
+    cannot reserve more it moves its rows to the spool and streams from
+    there; its rows() then returns a SpooledRows that reads back in
+    batches, most severe first.
+    """
+
+    def __init__(self, max_bytes: int, spool_dir: Optional[str] = None):
+        self.max_bytes = max_bytes
+        self.spool_dir = spool_dir
+        self.used = 0
+        self.peak_used = 0
+        self.spooled_rows = 0
+        self.spooled_trackers = 0
+        self.spool_path = None
+        self._spool = None
+        self._next_id = 0
+
+    def reserve(self, size: int) -> bool:
+        if self.used + size > self.max_bytes:
+            return False
+        self.used += size
+        self.peak_used = max(self.peak_used, self.used)
+        return True
+
+    def release(self, size: int):
+        self.used -= size
+
+    def new_spool_id(self) -> int:
+        self._next_id += 1
+        self.spooled_trackers += 1
+        return self._next_id
+
+    def spool(self) -> sqlite3.Connection:
+        if self._spool is None:
+            fd, self.spool_path = tempfile.mkstemp(prefix="diagnosis_spool_", suffix=".db", dir=self.spool_dir)
+            os.close(fd)
+            self._spool = sqlite3.connect(self.spool_path, check_same_thread=False)
+            self._spool.execute("PRAGMA journal_mode = OFF")
+            self._spool.execute("PRAGMA synchronous = OFF")
+            self._spool.execute("""
+                CREATE TABLE spool (
+                    tracker INTEGER NOT NULL,
+                    severity REAL,
+                    seq INTEGER NOT NULL,
+                    payload TEXT NOT NULL
+                )
+            """)
+        return self._spool
+
+    def write(self, tracker: int, rows: List[tuple]):
+        """Append (severity, seq, payload) rows for a tracker"""
+        self.spool().executemany(
+            "INSERT INTO spool (tracker, severity, seq, payload) VALUES (?, ?, ?, ?)",
+            [(tracker,) + row for row in rows]
+        )
+        self.spooled_rows += len(rows)
+
+    def finish(self, tracker: int):
+        """Index a tracker's spooled rows for ordered read-back"""
+        self.spool().execute(
+            "CREATE INDEX IF NOT EXISTS idx_spool_order ON spool (tracker, severity DESC, seq)"
+        )
+        self.spool().commit()
+
+    def read(self, tracker: int, limit: Optional[int]):
+        cursor = self.spool().execute(
+            "SELECT payload FROM spool WHERE tracker = ? ORDER BY severity DESC, seq LIMIT ?",
+            (tracker, -1 if limit is None else limit)
+        )
+        while True:
+            batch = cursor.fetchmany(SPOOL_BATCH_ROWS)
+            if not batch:
+                break
+            yield [json.loads(payload) for (payload,) in batch]
+
+    def stats(self) -> Dict:
+        return {
+            "max_bytes": self.max_bytes,
+            "retained_bytes": self.used,
+            "peak_retained_bytes": self.peak_used,
+            "spooled_rows": self.spooled_rows,
+            "spooled_checks": self.spooled_trackers,
+            "spool_file": self.spool_path
+        }
+
+    def close(self):
+        if self._spool is not None:
+            self._spool.close()
+            os.remove(self.spool_path)
+            self._spool = None
+
+class SpooledRows:
+    """Offender rows held in a MemoryBudget spool, streamed back most severe first
+
+    Iterable any number of times; transform() applies a per-batch function
+    (e.g. expanding rowids to full rows) while streaming.
+    """
+
+    def __init__(self, budget: MemoryBudget, tracker: int, length: int, limit: Optional[int],
+                 transforms: tuple = ()):
+        self._budget = budget
+        self._tracker = tracker
+        self._length = length
+        self._limit = limit
+        self._transforms = transforms
+
+    def __iter__(self):
+        for batch in self._budget.read(self._tracker, self._limit):
+            for transform in self._transforms:
+                batch = transform(batch)
+            yield from batch
+
+    def __len__(self) -> int:
+        return self._length
+
+    def __bool__(self) -> bool:
+        return self._length > 0
+
+    def transform(self, fn: Callable[[List], List]) -> "SpooledRows":
+        return SpooledRows(self._budget, self._tracker, self._length, self._limit, self._transforms + (fn,))
+
+class OffenderTracker:
+    """Exact count and sum of a check's offending rows plus a bounded top-K by severity
+
+    Only the K most severe rows are kept (a min-heap of size K), so memory
+    is constant however many rows offend. With spill_path every row is
+    also written to an NDJSON file, in batches through a short-lived handle
+    (the file is replaced by the first batch, so no handle outlives a
+    write). top_k=None keeps every row. With a MemoryBudget, kept rows move
+    to the budget's spool once it is used up. A sink is called with
+    (name, row) for every row as it is added.
+    """
+
+    def __init__(self, name: str, top_k: Optional[int] = DEFAULT_TOP_K, spill_path: Optional[str] = None,
+                 budget: Optional[MemoryBudget] = None, sink: Optional[Callable[[str, Dict], None]] = None):
+        self.name = name
+        self.sink = sink
+        self.top_k = top_k
+        self.count = 0
+        self.total = 0.0
+        self.spill_path = spill_path
+        self.budget = budget
+        self._heap: List[tuple] = []
+        self._spill: List[str] = []
+        self._spilled = False
+        self._spool_id = None
+
+    def add(self, row, severity: float, amount: float = 0.0):
+        if severity is None:
+            severity = float('-inf')
+        self.count += 1
+        self.total += amount or 0.0
+        if self.sink is not None:
+            self.sink(self.name, row)
+        if self.spill_path:
+            self._spill.append(json.dumps(row, default=_json_default) + "\n")
+            if len(self._spill) >= SPILL_BATCH_ROWS:
+                self._flush_spill()
+        if self._spool_id is not None:
+            self.budget.write(self._spool_id, [(severity, self.count, json.dumps(row, default=_json_default))])
+            return
+        size = 0
+        if self.budget is not None:
+            size = len(json.dumps(row, default=_json_default)) * MEMORY_ESTIMATE_FACTOR
+        # Ties keep the earlier row: -count sorts later rows first for eviction
+        item = (severity, -self.count, size, row)
+        if self.top_k is None or len(self._heap) < self.top_k:
+            if size and not self.budget.reserve(size):
+                self._move_to_spool(item)
+                return
+            heapq.heappush(self._heap, item)
+        elif item > self._heap[0]:
+            if size and not self.budget.reserve(size - self._heap[0][2]):
+                self._move_to_spool(item)
+                return
+            heapq.heapreplace(self._heap, item)
+
+    def _move_to_spool(self, item: tuple):
+        """Budget exhausted: hand every kept row (and all later ones) to the spool"""
+        self._spool_id = self.budget.new_spool_id()
+        self.budget.write(self._spool_id, [
+            (severity, -neg_count, json.dumps(row, default=_json_default))
+            for severity, neg_count, _, row in self._heap + [item]
+        ])
+        self.budget.release(sum(kept[2] for kept in self._heap))
+        self._heap = []
+        logger.info(f"Memory budget reached: {self.name} rows now spool to {self.budget.spool_path}")
+
+    def _flush_spill(self):
+        """Write pending spill rows, replacing the file on the first write of this tracker"""
+        directory = os.path.dirname(self.spill_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.spill_path, 'a' if self._spilled else 'w') as f:
+            f.writelines(self._spill)
+        self._spill.clear()
+        self._spilled = True
+
+    def rows(self):
+        """Kept rows, most severe first (a SpooledRows stream once spooled)"""
+        if self.spill_path and (self._spill or not self._spilled):
+            self._flush_spill()
+        if self._spool_id is not None:
+            self.budget.finish(self._spool_id)
+            kept = self.count if self.top_k is None else min(self.count, self.top_k)
+            return SpooledRows(self.budget, self._spool_id, kept, self.top_k)
+        return [row for _, _, _, row in sorted(self._heap, key=lambda item: item[:2], reverse=True)]
+
+    def summary(self) -> Dict:
+        kept = len(self._heap)
+        if self._spool_id is not None:
+            kept = self.count if self.top_k is None else min(self.count, self.top_k)
+        return {"count": self.count, "sum": self.total, "kept": kept, "spill_file": self.spill_path,
+                "spooled": self._spool_id is not None}
+
+# Ledger entries with the same user, currency, amount and reference_id this close together are duplicates
+DUPLICATE_WINDOW_SECONDS = 60.0
+DUPLICATE_EPOCH = datetime(1970, 1, 1)
+
+class DuplicateLedgerDetector:
+    """One-pass duplicate detection over ledger rows streamed in (user_id, created_at) order
+
+    created_at is parsed per row into seconds; naive ISO 8601 timestamps
+    with either a space or a 'T' separator are accepted (stream the two
+    shapes separately and combine them with sort_key, since their text
+    does not interleave in time order). Anything else, e.g. a zone offset,
+    is counted in `rejected` and skipped. Only the current user's rows from
+    the last window are held, in a deque plus a hash map from fingerprint
+    (currency, amount, reference_id) to its open cluster, so memory is
+    bounded by the window, not the ledger. A cluster is every entry
+    chained within the window of the previous one; it is emitted once it
+    can no longer grow.
+    """
+
+    def __init__(self, window_seconds: float = DUPLICATE_WINDOW_SECONDS):
+        self.window = window_seconds
+        self.rejected = 0
+        self._user = None
+        self._recent = deque()
+        self._open: Dict[tuple, Dict] = {}
+
+    @staticmethod
+    def timestamp(value) -> Optional[float]:
+        """Seconds since the epoch for a naive ISO 8601 timestamp (None if not one)"""
+        try:
+            parsed = datetime.fromisoformat(str(value))
+        except ValueError:
+            return None
+        if parsed.tzinfo is not None:
+            return None
+        return (parsed - DUPLICATE_EPOCH).total_seconds()
+
+    @staticmethod
+    def sort_key(row: Dict) -> tuple:
+        """Stream order of a row: created_at with a 'T' separator read as a space"""
+        return row['user_id'], str(row['created_at']).replace('T', ' ', 1)
+
+    def feed(self, row: Dict) -> List[Dict]:
+        """Add one row; returns clusters (two or more entries) closed by it"""
+        ts = self.timestamp(row['created_at'])
+        if ts is None:
+            self.rejected += 1
+            return []
+        closed = []
+        if row['user_id'] != self._user:
+            closed = self.finish()
+            self._user = row['user_id']
+        horizon = ts - self.window
+        while self._recent and self._recent[0][0] < horizon:
+            _, fingerprint = self._recent.popleft()
+            cluster = self._open.get(fingerprint)
+            if cluster is not None and cluster["last_ts"] < horizon:
+                del self._open[fingerprint]
+                if cluster["count"] > 1:
+                    closed.append(self._emit(cluster))
+        
+        fingerprint = (row['currency'], row['amount'], row['reference_id'])
+        cluster = self._open.get(fingerprint)
+        if cluster is None:
+            self._open[fingerprint] = {
+                "user_id": row['user_id'],
+                "currency": row['currency'],
+                "amount": row['amount'],
+                "reference_id": row['reference_id'],
+                "entry_ids": [row['id']],
+                "count": 1,
+                "first_at": row['created_at'],
+                "last_at": row['created_at'],
+                "last_ts": ts
+            }
+        else:
+            cluster["entry_ids"].append(row['id'])
+            cluster["count"] += 1
+            cluster["last_at"] = row['created_at']
+            cluster["last_ts"] = ts
+        self._recent.append((ts, fingerprint))
+        return closed
+
+    def finish(self) -> List[Dict]:
+        """Close every open cluster (end of input or of the current user)"""
+        closed = [self._emit(cluster) for cluster in self._open.values() if cluster["count"] > 1]
+        self._open.clear()
+        self._recent.clear()
+        return closed
+
+    @staticmethod
+    def _emit(cluster: Dict) -> Dict:
+        cluster = dict(cluster)
+        del cluster["last_ts"]
+        return cluster
+
+class LiquidationIndex:
+    """Per-symbol sorted liquidation prices, split by side, for tick-by-tick crossing queries
+
+    A long is liquidated once the price falls to its liquidation price and a
+    short once the price rises to it, so the crossed set for a new price is a
+    suffix of the long book and a prefix of the short book: two bisections.
+    """
+
+    def __init__(self):
+        self._books: Dict[Tuple[str, bool], Tuple[List[float], List]] = {}
+        self._positions: Dict = {}
+        self._marks: Dict[str, Tuple] = {}
+
+    def __len__(self) -> int:
+        return len(self._positions)
+
+    def __contains__(self, key) -> bool:
+        return key in self._positions
+
+    def get(self, key) -> Optional[Position]:
+        return self._positions.get(key)
+
+    def keys(self) -> List:
+        return list(self._positions)
+
+    def marks(self) -> Dict[str, float]:
+        """Mark price per symbol, taken from its highest-keyed position seen"""
+        return {symbol: mark for symbol, (key, mark) in self._marks.items()}
+
+    def upsert(self, position: Position):
+        """Insert a position or move it to its new liquidation price"""
+        latest = self._marks.get(position.symbol)
+        if latest is None or position.key is None or latest[0] is None or position.key >= latest[0]:
+            self._marks[position.symbol] = (position.key, position.mark_price)
+        if position.key in self._positions:
+            if self._positions[position.key] == position:
+                return
+            self.remove(position.key)
+        self._positions[position.key] = position
+        if position.liquidation_price != position.liquidation_price:  # NaN: never liquidates
+            return
+        prices, keys = self._books.setdefault((position.symbol, position.is_long), ([], []))
+        i = bisect.bisect_right(prices, position.liquidation_price)
+        prices.insert(i, position.liquidation_price)
+        keys.insert(i, position.key)
+
+    def remove(self, key):
+        """Drop a closed or deleted position; unknown keys are ignored"""
+        position = self._positions.pop(key, None)
+        if position is None or position.liquidation_price != position.liquidation_price:
+            return
+        prices, keys = self._books[(position.symbol, position.is_long)]
+        lo = bisect.bisect_left(prices, position.liquidation_price)
+        hi = bisect.bisect_right(prices, position.liquidation_price)
+        i = keys.index(key, lo, hi)
+        del prices[i]
+        del keys[i]
+
+    def crossed(self, symbol: str, price: float, up_price: Optional[float] = None) -> List[Position]:
+        """Positions liquidated by a move to price (longs) / up_price (shorts, defaults to price)"""
+        up_price = price if up_price is None else up_price
+        crossed = []
+        prices, keys = self._books.get((symbol, True), ([], []))
+        crossed.extend(keys[bisect.bisect_left(prices, price):])
+        prices, keys = self._books.get((symbol, False), ([], []))
+        crossed.extend(keys[:bisect.bisect_right(prices, up_price)])
+        return [self._positions[key] for key in crossed]
+
+
+# One row per position, shaped for RiskEngine.evaluate()
+RISK_POSITIONS_QUERY = """
+    SELECT rowid,
+           user_id,
+           symbol,
+           CASE WHEN side IN ('buy', 'long') THEN 1 ELSE -1 END AS direction,
+           quantity,
+           entry_price,
+           COALESCE(current_price, entry_price) AS mark_price,
+           margin
+    FROM positions
+"""
+
+# One row per user in user_risk_summary; {where} restricts the users recomputed
+USER_RISK_SUMMARY_SQL = """
+    INSERT INTO user_risk_summary
+        (user_id, positions, total_notional, net_notional, total_margin, max_leverage, net_pnl, updated_at)
+    SELECT user_id,
+           COUNT(*),
+           SUM(quantity * COALESCE(current_price, entry_price)),
+           SUM(CASE WHEN side IN ('buy', 'long') THEN 1 ELSE -1 END * quantity * COALESCE(current_price, entry_price)),
+           SUM(margin),
+           MAX(CASE WHEN margin > 0 THEN quantity * COALESCE(current_price, entry_price) / margin END),
+           SUM(CASE WHEN side IN ('buy', 'long') THEN 1 ELSE -1 END * quantity *
+               (COALESCE(current_price, entry_price) - entry_price)),
+           datetime('now')
+    FROM positions
+    WHERE user_id IS NOT NULL{where}
+    GROUP BY user_id
+"""
+RISK_SUMMARY_CONSUMER = "risk_summary"
+
+def _user_filter(user_id: Optional[str], alias: str = "") -> Tuple[str, tuple]:
+    """SQL suffix and parameters restricting a check to one user (nothing when user_id is None)"""
+    if user_id is None:
+        return "", ()
+    column = f"{alias}.user_id" if alias else "user_id"
+    return f" AND {column} = ?", (user_id,)
+
+# Indexes installed by install-indexes: per-user checks (diagnose --user) and ledger lookups
+REPAIR_INDEXES = {
+    "idx_repair_orders_user": ("orders", "user_id, status"),
+    "idx_repair_positions_user": ("positions", "user_id"),
+    "idx_repair_wallet_transactions_user": ("wallet_transactions", "user_id, created_at"),
+    "idx_repair_wallet_balances_user": ("wallet_balances", "user_id"),
+    # Per-account ledger replay after a checkpoint: (user_id, currency) then rowid
+    "idx_repair_wallet_transactions_account": ("wallet_transactions", "user_id, currency"),
+    # Double-entry grouping: GROUP BY reference_id, currency in index order
+    "idx_repair_wallet_transactions_reference": ("wallet_transactions", "reference_id, currency"),
+}
+USER_CACHE_SIZE = 256
+
+# A ledger checkpoint is stored every this many entries per (user_id, currency) account
+LEDGER_CHECKPOINT_INTERVAL = 1000
+# Wallet and ledger balances closer than this are considered equal
+RECONCILE_TOLERANCE = 1e-8
+
+# External fill/settlement reconciliation: file keys held in the hash table before
+# spilling sorted runs for a merge join (or max_memory / RECONCILE_KEY_BYTES)
+RECONCILE_HASH_KEYS = 1_000_000
+RECONCILE_KEY_BYTES = 200
+
+# File layout -> database side. The key columns must appear in the file header.
+# Each query yields key columns, row count, amount and whether the row falls in
+# the file's time window (the two ? parameters, NULL when the file has none).
+# File keys are strings, so the merge join reads the table in the text order
+# of its keys (CAST ... AS TEXT); INTEGER ids would otherwise sort 2 before 10.
+_IN_WINDOW = "COALESCE({column} BETWEEN julianday(?) AND julianday(?), 1)"
+RECONCILE_SOURCES = {
+    "orders": {
+        "key": ("order_id",),
+        "query": "SELECT id, 1, amount, " + _IN_WINDOW.format(column="julianday(created_at)") +
+                 " FROM orders",
+        "order_by": " ORDER BY CAST(id AS TEXT)"
+    },
+    "wallet_transactions": {
+        "key": ("reference_id", "currency"),
+        "query": "SELECT reference_id, currency, COUNT(*), SUM(amount), " +
+                 _IN_WINDOW.format(column="MAX(julianday(created_at))") +
+                 " FROM wallet_transactions WHERE reference_id IS NOT NULL AND currency IS NOT NULL"
+                 " GROUP BY reference_id, currency",
+        "order_by": " ORDER BY CAST(reference_id AS TEXT), CAST(currency AS TEXT)"
+    }
+}
+RECONCILE_TIME_COLUMNS = ("timestamp", "created_at")
+
+# Diagnosis metrics history: raw points are rolled into hourly buckets after
+# METRICS_RAW_RETENTION seconds, hourly into daily after METRICS_HOURLY_RETENTION
+METRICS_RAW_RETENTION = 2 * 86400
+METRICS_HOURLY_RETENTION = 90 * 86400
+METRICS_MERGE_SQL = """samples = samples + excluded.samples, total = total + excluded.total,
+    minimum = MIN(minimum, excluded.minimum), maximum = MAX(maximum, excluded.maximum)"""
+
+# Ledger entries older than this many whole months are moved to per-month archive files
+ARCHIVE_AFTER_MONTHS = 3
+# Only settled entries are archived: their order or wallet request has left these
+# states, and no other ledger entry (a reversal, an adjustment) references them
+ARCHIVE_OPEN_STATUSES = ("open", "pending", "processing", "partially_filled")
+ARCHIVE_SETTLED_SQL = f"""(
+    EXISTS (SELECT 1 FROM main.orders o WHERE o.id = wallet_transactions.reference_id
+            AND COALESCE(o.status, 'open') NOT IN {ARCHIVE_OPEN_STATUSES!r})
+    OR EXISTS (SELECT 1 FROM main.wallet_requests r WHERE r.id = wallet_transactions.reference_id
+               AND COALESCE(r.status, 'pending') NOT IN {ARCHIVE_OPEN_STATUSES!r})
+) AND NOT EXISTS (
+    SELECT 1 FROM main.wallet_transactions later WHERE later.reference_id = wallet_transactions.id
+)"""
+
+# Ledger entry types whose legs must balance per (reference_id, currency)
+TRANSFER_TYPES = ("transfer", "internal_transfer")
+TRADE_TYPES = ("trade",)
+FEE_TYPES = ("fee", "trading_fee")
+def _in_list(values: Tuple[str, ...]) -> str:
+    return ", ".join(f"'{value}'" for value in values)
+
+# One row per unbalanced group. Fees are charged on top of a trade's legs, so for trades the
+# non-fee legs must net to zero; for transfers every leg counts.
+UNBALANCED_GROUPS_SQL = f"""
+    SELECT reference_id, currency, COUNT(*) AS legs, COUNT(DISTINCT user_id) AS users,
+           CASE WHEN MAX(type IN ({_in_list(TRANSFER_TYPES)})) = 1 THEN 'transfer' ELSE 'trade' END AS kind,
+           SUM(amount) AS net,
+           SUM(CASE WHEN type IN ({_in_list(FEE_TYPES)}) THEN amount ELSE 0 END) AS fees,
+           CASE WHEN MAX(type IN ({_in_list(TRANSFER_TYPES)})) = 1 THEN SUM(amount)
+                ELSE SUM(CASE WHEN type IN ({_in_list(FEE_TYPES)}) THEN 0 ELSE amount END) END AS imbalance
+    FROM wallet_transactions
+    WHERE reference_id IS NOT NULL
+      AND type IN ({_in_list(TRANSFER_TYPES + TRADE_TYPES + FEE_TYPES)}){{where}}
+    GROUP BY reference_id, currency
+    HAVING MAX(type IN ({_in_list(TRANSFER_TYPES + TRADE_TYPES)})) = 1
+       AND ABS(imbalance) > {RECONCILE_TOLERANCE}
+"""
+
+class RiskEngine:
+    """Vectorized notional exposure and price-shock analysis over all positions
+
+    Positions are rows of (key, user_id, symbol, direction, quantity,
+    entry_price, mark_price, margin) with direction +1 for longs and -1 for
+    shorts.  A position is liquidated under a shock when its equity
+    (margin + PnL at the shocked price) falls to the maintenance margin.
+    """
+
+    def __init__(self, shocks: Tuple[float, ...] = DEFAULT_SHOCKS,
+                 maintenance_margin_rate: float = MAINTENANCE_MARGIN_RATE,
+                 leverage_threshold: float = HIGH_LEVERAGE_THRESHOLD):
+        self.shocks = tuple(shocks)
+        self.maintenance_margin_rate = maintenance_margin_rate
+        self.leverage_threshold = leverage_threshold
+
+    def evaluate(self, rows: List[tuple], per_user: bool = True) -> Dict:
+        """Compute exposures and scenario results for the given position rows
+
+        With per_user=False net_exposure_by_user and high_leverage are left
+        empty, for callers that read them from user_risk_summary.
+        """
+        if np is not None and rows:
+            return self._evaluate_numpy(rows, per_user)
+        return self._evaluate_python(rows, per_user)
+
+    def _empty_result(self) -> Dict:
+        return {
+            "total_exposure": 0.0,
+            "exposure_by_symbol": {},
+            "net_exposure_by_user": {},
+            "house_net_exposure": 0.0,
+            "scenarios": [],
+            "high_leverage": {},
+            "under_collateralized": {}
+        }
+
+    def _evaluate_numpy(self, rows: List[tuple], per_user: bool = True) -> Dict:
+        keys, users, symbols, direction, quantity, entry, mark, margin = zip(*rows)
+        direction = np.asarray(direction, dtype=np.float64)
+        quantity = np.asarray(quantity, dtype=np.float64)
+        entry = np.asarray(entry, dtype=np.float64)
+        mark = np.asarray(mark, dtype=np.float64)
+        margin = np.asarray(margin, dtype=np.float64)
+        keys = np.asarray(keys)
+
+        notional = quantity * mark
+        signed = direction * notional
+        is_long = direction > 0
+
+        result = self._empty_result()
+        result["total_exposure"] = float(notional.sum())
+
+        symbol_names, symbol_idx = self._factorize(symbols)
+        n_symbols = len(symbol_names)
+        long_by_symbol = np.bincount(symbol_idx, weights=np.where(is_long, notional, 0.0), minlength=n_symbols)
+        short_by_symbol = np.bincount(symbol_idx, weights=np.where(is_long, 0.0, notional), minlength=n_symbols)
+        count_by_symbol = np.bincount(symbol_idx, minlength=n_symbols)
+        for i, symbol in enumerate(symbol_names):
+            result["exposure_by_symbol"][symbol] = {
+                "long_notional": float(long_by_symbol[i]),
+                "short_notional": float(short_by_symbol[i]),
+                "net_notional": float(long_by_symbol[i] - short_by_symbol[i]),
+                "gross_notional": float(long_by_symbol[i] + short_by_symbol[i]),
+                "positions": int(count_by_symbol[i])
+            }
+
+        if per_user:
+            user_names, user_idx = self._factorize(users)
+            net_by_user = np.bincount(user_idx, weights=signed, minlength=len(user_names))
+            result["net_exposure_by_user"] = dict(zip(user_names, net_by_user.tolist()))
+        result["house_net_exposure"] = -float(signed.sum())
+
+        # Leverage is only defined for positive margin; margin <= 0 is under-collateralized
+        has_margin = margin > 0
+        if per_user:
+            leverage = np.divide(notional, margin, out=np.zeros_like(notional), where=has_margin)
+            high = has_margin & (leverage > self.leverage_threshold)
+            result["high_leverage"] = dict(zip(keys[high].tolist(), leverage[high].tolist()))
+
+        mmr = self.maintenance_margin_rate
+        equity_now = margin + direction * quantity * (mark - entry)
+        under = ~has_margin | (equity_now <= mmr * notional)
+        buffer = equity_now - mmr * notional
+        result["under_collateralized"] = dict(zip(keys[under].tolist(), buffer[under].tolist()))
+
+        # Equity under a shock s is linear in s, so every position has a critical
+        # shock beyond which it is liquidated (and another beyond which it is
+        # bankrupt).  Sorting those once answers the whole grid with binary
+        # searches and prefix sums instead of an n x len(shocks) matrix.
+        shocks = np.asarray(self.shocks, dtype=np.float64)
+        liquidated, (liquidated_base,) = self._crossing_sums(
+            equity_now - mmr * notional, signed - mmr * notional, shocks, notional)
+        _, (bankrupt_const, bankrupt_slope) = self._crossing_sums(
+            equity_now, signed, shocks, equity_now, signed)
+        liquidated_notional = liquidated_base * (1.0 + shocks)
+        bad_debt = -(bankrupt_const + bankrupt_slope * shocks)
+        long_notional = float(notional[is_long].sum())
+        short_notional = float(notional[~is_long].sum())
+        user_losses = np.where(shocks < 0, -shocks * long_notional, shocks * short_notional)
+
+        net_total = float(signed.sum())
+        for i, shock in enumerate(self.shocks):
+            result["scenarios"].append({
+                "shock": shock,
+                "user_pnl": net_total * shock,
+                "house_pnl": -net_total * shock,
+                "user_losses": float(user_losses[i]),
+                "positions_liquidated": int(liquidated[i]),
+                "liquidated_notional": float(liquidated_notional[i]),
+                "bad_debt": float(bad_debt[i])
+            })
+        return result
+
+    @staticmethod
+    def _factorize(values: tuple) -> Tuple[List, "np.ndarray"]:
+        """Map labels to dense integer codes (hash based; avoids sorting object arrays)"""
+        codes = {}
+        idx = np.fromiter((codes.setdefault(v, len(codes)) for v in values), dtype=np.int64, count=len(values))
+        return list(codes), idx
+
+    @staticmethod
+    def _crossing_sums(const, slope, shocks, *weights):
+        """Count rows, and sum each weight array, where const + slope * s <= 0 for every shock s"""
+        counts = np.zeros(len(shocks), dtype=np.int64)
+        sums = [np.zeros(len(shocks)) for _ in weights]
+
+        always = (slope == 0) & (const <= 0)
+        counts += int(always.sum())
+        for total, weight in zip(sums, weights):
+            total += float(weight[always].sum())
+
+        # slope > 0: crossed when s <= -const/slope; slope < 0: when s >= -const/slope
+        for mask, below in ((slope > 0, True), (slope < 0, False)):
+            if not mask.any():
+                continue
+            critical = -const[mask] / slope[mask]
+            order = np.argsort(critical, kind="stable")
+            critical = critical[order]
+            if below:
+                idx = np.searchsorted(critical, shocks, side="left")
+                counts += len(critical) - idx
+            else:
+                idx = np.searchsorted(critical, shocks, side="right")
+                counts += idx
+            for total, weight in zip(sums, weights):
+                prefix = np.concatenate(([0.0], np.cumsum(weight[mask][order])))
+                total += prefix[-1] - prefix[idx] if below else prefix[idx]
+        return counts, sums
+
+    def _evaluate_python(self, rows: List[tuple], per_user: bool = True) -> Dict:
+        result = self._empty_result()
+        mmr = self.maintenance_margin_rate
+        scenarios = [{
+            "shock": shock,
+            "user_pnl": 0.0,
+            "house_pnl": 0.0,
+            "user_losses": 0.0,
+            "positions_liquidated": 0,
+            "liquidated_notional": 0.0,
+            "bad_debt": 0.0
+        } for shock in self.shocks]
+        net_total = 0.0
+
+        for key, user_id, symbol, direction, quantity, entry, mark, margin in rows:
+            notional = quantity * mark
+            signed = direction * notional
+            net_total += signed
+            result["total_exposure"] += notional
+
+            exposure = result["exposure_by_symbol"].setdefault(symbol, {
+                "long_notional": 0.0,
+                "short_notional": 0.0,
+                "net_notional": 0.0,
+                "gross_notional": 0.0,
+                "positions": 0
+            })
+            exposure["long_notional" if direction > 0 else "short_notional"] += notional
+            exposure["net_notional"] += signed
+            exposure["gross_notional"] += notional
+            exposure["positions"] += 1
+            if per_user:
+                result["net_exposure_by_user"][user_id] = result["net_exposure_by_user"].get(user_id, 0.0) + signed
+                if margin > 0 and notional / margin > self.leverage_threshold:
+                    result["high_leverage"][key] = notional / margin
+            buffer = margin + direction * quantity * (mark - entry) - mmr * notional
+            if margin <= 0 or buffer <= 0:
+                result["under_collateralized"][key] = buffer
+
+            for scenario in scenarios:
+                price = mark * (1 + scenario["shock"])
+                scenario["user_losses"] += max(-direction * quantity * (price - mark), 0.0)
+                equity = margin + direction * quantity * (price - entry)
+                if equity <= mmr * quantity * price:
+                    scenario["positions_liquidated"] += 1
+                    scenario["liquidated_notional"] += quantity * price
+                    scenario["bad_debt"] += max(-equity, 0.0)
+
+        for scenario in scenarios:
+            scenario["user_pnl"] = net_total * scenario["shock"]
+            scenario["house_pnl"] = -net_total * scenario["shock"]
+        result["house_net_exposure"] = -net_total
+        result["scenarios"] = scenarios
+        return result
+
+# Correct PnL for a positions row, mirroring TradingSystemRepair._calculate_pnl
+PNL_SQL = """(CASE WHEN side = 'buy' THEN current_price - entry_price
+                   ELSE entry_price - current_price END) * quantity / entry_price"""
+
+# A ledger entry whose reference is neither an order nor a wallet request. Two
+# correlated primary-key probes, so the check costs one lookup per entry instead
+# of materialising every order and request id for each statement (or block)
+ORPHANED_REFERENCE_SQL = """NOT EXISTS (SELECT 1 FROM orders o WHERE o.id = wallet_transactions.reference_id)
+    AND NOT EXISTS (SELECT 1 FROM wallet_requests r WHERE r.id = wallet_transactions.reference_id)"""
+
+# Funds an open order holds frozen: the quote currency (amount * price) for a buy,
+# the base currency (amount) for a sell. Symbols are BASE + QUOTE, e.g. BTCUSDT.
+QUOTE_CURRENCIES = ("USDT", "USDC", "BUSD", "USD", "BTC", "ETH")
+_SYMBOL_QUOTE_SQL = "CASE " + " ".join(
+    f"WHEN symbol LIKE '%{quote}' AND length(symbol) > {len(quote)} THEN '{quote}'" for quote in QUOTE_CURRENCIES
+) + " END"
+_SYMBOL_BASE_SQL = f"RTRIM(substr(symbol, 1, length(symbol) - length({_SYMBOL_QUOTE_SQL})), '/-_')"
+ORDER_LOCKED_CURRENCY_SQL = f"""CASE side
+    WHEN 'buy' THEN {_SYMBOL_QUOTE_SQL}
+    ELSE {_SYMBOL_BASE_SQL}
+END"""
+ORDER_LOCKED_AMOUNT_SQL = "CASE side WHEN 'buy' THEN amount * COALESCE(price, 0) ELSE amount END"
+
+# Fixed-point money: amounts are compared as integers in minor units of their
+# currency (position margin: the symbol's quote currency; PnL, which PNL_SQL
+# expresses as quantity times return, the base currency), rounded half away
+# from zero like SQLite's ROUND, so float noise below half a unit never offends
+CURRENCY_DECIMALS = {"USD": 2, "USDT": 2, "USDC": 2, "BUSD": 2, "BTC": 8, "ETH": 8}
+DEFAULT_CURRENCY_DECIMALS = 8
+# Stored PnL may differ from the recomputed one by this many minor units
+# (a value sitting on a rounding boundary) without being reported or rewritten
+PNL_TOLERANCE_UNITS = 1
+
+def symbol_quote(symbol: Optional[str]) -> Optional[str]:
+    """Quote currency of a BASE+QUOTE symbol such as BTCUSDT (None if unrecognised)"""
+    for quote in QUOTE_CURRENCIES:
+        if symbol and symbol.endswith(quote) and len(symbol) > len(quote):
+            return quote
+    return None
+
+def symbol_base(symbol: Optional[str]) -> Optional[str]:
+    """Base currency of a BASE+QUOTE symbol, separators stripped (None if unrecognised)"""
+    quote = symbol_quote(symbol)
+    return symbol[:-len(quote)].rstrip("/-_") if quote else None
+
+def to_minor(value: Optional[float], currency: Optional[str]) -> int:
+    """Amount as an integer number of the currency's minor units"""
+    if value is None:
+        return 0
+    scaled = value * 10 ** CURRENCY_DECIMALS.get(currency, DEFAULT_CURRENCY_DECIMALS)
+    units = int(math.floor(abs(scaled) + 0.5))
+    return units if scaled >= 0 else -units
+
+def _scale_sql(currency_sql: str) -> str:
+    cases = " ".join(f"WHEN '{currency}' THEN {10 ** decimals}" for currency, decimals in CURRENCY_DECIMALS.items())
+    return f"(CASE {currency_sql} {cases} ELSE {10 ** DEFAULT_CURRENCY_DECIMALS} END)"
+
+WALLET_SCALE_SQL = _scale_sql("currency")
+POSITION_SCALE_SQL = _scale_sql(_SYMBOL_QUOTE_SQL)
+PNL_SCALE_SQL = _scale_sql(_SYMBOL_BASE_SQL)
+
+def minor_sql(expression: str, scale_sql: str) -> str:
+    """SQL for to_minor(expression): SQLite ROUND also rounds half away from zero"""
+    return f"ROUND(({expression}) * {scale_sql})"
+
+def quote_identifier(name: str) -> str:
+    """A table or column name as a quoted SQL identifier"""
+    return '"' + name.replace('"', '""') + '"'
+
+# Before/after rows kept per table in a repair change set
+CHANGE_SAMPLE_ROWS = 3
+# Pages copied per online-backup step; writers can proceed between steps
+SNAPSHOT_PAGES_PER_STEP = 1024
+
+def _json_default(value):
+    """JSON fallback for values sqlite3 and the checks can produce"""
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Enum):
+        return value.value
+    if isinstance(value, (Position, WalletBalance, LedgerEntry)):
+        return asdict(value)
+    if isinstance(value, bytes):
+        return value.hex()
+    if isinstance(value, SpooledRows):
+        return list(value)
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def calculate_pnl(position: Dict) -> float:
+    """Calculate correct PnL for a positions row"""
+    if position['side'] == 'buy':  # LONG
+        return (position['current_price'] - position['entry_price']) * position['quantity'] / position['entry_price']
+    else:  # SHORT
+        return (position['entry_price'] - position['current_price']) * position['quantity'] / position['entry_price']
+
+def _wallet_payload(row: Dict) -> Dict:
+    return {k: row[k] for k in ("user_id", "currency", "balance", "frozen_balance")}
+
+def _rule_negative_balance(row: Dict):
+    currency = row['currency']
+    if to_minor(row['balance'], currency) < 0 or to_minor(row['frozen_balance'], currency) < 0:
+        shortfall = min(row['balance'], 0) + min(row['frozen_balance'], 0)
+        return _wallet_payload(row), -shortfall, shortfall
+    return None
+
+def _rule_locked_exceeds(row: Dict):
+    if to_minor(row['frozen_balance'], row['currency']) > to_minor(row['balance'], row['currency']):
+        excess = row['frozen_balance'] - row['balance']
+        return _wallet_payload(row), excess, excess
+    return None
+
+def _rule_negative_margin(row: Dict):
+    if to_minor(row['margin'], symbol_quote(row['symbol'])) < 0:
+        return row, -row['margin'], row['margin']
+    return None
+
+def _rule_incorrect_pnl(row: Dict):
+    calculated_pnl = calculate_pnl(row)
+    drift = calculated_pnl - row['unrealized_pnl']
+    base = symbol_base(row['symbol'])
+    if abs(to_minor(calculated_pnl, base) - to_minor(row['unrealized_pnl'], base)) > PNL_TOLERANCE_UNITS:
+        return {
+            "position": row,
+            "calculated_pnl": calculated_pnl,
+            "stored_pnl": row['unrealized_pnl']
+        }, abs(drift), drift
+    return None
+
+@dataclass
+class RowRule:
+    """A per-row invariant: SQL prefilter for candidate rows plus a Python evaluation
+
+    evaluate(row) returns (payload, severity, amount) for an offending row
+    and None otherwise. The same rules drive full scans and re-evaluation
+    of individual rows (dirty keys).
+    """
+    name: str
+    section: str
+    table: str
+    where: str
+    evaluate: Callable[[Dict], Optional[tuple]]
+
+ROW_RULES = (
+    RowRule("negative_balances", "wallet_status", "wallet_balances",
+            "balance < 0 OR frozen_balance < 0", _rule_negative_balance),
+    RowRule("locked_exceeds_available", "wallet_status", "wallet_balances",
+            "frozen_balance > balance", _rule_locked_exceeds),
+    RowRule("negative_margin", "position_status", "positions", "margin < 0", _rule_negative_margin),
+    RowRule("incorrect_pnl", "position_status", "positions", "1 = 1", _rule_incorrect_pnl),
+)
+
+def _rule_matched(row: Dict):
+    """For rules whose SQL condition is the whole test"""
+    amount = row.get('amount') or 0.0
+    return row, abs(amount), amount
+
+# Sampled triage also covers the row-level order and ledger rules
+SAMPLE_RULES = ROW_RULES + (
+    RowRule("stale_orders", "order_status", "orders",
+            "status = 'open' AND created_at < datetime('now', '-1 day')", _rule_matched),
+    RowRule("orphaned_entries", "ledger_integrity", "wallet_transactions", ORPHANED_REFERENCE_SQL, _rule_matched),
+)
+
+# diagnose --sample: rows per random rowid block, tables small enough to read in full,
+# and z for the 95% Wilson intervals
+SAMPLE_BLOCK_ROWS = 64
+SAMPLE_MIN_ROWS = 1000
+SAMPLE_Z = 1.96
+
+def parse_fraction(text: str) -> float:
+    """Parse a fraction such as 0.01 or 1%"""
+    text = text.strip()
+    value = float(text[:-1]) / 100 if text.endswith("%") else float(text)
+    if not 0 < value <= 1:
+        raise argparse.ArgumentTypeError(f"fraction must be in (0, 1]: {text}")
+    return value
+
+def wilson_interval(hits: int, n: int, z: float = SAMPLE_Z) -> Tuple[float, float]:
+    """Wilson score interval for a proportion observed as hits out of n"""
+    if n == 0:
+        return 0.0, 1.0
+    p = hits / n
+    denominator = 1 + z * z / n
+    centre = (p + z * z / (2 * n)) / denominator
+    half = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / denominator
+    return max(0.0, centre - half), min(1.0, centre + half)
+
+def rules_for(table: str) -> Tuple[RowRule, ...]:
+    return tuple(rule for rule in ROW_RULES if rule.table == table)
+
+def _rules_where(rules: Tuple[RowRule, ...]) -> str:
+    return " OR ".join(f"({rule.where})" for rule in rules)
+
+DIRTY_KEY_TABLES = ("wallet_balances", "orders", "positions")
+
+class DirtyKeyQueue:
+    """Reader side of repair_dirty_keys, filled by the triggers install_change_tracking adds
+
+    Each consumer keeps its own cursor (last seq processed) in repair_state;
+    entries every consumer has passed are pruned.
+    """
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def installed(self) -> bool:
+        return bool(self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'repair_dirty_keys'"
+        ).fetchone())
+
+    def head(self) -> int:
+        return self.conn.execute("SELECT COALESCE(MAX(seq), 0) FROM repair_dirty_keys").fetchone()[0]
+
+    def cursor(self, consumer: str) -> Optional[int]:
+        value = _state_get(self.conn, f"dirty_cursor:{consumer}")
+        return int(value) if value is not None else None
+
+    def pending(self, consumer: str, upto: int) -> Dict[str, Dict[str, set]]:
+        """Changed row keys and user ids per table in (cursor, upto]"""
+        changes = {table: {"keys": set(), "users": set()} for table in DIRTY_KEY_TABLES}
+        for table, row_key, user_id in self.conn.execute(
+            "SELECT table_name, row_key, user_id FROM repair_dirty_keys WHERE seq > ? AND seq <= ?",
+            (self.cursor(consumer) or 0, upto)
+        ):
+            changes[table]["keys"].add(row_key)
+            changes[table]["users"].add(user_id)
+        return changes
+
+    def ack(self, consumer: str, upto: int):
+        _state_set(self.conn, f"dirty_cursor:{consumer}", str(upto))
+        self.conn.execute("""
+            DELETE FROM repair_dirty_keys WHERE seq <= (
+                SELECT MIN(CAST(value AS INTEGER)) FROM repair_state WHERE key LIKE 'dirty_cursor:%'
+            )
+        """)
+        self.conn.commit()
+
+# Tables read by each diagnosis check; a check is re-run only when one of them changed
+CHECK_TABLES = {
+    "wallet_status": ("wallet_balances",),
+    "order_status": ("orders", "wallet_balances"),
+    "position_status": ("positions",),
+    "ledger_integrity": ("wallet_transactions", "orders", "wallet_requests"),
+    "risk_assessment": ("positions",),
+    # Also keyed on the archive files themselves (see CheckCache.token)
+    "archive_status": ("repair_ledger_partitions", "orders", "wallet_requests")
+}
+# Checks that also depend on the clock (stale orders age out without any write)
+CHECK_TTL = {"order_status": 60}
+CHANGE_TRACKED_TABLES = ("wallet_balances", "orders", "positions", "wallet_transactions", "wallet_requests")
+
+AUDIT_GENESIS_HASH = "0" * 64
+
+def _state_get(conn: sqlite3.Connection, key: str) -> Optional[str]:
+    """Read a value from the tool's repair_state key/value table"""
+    try:
+        row = conn.execute("SELECT value FROM repair_state WHERE key = ?", (key,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row[0] if row else None
+
+def _state_set(conn: sqlite3.Connection, key: str, value: str):
+    """Write a value to repair_state (caller commits)"""
+    conn.execute("CREATE TABLE IF NOT EXISTS repair_state (key TEXT PRIMARY KEY, value TEXT)")
+    conn.execute("INSERT OR REPLACE INTO repair_state (key, value) VALUES (?, ?)", (key, value))
+
+class AuditLog:
+    """Buffered, hash-chained writer for the audit_log table
+
+    Entries are buffered and written with executemany when the buffer fills
+    or the repair transaction commits. Each entry stores the SHA-256 of the
+    previous entry's hash plus its own fields, so editing, deleting or
+    reordering any entry breaks the chain from that point on.
+    """
+
+    def __init__(self, conn: sqlite3.Connection, batch_size: int = 500):
+        self.conn = conn
+        self.batch_size = batch_size
+        self._buffer: List[tuple] = []
+        self._ready = False
+
+    @staticmethod
+    def entry_hash(prev_hash: str, user_id, action, details, timestamp, run_id) -> str:
+        payload = json.dumps([user_id, action, details, timestamp, run_id], separators=(',', ':'))
+        return hashlib.sha256((prev_hash + payload).encode('utf-8')).hexdigest()
+
+    def _ensure_table(self):
+        """Create audit_log once, adding the chain columns to a pre-existing table"""
+        if self._ready:
+            return
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS audit_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT,
+                action TEXT,
+                details TEXT,
+                timestamp DATETIME,
+                run_id TEXT,
+                prev_hash TEXT,
+                entry_hash TEXT
+            )
+        """)
+        columns = {row[1] for row in self.conn.execute("PRAGMA table_info(audit_log)")}
+        for column in ("run_id", "prev_hash", "entry_hash"):
+            if column not in columns:
+                self.conn.execute(f"ALTER TABLE audit_log ADD COLUMN {column} TEXT")
+        self._ready = True
+
+    def add(self, user_id: str, action: str, details: str, run_id: Optional[str] = None):
+        timestamp = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S.%f')
+        self._buffer.append((user_id, action, details, timestamp, run_id))
+        if len(self._buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> int:
+        """Write buffered entries (inside the caller's transaction)
+
+        The chain tail is re-read under the write lock on every flush, since
+        other processes append to the same chain; outside a transaction one
+        is opened with BEGIN IMMEDIATE for the caller to commit.
+        """
+        if not self._buffer:
+            return 0
+        self._ensure_table()
+        if not self.conn.in_transaction:
+            self.conn.execute("BEGIN IMMEDIATE")
+        row = self.conn.execute(
+            "SELECT entry_hash FROM audit_log WHERE entry_hash IS NOT NULL ORDER BY id DESC LIMIT 1"
+        ).fetchone()
+        rows = []
+        prev_hash = row[0] if row else AUDIT_GENESIS_HASH
+        for user_id, action, details, timestamp, run_id in self._buffer:
+            entry_hash = self.entry_hash(prev_hash, user_id, action, details, timestamp, run_id)
+            rows.append((user_id, action, details, timestamp, run_id, prev_hash, entry_hash))
+            prev_hash = entry_hash
+        self.conn.executemany("""
+            INSERT INTO audit_log (user_id, action, details, timestamp, run_id, prev_hash, entry_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, rows)
+        self._buffer.clear()
+        return len(rows)
+
+    def discard(self):
+        """Forget buffered entries (and the table check) after a rollback"""
+        self._buffer.clear()
+        self._ready = False
+
+    def verify(self, full: bool = False) -> Dict:
+        """Check the chain from the last verified entry (or from the start with full)"""
+        result = {"verified": 0, "valid": True, "broken_at": None, "last_id": None}
+        self._ensure_table()
+        last_id, expected = 0, AUDIT_GENESIS_HASH
+        checkpoint = None if full else _state_get(self.conn, "audit_verified")
+        if checkpoint:
+            last_id, expected = json.loads(checkpoint)
+            # The verified tail must still be there, unchanged
+            row = self.conn.execute("SELECT entry_hash FROM audit_log WHERE id = ?", (last_id,)).fetchone()
+            if not row or row[0] != expected:
+                result.update(valid=False, broken_at=last_id)
+                return result
+
+        cursor = self.conn.execute("""
+            SELECT id, user_id, action, details, timestamp, run_id, prev_hash, entry_hash
+            FROM audit_log
+            WHERE id > ? AND entry_hash IS NOT NULL
+            ORDER BY id
+        """, (last_id,))
+        for entry_id, user_id, action, details, timestamp, run_id, prev_hash, entry_hash in cursor:
+            if prev_hash != expected or entry_hash != self.entry_hash(
+                    prev_hash, user_id, action, details, timestamp, run_id):
+                result.update(valid=False, broken_at=entry_id)
+                break
+            last_id, expected = entry_id, entry_hash
+            result["verified"] += 1
+
+        result["last_id"] = last_id
+        if result["valid"]:
+            _state_set(self.conn, "audit_verified", json.dumps([last_id, expected]))
+            self.conn.commit()
+        return result
+
+class CheckCache:
+    """Per-check result cache keyed on cheap change tokens
+
+    A table's token is its trigger-maintained counter from
+    repair_change_counters when change tracking is installed, otherwise the
+    database-wide (PRAGMA data_version, connection total_changes) pair.
+    Archive checks also carry the partition summaries and file stats.
+    Counter and archive tokens survive restarts, so results keyed only on
+    them are also persisted to repair_check_cache for the next process (cron runs).
+    """
+
+    def __init__(self, conn: sqlite3.Connection, variant=None):
+        self.conn = conn
+        # Settings that change a check's output (e.g. top-K) are part of every token
+        self.variant = json.dumps(variant)
+        self.hits = 0
+        self.misses = 0
+        self._entries: Dict[str, Tuple[tuple, float, Dict]] = {}
+        self._own_changes = 0
+
+    def _counters(self, tables: Tuple[str, ...]) -> Dict[str, int]:
+        exists = self.conn.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'repair_change_counters'"
+        ).fetchone()
+        if not exists:
+            return {}
+        placeholders = ",".join("?" * len(tables))
+        rows = self.conn.execute(
+            f"SELECT table_name, version FROM repair_change_counters WHERE table_name IN ({placeholders})",
+            tables
+        ).fetchall()
+        return {row[0]: row[1] for row in rows}
+
+    def token(self, tables: Tuple[str, ...]) -> tuple:
+        """Change token covering every table in tables"""
+        archives = ()
+        if "repair_ledger_partitions" in tables:
+            # The partition summaries and their files are fingerprinted directly
+            archives = (("archives", self._archive_files()),)
+            tables = tuple(table for table in tables if table != "repair_ledger_partitions")
+        counters = self._counters(tables)
+        if all(table in counters for table in tables):
+            return tuple(("counter", table, counters[table]) for table in tables) + archives + \
+                (("variant", self.variant),)
+        data_version = self.conn.execute("PRAGMA data_version").fetchone()[0]
+        # Our own cache writes must not invalidate the checks they describe
+        return (("db", data_version, self.conn.total_changes - self._own_changes),) + archives + \
+            (("variant", self.variant),)
+
+    def _archive_files(self) -> tuple:
+        """Recorded summary plus current (size, mtime_ns) of every ledger archive file"""
+        try:
+            partitions = self.conn.execute(
+                "SELECT partition, path, entries, hash, file_size, file_mtime_ns FROM repair_ledger_partitions "
+                "ORDER BY partition"
+            ).fetchall()
+        except sqlite3.OperationalError:
+            return ()
+        files = []
+        for row in partitions:
+            try:
+                stat = os.stat(row[1])
+                files.append(tuple(row) + (stat.st_size, stat.st_mtime_ns))
+            except OSError:
+                files.append(tuple(row) + (None, None))
+        return tuple(files)
+
+    @staticmethod
+    def _durable(token: tuple) -> bool:
+        return all(part[0] in ("counter", "archives", "variant") for part in token)
+
+    @contextmanager
+    def own_writes(self):
+        """Writes in this block are the tool's own bookkeeping and do not change the db token"""
+        before = self.conn.total_changes
+        try:
+            yield
+        finally:
+            self._own_changes += self.conn.total_changes - before
+
+    def get(self, name: str, token: tuple) -> Optional[Dict]:
+        ttl = CHECK_TTL.get(name)
+        entry = self._entries.get(name)
+        if entry and entry[0] == token and (ttl is None or time.time() - entry[1] < ttl):
+            self.hits += 1
+            return entry[2]
+        if self._durable(token):
+            row = self._load(name, token)
+            if row and (ttl is None or time.time() - row[0] < ttl):
+                result = json.loads(row[1])
+                self._entries[name] = (token, row[0], result)
+                self.hits += 1
+                return result
+        self.misses += 1
+        return None
+
+    def put(self, name: str, token: tuple, result: Dict):
+        now = time.time()
+        self._entries[name] = (token, now, result)
+        if self._durable(token):
+            before = self.conn.total_changes
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS repair_check_cache (
+                    check_name TEXT PRIMARY KEY,
+                    token TEXT NOT NULL,
+                    computed_at REAL NOT NULL,
+                    result TEXT NOT NULL
+                )
+            """)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO repair_check_cache (check_name, token, computed_at, result) VALUES (?, ?, ?, ?)",
+                (name, json.dumps(token), now, json.dumps(result, default=str))
+            )
+            self.conn.commit()
+            self._own_changes += self.conn.total_changes - before
+
+    def _load(self, name: str, token: tuple) -> Optional[tuple]:
+        try:
+            return self.conn.execute(
+                "SELECT computed_at, result FROM repair_check_cache WHERE check_name = ? AND token = ?",
+                (name, json.dumps(token))
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+
+    def stats(self) -> Dict:
+        return {"hits": self.hits, "misses": self.misses}
+
+    def clear(self):
+        """Forget in-memory results (persisted ones are keyed on counters and stay valid)"""
+        self._entries.clear()
+
+def emit_section(emit: Callable[[Dict], None], section: str, fields: Dict, skip: Callable[[str, object], bool] = lambda key, value: False):
+    """NDJSON records of one diagnosis section: its scalar fields, then its rows and mapping entries"""
+    emit(dict({"record": "section", "section": section},
+              **{k: v for k, v in fields.items() if not isinstance(v, (list, dict, SpooledRows))}))
+    for key, value in fields.items():
+        if isinstance(value, (list, SpooledRows)) and not skip(key, value):
+            for row in value:
+                emit({"record": "row", "section": section, "field": key, "data": row})
+        elif isinstance(value, dict):
+            for name, item in value.items():
+                emit({"record": "row", "section": section, "field": key, "key": name, "data": item})
+
+class DiagnosisStream:
+    """NDJSON writer fed by diagnose_system while its checks run
+
+    Offending rows are written as the checks find them (every row, not only
+    the top-K kept in the diagnosis), then each section's summary once its
+    check is done, and the issues and a summary record at the end. Rows of a
+    section answered from the check cache, and rows reshaped after their
+    check (position rows, net exposure), are written from the result.
+    """
+
+    def __init__(self, f, encoder: json.JSONEncoder):
+        self.f = f
+        self.encoder = encoder
+        self.section = None
+        self._streamed = set()
+
+    def emit(self, record: Dict):
+        for chunk in self.encoder.iterencode(record):
+            self.f.write(chunk)
+        self.f.write("\n")
+
+    def begin(self, diagnosis: Dict):
+        self.emit({"record": "diagnosis", "timestamp": diagnosis["timestamp"], "streamed": True})
+
+    def start_section(self, section: str):
+        self.section = section
+
+    def row(self, field: str, row: Dict):
+        self._streamed.add((self.section, field))
+        self.emit({"record": "row", "section": self.section, "field": field, "data": row})
+
+    def end_section(self, section: str, fields: Dict):
+        self.section = None
+        emit_section(self.emit, section, fields, skip=lambda key, value: (section, key) in self._streamed)
+
+    def finish(self, diagnosis: Dict):
+        # Issue rows are the rows of a section field, already written under it
+        located = {id(value): (section, key)
+                   for section in CHECK_TABLES for key, value in (diagnosis.get(section) or {}).items()
+                   if isinstance(value, (list, SpooledRows))}
+        for issue in diagnosis["issues_found"]:
+            record = {"record": "issue", "severity": issue["severity"], "type": issue["type"],
+                      "description": issue["description"], "rows": issue["count"]}
+            where = located.get(id(issue["details"]))
+            if where:
+                record.update(section=where[0], field=where[1])
+            self.emit(record)
+            if not where:
+                for row in issue["details"]:
+                    self.emit({"record": "row", "issue": issue["type"], "data": row})
+        self.emit({"record": "summary", "issues_found": len(diagnosis["issues_found"]),
+                   "cache": diagnosis.get("cache"), "durations": diagnosis.get("durations")})
 
 class TradingSystemRepair:
     """Main class for diagnosing and repairing trading system issues"""
     
-    def __init__(self, db_path: str = "trading.db"):
+    def __init__(self, db_path: str = "trading.db", use_cache: bool = True,
+                 top_k: Optional[int] = DEFAULT_TOP_K, spill_dir: Optional[str] = None,
+                 duplicate_window: float = DUPLICATE_WINDOW_SECONDS, max_memory: Optional[int] = None,
+                 keep_metrics: bool = False):
         self.db_path = db_path
+        self.keep_metrics = keep_metrics
+        self.memory_budget = MemoryBudget(max_memory, spill_dir) if max_memory else None
+        self.duplicate_window = duplicate_window
+        self.top_k = top_k
+        self.spill_dir = spill_dir
+        if spill_dir:
+            os.makedirs(spill_dir, exist_ok=True)
         self.conn = None
+        self.liquidation_index = LiquidationIndex()
+        # Change token of positions the index was last synced at (None: never)
+        self._liquidation_token = None
+        self._in_transaction = False
+        self._change_set = None
+        self._record_undo = False
+        self._run_id = None
+        # Spill subdirectory of the running diagnosis (None: a full run, spilling into spill_dir itself)
+        self._spill_scope = None
+        # DiagnosisStream of the running check, fed every tracked offender row
+        self._stream = None
+        self._throttle = None
+        self.progress = ProgressTracker()
         self._connect_db()
+        self.audit = AuditLog(self.conn)
+        self.use_cache = use_cache
+        self.check_cache = CheckCache(self.conn, variant=(top_k, spill_dir, duplicate_window, max_memory))
+        self.dirty_keys = DirtyKeyQueue(self.conn)
+        self._user_cache: "OrderedDict[str, tuple]" = OrderedDict()
         
     def _connect_db(self):
         """Establish database connection"""
         try:
-            self.conn = sqlite3.connect(self.db_path)
+            # Not bound to the creating thread: the HTTP service hands pooled instances between threads
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False)
             self.conn.row_factory = sqlite3.Row
+            self.conn.set_progress_handler(self.progress.on_vm_step, PROGRESS_HANDLER_OPS)
             logger.info(f"Connected to database: {self.db_path}")
         except Exception as e:
             logger.error(f"Database connection failed: {e}")
@@ -94,49 +1676,1264 @@ class TradingSystemRepair:
         return results
     
     def _execute_update(self, query: str, params: tuple = ()) -> int:
-        """Execute update query and commit"""
+        """Execute update query and commit (deferred to the end of an open repair transaction)"""
         cursor = self.conn.cursor()
         cursor.execute(query, params)
-        self.conn.commit()
+        if not self._in_transaction:
+            self.conn.commit()
         return cursor.rowcount
     
-    def diagnose_system(self) -> Dict:
-        """Run comprehensive system diagnostics"""
-        logger.info("Starting system diagnostics...")
-        
-        diagnosis = {
-            "timestamp": datetime.now().isoformat(),
-            "issues_found": [],
-            "wallet_status": {},
-            "order_status": {},
-            "position_status": {},
-            "ledger_integrity": {},
-            "risk_assessment": {}
-        }
+    def diagnose_system(self, incremental: bool = False, stream: Optional[DiagnosisStream] = None) -> Dict:
+        """Run comprehensive system diagnostics
+
+        With incremental=True (and dirty-key tracking installed) the per-row
+        wallet and position rules are only re-evaluated for rows changed since
+        the previous incremental run, and double-entry groups only for new
+        ledger references; their offenders persist in repair_offenders.
+        A stream is fed rows and sections as the checks produce them.
+        """
+        logger.info("Starting system diagnostics...")
+        dirty_keys = incremental and self.dirty_keys.installed()
+        if incremental and not dirty_keys:
+            logger.warning("Dirty-key tracking not installed (run install-tracking --dirty-keys), "
+                           "running full wallet and position checks")
+        
+        diagnosis = {
+            "timestamp": datetime.now().isoformat(),
+            "issues_found": [],
+            "wallet_status": {},
+            "order_status": {},
+            "position_status": {},
+            "ledger_integrity": {},
+            "risk_assessment": {}
+        }
+        if stream is not None:
+            stream.begin(diagnosis)
+        
+        hits, misses = self.check_cache.hits, self.check_cache.misses
+        durations = diagnosis["durations"] = {}
+        progress = diagnosis["progress"] = {}
+        
+        def timed(section: str, check):
+            started = time.perf_counter()
+            scanned = PROGRESS_SCANNED_TABLES.get(section)
+            self.progress.start(section, self._estimate_rows(scanned) if scanned else None)
+            if stream is not None:
+                stream.start_section(section)
+                self._stream = stream
+            try:
+                diagnosis[section] = check()
+            except sqlite3.OperationalError as e:
+                self._raise_if_cancelled(e)
+                raise
+            finally:
+                self._stream = None
+                progress[section] = self.progress.finish()
+            durations[section] = time.perf_counter() - started
+            if stream is not None:
+                stream.end_section(section, diagnosis[section])
+        
+        # Check wallet balances
+        if dirty_keys:
+            timed("wallet_status", self._check_wallets_incremental)
+        else:
+            timed("wallet_status", lambda: self._run_check("wallet_status", self._check_wallets))
+        
+        # Check order book integrity
+        timed("order_status", lambda: self._run_check("order_status", self._check_orders))
+        
+        # Check open positions
+        if dirty_keys:
+            timed("position_status", self._check_positions_incremental)
+        else:
+            timed("position_status", lambda: self._run_check("position_status", self._check_positions))
+        
+        # Verify ledger consistency
+        if incremental:
+            timed("ledger_integrity", lambda: self._verify_ledger(incremental=True))
+        else:
+            timed("ledger_integrity", lambda: self._run_check("ledger_integrity", self._verify_ledger))
+        
+        # Assess risk exposure, bringing the per-user risk summary up to date first
+        if self.dirty_keys.installed():
+            with self.check_cache.own_writes():
+                self.refresh_risk_summary()
+        timed("risk_assessment", lambda: self._run_check("risk_assessment", self._assess_risk))
+        
+        # Ledger archives: only opened when their summary no longer matches
+        timed("archive_status", lambda: self._run_check("archive_status", self._check_archives))
+        
+        # Identify specific issues
+        diagnosis["issues_found"] = self._identify_issues(diagnosis)
+        
+        diagnosis["cache"] = {
+            "hits": self.check_cache.hits - hits,
+            "misses": self.check_cache.misses - misses
+        }
+        
+        diagnosis["memory"] = {"peak_rss_bytes": peak_rss_bytes()}
+        if self.memory_budget is not None:
+            diagnosis["memory"].update(self.memory_budget.stats())
+        
+        if self.keep_metrics:
+            self.record_metrics(diagnosis)
+        if stream is not None:
+            stream.finish(diagnosis)
+        
+        logger.info(f"Diagnosis complete. Found {len(diagnosis['issues_found'])} issues. "
+                    f"Cache: {diagnosis['cache']['hits']} hits, {diagnosis['cache']['misses']} misses.")
+        return diagnosis
+    
+    def _estimate_rows(self, table: str) -> Optional[int]:
+        """Row count estimate from the rowid span (two index probes, no scan)"""
+        try:
+            low, high = self.conn.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {table}").fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return high - low + 1 if low is not None else 0
+    
+    def _raise_if_cancelled(self, error: BaseException):
+        """Turn the 'interrupted' error of a statement aborted by the progress handler into OperationCancelled"""
+        if self.progress.cancel_requested and not isinstance(error, OperationCancelled):
+            raise OperationCancelled(f"cancelled during {self.progress.stage or 'run'}") from error
+    
+    def _ensure_metrics_table(self):
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS repair_metrics (
+                metric TEXT NOT NULL,
+                resolution TEXT NOT NULL,
+                bucket_start INTEGER NOT NULL,
+                samples INTEGER NOT NULL,
+                total REAL NOT NULL,
+                minimum REAL NOT NULL,
+                maximum REAL NOT NULL,
+                PRIMARY KEY (metric, resolution, bucket_start)
+            ) WITHOUT ROWID
+        """)
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_repair_metrics_rollup ON repair_metrics (resolution, bucket_start)"
+        )
+    
+    def record_metrics(self, diagnosis: Dict, at: Optional[float] = None) -> int:
+        """Append a diagnosis's per-rule counts and sums and per-check durations to repair_metrics
+        
+        Metrics are named <section>.<rule>.count / .sum,
+        check.<section>.seconds / .rows / .rows_per_sec, plus issues.count. Raw points older than
+        METRICS_RAW_RETENTION are rolled up into hourly buckets and hourly
+        ones older than METRICS_HOURLY_RETENTION into daily buckets, so the
+        table stays small. A failure (e.g. a read-only database) is logged
+        and does not fail the diagnosis.
+        """
+        at = int(time.time() if at is None else at)
+        points = [("issues.count", float(len(diagnosis.get("issues_found", []))))]
+        for section in CHECK_TABLES:
+            for rule, totals in (diagnosis.get(section) or {}).get("totals", {}).items():
+                points.append((f"{section}.{rule}.count", float(totals["count"])))
+                points.append((f"{section}.{rule}.sum", float(totals["sum"] or 0.0)))
+        for section, seconds in diagnosis.get("durations", {}).items():
+            points.append((f"check.{section}.seconds", seconds))
+        for section, progress in diagnosis.get("progress", {}).items():
+            points.append((f"check.{section}.rows", float(progress["rows"])))
+            points.append((f"check.{section}.rows_per_sec", progress["rows_per_sec"]))
+        
+        try:
+            # Bookkeeping writes must not invalidate cached check results
+            with self.check_cache.own_writes():
+                self._ensure_metrics_table()
+                self.conn.executemany(f"""
+                    INSERT INTO repair_metrics (metric, resolution, bucket_start, samples, total, minimum, maximum)
+                    VALUES (?, 'raw', ?, 1, ?, ?, ?)
+                    ON CONFLICT (metric, resolution, bucket_start) DO UPDATE SET {METRICS_MERGE_SQL}
+                """, [(metric, at, value, value, value) for metric, value in points])
+                self._rollup_metrics(at)
+                self.conn.commit()
+        except sqlite3.Error as e:
+            self._rollback()
+            logger.warning(f"Could not record diagnosis metrics: {e}")
+            return 0
+        return len(points)
+    
+    def _rollup_metrics(self, now: int):
+        """Fold complete raw buckets into hours and hourly buckets into days past their retention"""
+        for source, target, step, retention in (("raw", "hour", 3600, METRICS_RAW_RETENTION),
+                                                ("hour", "day", 86400, METRICS_HOURLY_RETENTION)):
+            cutoff = (now - retention) // step * step
+            self.conn.execute(f"""
+                INSERT INTO repair_metrics (metric, resolution, bucket_start, samples, total, minimum, maximum)
+                SELECT metric, '{target}', bucket_start / {step} * {step},
+                       SUM(samples), SUM(total), MIN(minimum), MAX(maximum)
+                FROM repair_metrics
+                WHERE resolution = ? AND bucket_start < ?
+                GROUP BY metric, bucket_start / {step}
+                ON CONFLICT (metric, resolution, bucket_start) DO UPDATE SET {METRICS_MERGE_SQL}
+            """, (source, cutoff))
+            self.conn.execute("DELETE FROM repair_metrics WHERE resolution = ? AND bucket_start < ?", (source, cutoff))
+    
+    def metric_trend(self, metric: str, days: float = 30, step: Optional[str] = None) -> Dict:
+        """Per-bucket samples, average, minimum and maximum of a metric over the last `days`
+        
+        metric is a full name (wallet_status.negative_balances.count) or a
+        rule name, which means that rule's count. step is "hour" or "day"
+        (default: hour up to two days, else day); raw, hourly and daily
+        points are merged into it, so the answer comes from the metrics
+        table alone.
+        """
+        self._ensure_metrics_table()
+        if "." not in metric:
+            row = self.conn.execute(
+                "SELECT DISTINCT metric FROM repair_metrics WHERE metric LIKE ? ORDER BY metric LIMIT 1",
+                (f"%.{metric}.count",)
+            ).fetchone()
+            metric = row[0] if row else f"{metric}.count"
+        step = step or ("hour" if days <= 2 else "day")
+        seconds = {"hour": 3600, "day": 86400}[step]
+        since = int(time.time() - days * 86400) // seconds * seconds
+        points = [
+            {
+                "bucket": datetime.fromtimestamp(bucket, timezone.utc).strftime('%Y-%m-%d %H:%M'),
+                "samples": samples,
+                "average": total / samples,
+                "minimum": minimum,
+                "maximum": maximum
+            }
+            for bucket, samples, total, minimum, maximum in self.conn.execute(f"""
+                SELECT bucket_start / {seconds} * {seconds} AS bucket, SUM(samples), SUM(total), MIN(minimum), MAX(maximum)
+                FROM repair_metrics
+                WHERE metric = ? AND resolution IN ('raw', 'hour', 'day') AND bucket_start >= ?
+                GROUP BY bucket
+                ORDER BY bucket
+            """, (metric, since))
+        ]
+        return {"metric": metric, "days": days, "step": step, "points": points}
+    
+    def run_check(self, name: str) -> Dict:
+        """Run (or serve from cache) a single diagnosis check by section name"""
+        checks = {
+            "wallet_status": self._check_wallets,
+            "order_status": self._check_orders,
+            "position_status": self._check_positions,
+            "ledger_integrity": self._verify_ledger,
+            "risk_assessment": self._assess_risk,
+            "archive_status": self._check_archives
+        }
+        return self._run_check(name, checks[name])
+    
+    def diagnose_sample(self, fraction: float, escalate_above: Optional[float] = None,
+                        seed: Optional[int] = None) -> Dict:
+        """Estimate per-rule offender counts from a random sample of rowid blocks
+        
+        Each table's rowid span is cut into SAMPLE_BLOCK_ROWS blocks and
+        the given fraction of them is read (rowid range seeks), so the cost
+        scales with the sample, not the table. Tables spanning fewer than
+        SAMPLE_MIN_ROWS rowids are read in full and reported exactly.
+        Counts are scaled to the table and bounded by a 95% Wilson interval
+        (blocks are clusters, so treat the bounds as approximate). Rules whose
+        estimated rate exceeds escalate_above get a full run of their check.
+        """
+        started = time.perf_counter()
+        rng = random.Random(seed)
+        diagnosis = {
+            "timestamp": datetime.now().isoformat(),
+            "mode": "sample",
+            "fraction": fraction,
+            "tables": {},
+            "rules": {}
+        }
+        full_checks: Dict[str, Dict] = {}
+        
+        # Partial results: spilled apart from the full run's files
+        with self._spill_scoped("sample"):
+            for table in dict.fromkeys(rule.table for rule in SAMPLE_RULES):
+                rules = [rule for rule in SAMPLE_RULES if rule.table == table]
+                low, high = self.conn.execute(f"SELECT MIN(rowid), MAX(rowid) FROM {table}").fetchone()
+                span = high - low + 1 if low is not None else 0
+                exact = span <= max(SAMPLE_MIN_ROWS, SAMPLE_BLOCK_ROWS) or fraction >= 1
+                if exact:
+                    ranges = [(low, high)] if span else []
+                else:
+                    blocks = math.ceil(span / SAMPLE_BLOCK_ROWS)
+                    chosen = sorted(rng.sample(range(blocks), max(1, math.ceil(blocks * fraction))))
+                    ranges = [(low + block * SAMPLE_BLOCK_ROWS, min(high, low + (block + 1) * SAMPLE_BLOCK_ROWS - 1))
+                              for block in chosen]
+            
+                matches = ", ".join(f"({rule.where}) AS _sample_{i}" for i, rule in enumerate(rules))
+                trackers = [self._tracker(rule.name) for rule in rules]
+                sampled = 0
+                for start, end in ranges:
+                    for row in self._iter_query(f"SELECT *, {matches} FROM {table} WHERE rowid BETWEEN ? AND ?",
+                                                (start, end)):
+                        sampled += 1
+                        flags = [row.pop(f"_sample_{i}") for i in range(len(rules))]
+                        for rule, tracker, flag in zip(rules, trackers, flags):
+                            offending = rule.evaluate(row) if flag else None
+                            if offending:
+                                tracker.add(*offending)
+            
+                sampled_span = sum(end - start + 1 for start, end in ranges)
+                estimated_rows = sampled * span / sampled_span if sampled_span else 0
+                diagnosis["tables"][table] = {
+                    "rowid_span": span,
+                    "rows_sampled": sampled,
+                    "estimated_rows": round(estimated_rows),
+                    "blocks": len(ranges),
+                    "exact": exact
+                }
+            
+                for rule, tracker in zip(rules, trackers):
+                    rate = tracker.count / sampled if sampled else 0.0
+                    low_rate, high_rate = (rate, rate) if exact else wilson_interval(tracker.count, sampled)
+                    estimate = {
+                        "section": rule.section,
+                        "table": table,
+                        "offenders_sampled": tracker.count,
+                        "rate": rate,
+                        "estimate": round(rate * estimated_rows),
+                        "ci_low": math.floor(low_rate * estimated_rows),
+                        "ci_high": math.ceil(high_rate * estimated_rows),
+                        "exact": exact,
+                        "escalated": False,
+                        "sample_offenders": tracker.rows()
+                    }
+                    if not exact and escalate_above is not None and rate > escalate_above:
+                        if rule.section not in full_checks:
+                            logger.info(f"Escalating {rule.section} to a full scan ({rule.name} rate {rate:.2%})")
+                            full_checks[rule.section] = self.run_check(rule.section)
+                        full = full_checks[rule.section]
+                        count = full["totals"][rule.name]["count"]
+                        estimate.update(estimate=count, ci_low=count, ci_high=count, exact=True, escalated=True,
+                                        sample_offenders=full[rule.name])
+                    diagnosis["rules"][rule.name] = estimate
+        
+        diagnosis["seconds"] = time.perf_counter() - started
+        return diagnosis
+    
+    def diagnose_user(self, user_id: str) -> Dict:
+        """Run every check restricted to one user, in the same structure as diagnose_system
+
+        Each query filters on user_id, so with install_indexes() in place the
+        whole drill-down is index lookups. Results are kept in a small LRU
+        keyed by user and the change token of all checked tables.
+        """
+        tables = tuple(sorted({table for tables in CHECK_TABLES.values() for table in tables}))
+        token = self.check_cache.token(tables) if self.use_cache else None
+        ttl = min(CHECK_TTL.values())
+        cached = self._user_cache.get(user_id)
+        if token is not None and cached and cached[0] == token and time.time() - cached[1] < ttl:
+            self._user_cache.move_to_end(user_id)
+            return cached[2]
+        
+        with self._spill_scoped(f"user-{user_id}"):
+            diagnosis = {
+                "timestamp": datetime.now().isoformat(),
+                "user_id": user_id,
+                "issues_found": [],
+                "wallet_status": self._check_wallets(user_id),
+                "order_status": self._check_orders(user_id),
+                "position_status": self._check_positions(user_id),
+                "ledger_integrity": self._verify_ledger(user_id),
+                "risk_assessment": self._assess_risk(user_id),
+                "archive_status": self._check_archives(user_id)
+            }
+        diagnosis["issues_found"] = self._identify_issues(diagnosis)
+        
+        if token is not None:
+            self._user_cache[user_id] = (token, time.time(), diagnosis)
+            self._user_cache.move_to_end(user_id)
+            while len(self._user_cache) > USER_CACHE_SIZE:
+                self._user_cache.popitem(last=False)
+        return diagnosis
+    
+    def install_indexes(self) -> List[str]:
+        """Create the indexes per-user checks and ledger lookups rely on (skipping missing tables)"""
+        existing = {row['name'] for row in self._execute_query(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )}
+        installed = []
+        for name, (table, columns) in REPAIR_INDEXES.items():
+            if table in existing:
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})")
+                installed.append(name)
+        self.conn.commit()
+        logger.info(f"Indexes installed: {', '.join(installed)}")
+        return installed
+    
+    def build_ledger_checkpoints(self, rebuild: bool = False) -> Dict:
+        """Extend the per-account ledger checkpoints with entries added since the last build
+
+        Ledger position is the wallet_transactions rowid. repair_ledger_heads
+        holds each account's running balance through the build watermark;
+        every LEDGER_CHECKPOINT_INTERVAL entries of an account a row goes to
+        repair_ledger_checkpoints with the balance at that position and the
+        latest created_at (as julianday) it covers. The ledger is assumed
+        append-only; after editing old entries, rebuild.
+        """
+        started = time.perf_counter()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS repair_ledger_checkpoints (
+                user_id TEXT NOT NULL,
+                currency TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                as_of REAL NOT NULL,
+                balance REAL NOT NULL,
+                entries INTEGER NOT NULL,
+                PRIMARY KEY (user_id, currency, position)
+            )
+        """)
+        self.conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_repair_ledger_checkpoints_as_of
+            ON repair_ledger_checkpoints (user_id, currency, as_of)
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS repair_ledger_heads (
+                user_id TEXT NOT NULL,
+                currency TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                as_of REAL,
+                balance REAL NOT NULL,
+                entries INTEGER NOT NULL,
+                PRIMARY KEY (user_id, currency)
+            )
+        """)
+        if rebuild:
+            self.conn.execute("DELETE FROM repair_ledger_checkpoints")
+            self.conn.execute("DELETE FROM repair_ledger_heads")
+            _state_set(self.conn, "ledger_checkpoint_rowid", "0")
+            # Archived entries are no longer in the table; start from their recorded sums
+            if self._execute_query(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'repair_partition_accounts'"):
+                self.conn.execute("""
+                    INSERT INTO repair_ledger_heads (user_id, currency, position, as_of, balance, entries)
+                    SELECT user_id, currency, 0, NULL, SUM(amount_sum), SUM(entries)
+                    FROM repair_partition_accounts GROUP BY user_id, currency
+                """)
+        watermark = int(_state_get(self.conn, "ledger_checkpoint_rowid") or 0)
+        
+        heads: Dict[Tuple[str, str], list] = {}
+        checkpoints = 0
+        rows = 0
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        cursor.execute("""
+            SELECT rowid, user_id, currency, amount, julianday(created_at)
+            FROM wallet_transactions WHERE rowid > ? ORDER BY rowid
+        """, (watermark,))
+        for rowid, user_id, currency, amount, created in cursor:
+            account = (user_id, currency)
+            head = heads.get(account)
+            if head is None:
+                stored = self.conn.execute(
+                    "SELECT position, as_of, balance, entries FROM repair_ledger_heads WHERE user_id = ? AND currency = ?",
+                    account
+                ).fetchone()
+                head = heads[account] = list(stored) if stored else [0, None, 0.0, 0]
+            head[0] = rowid
+            if created is not None and (head[1] is None or created > head[1]):
+                head[1] = created
+            head[2] += amount
+            head[3] += 1
+            rows += 1
+            if head[3] % LEDGER_CHECKPOINT_INTERVAL == 0 and head[1] is not None:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO repair_ledger_checkpoints VALUES (?, ?, ?, ?, ?, ?)",
+                    account + tuple(head)
+                )
+                checkpoints += 1
+            watermark = rowid
+        
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO repair_ledger_heads VALUES (?, ?, ?, ?, ?, ?)",
+            [account + tuple(head) for account, head in heads.items()]
+        )
+        _state_set(self.conn, "ledger_checkpoint_rowid", str(watermark))
+        self.conn.commit()
+        result = {
+            "rows": rows,
+            "accounts_touched": len(heads),
+            "checkpoints_written": checkpoints,
+            "watermark": watermark,
+            "seconds": time.perf_counter() - started
+        }
+        logger.info(f"Ledger checkpoints: {rows} new entries, {checkpoints} checkpoints written")
+        return result
+    
+    def balance_at(self, user_id: str, currency: str, at: str) -> Dict:
+        """Ledger balance of one account at a point in time: nearest checkpoint plus replayed delta
+
+        The checkpoint chosen is the latest one whose entries are all at or
+        before `at`; only the account's entries after its position are
+        replayed (an index range on user_id, currency, rowid), plus any
+        archived ones past it.
+        """
+        if not self._execute_query(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'repair_ledger_checkpoints'"):
+            self.build_ledger_checkpoints()
+        checkpoint = self.conn.execute("""
+            SELECT position, as_of, balance, entries FROM repair_ledger_checkpoints
+            WHERE user_id = ? AND currency = ? AND as_of <= julianday(?)
+            ORDER BY as_of DESC, position DESC LIMIT 1
+        """, (user_id, currency, at)).fetchone()
+        position, balance, entries = (checkpoint[0], checkpoint[2], checkpoint[3]) if checkpoint else (0, 0.0, 0)
+        delta, replayed = self.conn.execute("""
+            SELECT COALESCE(SUM(amount), 0), COUNT(*) FROM wallet_transactions
+            WHERE user_id = ? AND currency = ? AND rowid > ? AND julianday(created_at) <= julianday(?)
+        """, (user_id, currency, position, at)).fetchone()
+        # Entries after the checkpoint may since have moved to a ledger archive
+        archived, archived_entries = self._archived_delta(user_id, currency, at, position)
+        delta += archived
+        replayed += archived_entries
+        return {
+            "user_id": user_id,
+            "currency": currency,
+            "time": at,
+            "balance": balance + delta,
+            "entries": entries + replayed,
+            "checkpoint_position": position if checkpoint else None,
+            "replayed": replayed
+        }
+    
+    def _ensure_partition_tables(self):
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS repair_ledger_partitions (
+                partition TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                entries INTEGER NOT NULL,
+                amount_sum REAL NOT NULL,
+                min_rowid INTEGER,
+                max_rowid INTEGER,
+                hash TEXT NOT NULL,
+                file_size INTEGER,
+                file_mtime_ns INTEGER,
+                archived_at TEXT
+            )
+        """)
+        # Entries copied to an archive's wallet_transactions_staged table, still in the live ledger
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS repair_archive_staged (
+                partition TEXT PRIMARY KEY,
+                path TEXT NOT NULL,
+                entries INTEGER NOT NULL,
+                amount_sum REAL NOT NULL,
+                hash TEXT NOT NULL,
+                staged_at TEXT
+            )
+        """)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS repair_partition_accounts (
+                partition TEXT NOT NULL,
+                user_id TEXT NOT NULL,
+                currency TEXT NOT NULL,
+                entries INTEGER NOT NULL,
+                amount_sum REAL NOT NULL,
+                PRIMARY KEY (partition, user_id, currency)
+            )
+        """)
+    
+    @contextmanager
+    def _attached(self, path: str, alias: str):
+        """ATTACH a database for the duration of the block (outside any open transaction)"""
+        self.conn.commit()
+        self.conn.execute("ATTACH DATABASE ? AS " + alias, (path,))
+        try:
+            yield alias
+        finally:
+            self.conn.commit()
+            self.conn.execute("DETACH DATABASE " + alias)
+    
+    def _partition_digest(self, schema: str, table: str = "wallet_transactions", where: str = "1 = 1") -> Dict:
+        """Count, amount sum, rowid range, per-account sums and SHA-256 of a ledger partition's rows"""
+        digest = hashlib.sha256()
+        summary = {"entries": 0, "amount_sum": 0.0, "min_rowid": None, "max_rowid": None, "accounts": {}}
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(f"SELECT rowid, * FROM {schema}.{table} WHERE {where} ORDER BY rowid")
+        names = [column[0] for column in cursor.description]
+        user_col, currency_col, amount_col = names.index("user_id"), names.index("currency"), names.index("amount")
+        for row in cursor:
+            digest.update(json.dumps(row, default=_json_default).encode())
+            digest.update(b"\n")
+            summary["entries"] += 1
+            summary["amount_sum"] += row[amount_col]
+            if summary["min_rowid"] is None:
+                summary["min_rowid"] = row[0]
+            summary["max_rowid"] = row[0]
+            account = summary["accounts"].setdefault((row[user_col], row[currency_col]), [0, 0.0])
+            account[0] += 1
+            account[1] += row[amount_col]
+        summary["hash"] = digest.hexdigest()
+        return summary
+    
+    def _archive_path(self, partition: str, archive_dir: Optional[str] = None) -> str:
+        stem = os.path.splitext(os.path.basename(self.db_path))[0]
+        archive_dir = archive_dir or os.path.join(os.path.dirname(os.path.abspath(self.db_path)), f"{stem}_archive")
+        os.makedirs(archive_dir, exist_ok=True)
+        return os.path.join(archive_dir, f"{stem}.ledger-{partition}.db")
+    
+    @staticmethod
+    def _digests_match(a: Dict, b: Dict) -> bool:
+        return a["entries"] == b["entries"] and a["hash"] == b["hash"] and abs(a["amount_sum"] - b["amount_sum"]) < 1e-9
+    
+    def _ledger_table_sql(self) -> Tuple[str, str]:
+        """CREATE TABLE statement and quoted column list of the live wallet_transactions"""
+        create_sql = self.conn.execute(
+            "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'wallet_transactions'"
+        ).fetchone()[0]
+        columns = ", ".join(f'"{row[1]}"' for row in self.conn.execute("PRAGMA table_info(wallet_transactions)"))
+        return create_sql, columns
+    
+    def archive_ledger(self, older_than_months: int = ARCHIVE_AFTER_MONTHS,
+                       archive_dir: Optional[str] = None) -> Dict:
+        """Copy settled ledger entries into per-month archive databases, verified, without deleting them
+        
+        Entries created before the first day of the month older_than_months
+        ago that are settled (ARCHIVE_SETTLED_SQL) are copied, rowids
+        preserved, to the wallet_transactions_staged table of
+        <db>_archive/<db>.ledger-YYYY-MM.db. The copy's count, amount sum and
+        row hash must equal those of the live rows, or it is discarded; a
+        verified copy is recorded in repair_archive_staged. The live ledger
+        is untouched until purge_archived_ledger().
+        """
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        month_index = now.year * 12 + now.month - 1 - older_than_months
+        cutoff = f"{month_index // 12:04d}-{month_index % 12 + 1:02d}-01 00:00:00"
+        self._ensure_partition_tables()
+        self.conn.commit()
+        
+        create_sql, columns = self._ledger_table_sql()
+        eligible = f"julianday(created_at) < julianday(?) AND {ARCHIVE_SETTLED_SQL}"
+        partitions = [row[0] for row in self.conn.execute(f"""
+            SELECT DISTINCT strftime('%Y-%m', created_at) FROM main.wallet_transactions
+            WHERE {eligible} ORDER BY 1
+        """, (cutoff,))]
+        
+        result = {"cutoff": cutoff, "partitions": [], "entries_staged": 0, "failed": []}
+        for partition in partitions:
+            path = self._archive_path(partition, archive_dir)
+            with self._attached(path, "ledger_archive") as alias:
+                for name in ("wallet_transactions", "wallet_transactions_staged"):
+                    self.conn.execute(re.sub(
+                        r'CREATE TABLE\s+(IF NOT EXISTS\s+)?["`\[]?wallet_transactions["`\]]?',
+                        f"CREATE TABLE IF NOT EXISTS {alias}.{name}", create_sql, count=1
+                    ))
+                # Re-staging replaces any earlier, unpurged copy
+                self.conn.execute(f"DELETE FROM {alias}.wallet_transactions_staged")
+                self.conn.execute(f"""
+                    INSERT INTO {alias}.wallet_transactions_staged (rowid, {columns})
+                    SELECT rowid, {columns} FROM main.wallet_transactions
+                    WHERE strftime('%Y-%m', created_at) = ? AND {eligible}
+                """, (partition, cutoff))
+                copy = self._partition_digest(alias, "wallet_transactions_staged")
+                live = self._partition_digest(
+                    "main", where=f"rowid IN (SELECT rowid FROM {alias}.wallet_transactions_staged)")
+                if not self._digests_match(copy, live):
+                    self.conn.execute(f"DELETE FROM {alias}.wallet_transactions_staged")
+                    self.conn.execute("DELETE FROM repair_archive_staged WHERE partition = ?", (partition,))
+                    result["failed"].append({"partition": partition, "path": path, "reason": "copy does not verify"})
+                    logger.error(f"Archive copy for {partition} does not match the live ledger, discarded")
+                    continue
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO repair_archive_staged VALUES (?, ?, ?, ?, ?, ?)",
+                    (partition, path, copy["entries"], copy["amount_sum"], copy["hash"], now.isoformat())
+                )
+            result["partitions"].append({"partition": partition, "path": path, "staged": copy["entries"]})
+            result["entries_staged"] += copy["entries"]
+            logger.info(f"Staged {copy['entries']} settled ledger entries for {partition} in {path}")
+        
+        result["seconds"] = time.perf_counter() - started
+        return result
+    
+    def purge_archived_ledger(self) -> Dict:
+        """Remove staged ledger entries from the live table once both copies still verify
+        
+        For every partition in repair_archive_staged, the staged archive rows
+        and the live rows with the same rowids must both still match the
+        count, sum and hash recorded at staging; otherwise the partition is
+        skipped (stage it again). In one transaction across both databases
+        the live rows are deleted, the staged rows join the archive's
+        wallet_transactions, and the partition's summary, per-account sums
+        and row hash are recorded in repair_ledger_partitions and
+        repair_partition_accounts. Ledger checkpoints are brought up to date
+        first so running balances still include the moved entries.
+        """
+        started = time.perf_counter()
+        now = datetime.now(timezone.utc)
+        self.build_ledger_checkpoints()
+        self._ensure_partition_tables()
+        self.conn.commit()
+        
+        _, columns = self._ledger_table_sql()
+        staged_parts = self.conn.execute(
+            "SELECT partition, path, entries, amount_sum, hash FROM repair_archive_staged ORDER BY partition"
+        ).fetchall()
+        result = {"partitions": [], "entries_moved": 0, "skipped": []}
+        for partition, path, entries, amount_sum, expected_hash in staged_parts:
+            recorded = {"entries": entries, "amount_sum": amount_sum, "hash": expected_hash}
+            with self._attached(path, "ledger_archive") as alias:
+                staged = f"rowid IN (SELECT rowid FROM {alias}.wallet_transactions_staged)"
+                copy = self._partition_digest(alias, "wallet_transactions_staged")
+                live = self._partition_digest("main", where=staged)
+                if not (self._digests_match(copy, recorded) and self._digests_match(live, recorded)):
+                    result["skipped"].append({"partition": partition, "path": path,
+                                              "reason": "changed since staging, run archive again"})
+                    logger.warning(f"Staged archive for {partition} no longer verifies, not purged")
+                    continue
+                moved = self.conn.execute(f"DELETE FROM main.wallet_transactions WHERE {staged}").rowcount
+                self.conn.execute(f"""
+                    INSERT INTO {alias}.wallet_transactions (rowid, {columns})
+                    SELECT rowid, {columns} FROM {alias}.wallet_transactions_staged
+                """)
+                self.conn.execute(f"DELETE FROM {alias}.wallet_transactions_staged")
+                self.conn.execute("DELETE FROM repair_archive_staged WHERE partition = ?", (partition,))
+                
+                summary = self._partition_digest(alias)
+                self.conn.execute("DELETE FROM repair_partition_accounts WHERE partition = ?", (partition,))
+                self.conn.executemany(
+                    "INSERT INTO repair_partition_accounts VALUES (?, ?, ?, ?, ?)",
+                    [(partition, user_id, currency, entries, amount)
+                     for (user_id, currency), (entries, amount) in summary["accounts"].items()]
+                )
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO repair_ledger_partitions VALUES (?, ?, ?, ?, ?, ?, ?, NULL, NULL, ?)",
+                    (partition, path, summary["entries"], summary["amount_sum"], summary["min_rowid"],
+                     summary["max_rowid"], summary["hash"], now.isoformat())
+                )
+            # The file is only final once detached
+            stat = os.stat(path)
+            self.conn.execute(
+                "UPDATE repair_ledger_partitions SET file_size = ?, file_mtime_ns = ? WHERE partition = ?",
+                (stat.st_size, stat.st_mtime_ns, partition)
+            )
+            self.conn.commit()
+            result["partitions"].append({"partition": partition, "path": path, "moved": moved,
+                                         "entries": summary["entries"]})
+            result["entries_moved"] += moved
+            logger.info(f"Purged {moved} archived ledger entries for {partition} (archive: {path})")
+        
+        result["seconds"] = time.perf_counter() - started
+        return result
+    
+    def _check_archives(self, user_id: Optional[str] = None) -> Dict:
+        """Compare each ledger archive with its recorded summary; scan only archives that disagree
+        
+        An archive whose file size and mtime are unchanged since it was
+        written is trusted without opening it. Otherwise it is attached and
+        re-digested; if count, sum or hash differ it is reported and its rows
+        get the orphaned-reference check.
+        """
+        result = {
+            "partitions": 0,
+            "archived_entries": 0,
+            "archives_scanned": 0,
+            "archive_mismatches": [],
+            "archived_orphans": []
+        }
+        mismatches = self._tracker("archive_mismatches")
+        orphans = self._tracker("archived_orphans")
+        try:
+            partitions = self._execute_query("SELECT * FROM repair_ledger_partitions ORDER BY partition")
+        except sqlite3.OperationalError:
+            partitions = []
+        
+        for part in partitions:
+            result["partitions"] += 1
+            result["archived_entries"] += part["entries"]
+            try:
+                stat = os.stat(part["path"])
+            except OSError:
+                mismatches.add({"partition": part["partition"], "path": part["path"], "reason": "missing"},
+                               part["entries"], part["amount_sum"])
+                continue
+            if (stat.st_size, stat.st_mtime_ns) == (part["file_size"], part["file_mtime_ns"]):
+                continue
+            
+            result["archives_scanned"] += 1
+            with self._attached(part["path"], "ledger_archive") as alias:
+                actual = self._partition_digest(alias)
+                expected = {k: part[k] for k in ("entries", "amount_sum", "hash")}
+                if {k: actual[k] for k in expected} != expected:
+                    drift = actual["amount_sum"] - part["amount_sum"]
+                    mismatches.add({
+                        "partition": part["partition"],
+                        "path": part["path"],
+                        "reason": "modified",
+                        "expected": expected,
+                        "actual": {k: actual[k] for k in expected}
+                    }, abs(drift) + abs(actual["entries"] - part["entries"]), drift)
+                    user_sql, params = _user_filter(user_id)
+                    for row in self._iter_query(f"""
+                        SELECT * FROM {alias}.wallet_transactions
+                        WHERE {ORPHANED_REFERENCE_SQL}{user_sql}
+                    """, params):
+                        orphans.add(dict(row, partition=part["partition"]), abs(row['amount']), row['amount'])
+                    continue
+            # Same content, only the file was touched: remember the new fingerprint
+            self.conn.execute(
+                "UPDATE repair_ledger_partitions SET file_size = ?, file_mtime_ns = ? WHERE partition = ?",
+                (stat.st_size, stat.st_mtime_ns, part["partition"])
+            )
+            self.conn.commit()
+        
+        return self._collect(result, mismatches, orphans)
+    
+    def _archived_delta(self, user_id: str, currency: str, at: str, after_rowid: int) -> Tuple[float, int]:
+        """Sum and count of an account's archived entries with rowid > after_rowid created at or before `at`
+
+        Partitions ending before `at` whose rows all lie past after_rowid come
+        from the recorded per-account sums; only a partition straddling the
+        range is attached.
+        """
+        try:
+            partitions = self._execute_query("""
+                SELECT p.partition, p.path, p.min_rowid, a.entries, a.amount_sum
+                FROM repair_ledger_partitions p
+                JOIN repair_partition_accounts a ON a.partition = p.partition
+                WHERE a.user_id = ? AND a.currency = ? AND p.max_rowid > ?
+                  AND julianday(p.partition || '-01') <= julianday(?)
+            """, (user_id, currency, after_rowid, at))
+        except sqlite3.OperationalError:
+            return 0.0, 0
+        total, count = 0.0, 0
+        for part in partitions:
+            month_end = self.conn.execute(
+                "SELECT julianday(? || '-01', '+1 month') <= julianday(?)", (part["partition"], at)
+            ).fetchone()[0]
+            if month_end and part["min_rowid"] > after_rowid:
+                total += part["amount_sum"]
+                count += part["entries"]
+                continue
+            with self._attached(part["path"], "ledger_archive") as alias:
+                amount, entries = self.conn.execute(f"""
+                    SELECT COALESCE(SUM(amount), 0), COUNT(*) FROM {alias}.wallet_transactions
+                    WHERE user_id = ? AND currency = ? AND rowid > ? AND julianday(created_at) <= julianday(?)
+                """, (user_id, currency, after_rowid, at)).fetchone()
+            total += amount
+            count += entries
+        return total, count
+    
+    def reconcile_wallets(self) -> Dict:
+        """Compare wallet_balances with ledger balances taken from the checkpoint heads
+
+        The checkpoints are brought up to date first, so only ledger entries
+        added since the last build are read. Accounts present on only one
+        side count as mismatches against zero.
+        """
+        build = self.build_ledger_checkpoints()
+        result = {"accounts": 0, "balance_mismatches": [], "checkpoints": build}
+        mismatches = self._tracker("balance_mismatches")
+        for row in self._iter_query("""
+            SELECT w.user_id, w.currency, w.balance AS wallet_balance,
+                   COALESCE(h.balance, 0) AS ledger_balance, COALESCE(h.entries, 0) AS entries
+            FROM wallet_balances w
+            LEFT JOIN repair_ledger_heads h ON h.user_id = w.user_id AND h.currency = w.currency
+            UNION ALL
+            SELECT h.user_id, h.currency, 0, h.balance, h.entries
+            FROM repair_ledger_heads h
+            WHERE NOT EXISTS (
+                SELECT 1 FROM wallet_balances w WHERE w.user_id = h.user_id AND w.currency = h.currency
+            )
+        """):
+            result["accounts"] += 1
+            difference = row['wallet_balance'] - row['ledger_balance']
+            if abs(difference) > RECONCILE_TOLERANCE:
+                row["difference"] = difference
+                mismatches.add(row, abs(difference), difference)
+        return self._collect(result, mismatches)
+    
+    def reconcile_fills(self, path: str, max_keys: Optional[int] = None) -> Dict:
+        """Reconcile an exported fill or settlement CSV against the database
         
-        # Check wallet balances
-        diagnosis["wallet_status"] = self._check_wallets()
+        A file with an order_id column is matched to orders.amount; one with
+        reference_id and currency columns to the summed wallet_transactions
+        of each (reference_id, currency). File rows sharing a key are summed.
+        With a timestamp/created_at column, database records created outside
+        the file's time range are not reported as extra (they still match).
         
-        # Check order book integrity
-        diagnosis["order_status"] = self._check_orders()
+        The file is aggregated in a hash table of at most max_keys keys and
+        joined against one scan of the table. Past that, the table is written
+        as sorted runs to disk and the merged runs are merge-joined with the
+        table read in key order, so memory stays bounded by max_keys.
+        """
+        started = time.perf_counter()
+        if max_keys is None:
+            max_keys = (self.memory_budget.max_bytes // RECONCILE_KEY_BYTES if self.memory_budget
+                        else RECONCILE_HASH_KEYS)
+        max_keys = max(1, max_keys)
+        missing = self._tracker("missing_records")
+        extra = self._tracker("extra_records")
+        mismatches = self._tracker("amount_mismatches")
+        result = {"file": path, "rows": 0, "skipped": 0, "keys": 0, "matched": 0, "runs": 0}
         
-        # Check open positions
-        diagnosis["position_status"] = self._check_positions()
+        run_dir = tempfile.mkdtemp(prefix="reconcile-", dir=self.spill_dir)
+        runs: List[str] = []
+        table: Dict[tuple, list] = {}
+        window = [None, None]
+        try:
+            with open(path, newline="") as f:
+                reader = csv.DictReader(f)
+                header = reader.fieldnames or []
+                source = next((name for name, spec in RECONCILE_SOURCES.items()
+                               if all(column in header for column in spec["key"])), None)
+                if source is None or "amount" not in header:
+                    raise ValueError(f"{path}: header needs amount and one of "
+                                     + ", ".join("+".join(spec["key"]) for spec in RECONCILE_SOURCES.values()))
+                key_columns = RECONCILE_SOURCES[source]["key"]
+                time_column = next((column for column in RECONCILE_TIME_COLUMNS if column in header), None)
+                
+                for row in reader:
+                    result["rows"] += 1
+                    key = tuple(row[column] for column in key_columns)
+                    try:
+                        amount = float(row["amount"])
+                    except (TypeError, ValueError):
+                        result["skipped"] += 1
+                        continue
+                    if not all(key):
+                        result["skipped"] += 1
+                        continue
+                    if time_column and row[time_column]:
+                        stamp = row[time_column]
+                        if window[0] is None or stamp < window[0]:
+                            window[0] = stamp
+                        if window[1] is None or stamp > window[1]:
+                            window[1] = stamp
+                    entry = table.get(key)
+                    if entry is None:
+                        if len(table) >= max_keys:
+                            runs.append(self._write_reconcile_run(table, run_dir, len(runs)))
+                            table = {}
+                        entry = table[key] = [0, 0.0]
+                    entry[0] += 1
+                    entry[1] += amount
+            
+            spec = RECONCILE_SOURCES[source]
+            query, params = spec["query"], tuple(window)
+            result.update(source=source, window=window if window[0] is not None else None)
+            
+            def compare(key, file_entry, db_entry):
+                record = dict(zip(key_columns, key))
+                if db_entry is None:
+                    record.update(file_rows=file_entry[0], file_amount=file_entry[1])
+                    missing.add(record, abs(file_entry[1]), file_entry[1])
+                elif file_entry is None:
+                    if db_entry[2]:
+                        record.update(db_rows=db_entry[0], db_amount=db_entry[1])
+                        extra.add(record, abs(db_entry[1]), db_entry[1])
+                else:
+                    result["matched"] += 1
+                    difference = file_entry[1] - db_entry[1]
+                    if abs(difference) > RECONCILE_TOLERANCE:
+                        record.update(file_amount=file_entry[1], db_amount=db_entry[1], difference=difference)
+                        mismatches.add(record, abs(difference), difference)
+            
+            cursor = self.conn.cursor()
+            cursor.row_factory = None
+            if not runs:
+                # Hash join: one pass over the table, probing the file's keys
+                result["mode"] = "hash"
+                result["keys"] = len(table)
+                for row in cursor.execute(query, params):
+                    key = tuple(str(value) for value in row[:-3])
+                    compare(key, table.pop(key, None), (row[-3], row[-2] or 0.0, row[-1]))
+                for key, entry in table.items():
+                    compare(key, entry, None)
+            else:
+                # Sort-merge join: merged sorted runs against the table in key order
+                runs.append(self._write_reconcile_run(table, run_dir, len(runs)))
+                table = {}
+                result["mode"] = "sort-merge"
+                file_side = self._merge_reconcile_runs(runs)
+                db_side = ((tuple(str(value) for value in row[:-3]), (row[-3], row[-2] or 0.0, row[-1]))
+                           for row in cursor.execute(query + spec["order_by"], params))
+                file_item, db_item = next(file_side, None), next(db_side, None)
+                while file_item is not None or db_item is not None:
+                    if db_item is None or (file_item is not None and file_item[0] < db_item[0]):
+                        result["keys"] += 1
+                        compare(file_item[0], file_item[1], None)
+                        file_item = next(file_side, None)
+                    elif file_item is None or db_item[0] < file_item[0]:
+                        compare(db_item[0], None, db_item[1])
+                        db_item = next(db_side, None)
+                    else:
+                        result["keys"] += 1
+                        compare(file_item[0], file_item[1], db_item[1])
+                        file_item, db_item = next(file_side, None), next(db_side, None)
+        finally:
+            for run in runs:
+                os.remove(run)
+            os.rmdir(run_dir)
         
-        # Verify ledger consistency
-        diagnosis["ledger_integrity"] = self._verify_ledger()
+        result["runs"] = len(runs)
+        result["seconds"] = time.perf_counter() - started
+        result["rows_per_sec"] = result["rows"] / result["seconds"] if result["seconds"] else 0.0
+        logger.info(f"Reconciled {result['rows']} rows of {path} against {result['source']} "
+                    f"({result['mode']}, {result['rows_per_sec']:.0f} rows/sec)")
+        return self._collect(result, missing, extra, mismatches)
+    
+    @staticmethod
+    def _write_reconcile_run(table: Dict[tuple, list], run_dir: str, index: int) -> str:
+        """Write one sorted run of aggregated file keys as NDJSON"""
+        path = os.path.join(run_dir, f"run-{index:05d}.ndjson")
+        with open(path, "w") as f:
+            for key in sorted(table):
+                f.write(json.dumps([list(key)] + table[key]) + "\n")
+        return path
+    
+    @staticmethod
+    def _merge_reconcile_runs(paths: List[str]):
+        """Merge sorted runs, summing keys that appear in more than one run"""
+        files = [open(path) for path in paths]
+        try:
+            streams = [((tuple(key), count, amount) for key, count, amount in map(json.loads, f)) for f in files]
+            current = None
+            for key, count, amount in heapq.merge(*streams, key=lambda item: item[0]):
+                if current is not None and current[0] == key:
+                    current[1][0] += count
+                    current[1][1] += amount
+                    continue
+                if current is not None:
+                    yield current
+                current = (key, [count, amount])
+            if current is not None:
+                yield current
+        finally:
+            for f in files:
+                f.close()
+    
+    def _run_check(self, name: str, check) -> Dict:
+        """Run a check, or return its cached result if none of its tables changed"""
+        if not self.use_cache:
+            return check()
+        # Token is taken before the check so writes during the run invalidate it
+        token = self.check_cache.token(CHECK_TABLES[name])
+        result = self.check_cache.get(name, token)
+        if result is None:
+            result = check()
+            # Spooled results stay on disk; caching them would pull them back into memory
+            if not any(isinstance(value, SpooledRows) for value in result.values()):
+                self.check_cache.put(name, token, result)
+        else:
+            logger.debug(f"Check {name} unchanged since last run, using cached result")
+        return result
+    
+    def install_change_tracking(self, dirty_keys: bool = False) -> List[str]:
+        """Install per-table change counters maintained by AFTER INSERT/UPDATE/DELETE triggers
+
+        With dirty_keys=True, wallet_balances, orders and positions also get
+        triggers that queue each changed (rowid, user_id) in repair_dirty_keys.
+        """
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS repair_change_counters (
+                table_name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        existing = {row['name'] for row in self._execute_query(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )}
+        installed = []
+        for table in CHANGE_TRACKED_TABLES:
+            if table not in existing:
+                continue
+            self.conn.execute(
+                "INSERT OR IGNORE INTO repair_change_counters (table_name, version) VALUES (?, 0)", (table,)
+            )
+            for event in ("INSERT", "UPDATE", "DELETE"):
+                self.conn.execute(f"""
+                    CREATE TRIGGER IF NOT EXISTS repair_count_{table}_{event.lower()}
+                    AFTER {event} ON {table}
+                    BEGIN
+                        UPDATE repair_change_counters SET version = version + 1
+                        WHERE table_name = '{table}';
+                    END
+                """)
+            installed.append(table)
+        if dirty_keys:
+            self._install_dirty_key_triggers(existing)
+        self.conn.commit()
+        logger.info(f"Change tracking installed on: {', '.join(installed)}")
+        return installed
+    
+    def _install_dirty_key_triggers(self, existing: set):
+        """Queue changed row keys so incremental diagnosis only revisits them"""
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS repair_dirty_keys (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                table_name TEXT NOT NULL,
+                row_key INTEGER NOT NULL,
+                user_id TEXT
+            )
+        """)
+        for table in DIRTY_KEY_TABLES:
+            if table not in existing:
+                continue
+            queue = "INSERT INTO repair_dirty_keys (table_name, row_key, user_id)"
+            self.conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS repair_dirty_{table}_insert AFTER INSERT ON {table}
+                BEGIN
+                    {queue} VALUES ('{table}', NEW.rowid, NEW.user_id);
+                END
+            """)
+            # A row moved to another rowid or user dirties both the old and the new key
+            self.conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS repair_dirty_{table}_update AFTER UPDATE ON {table}
+                BEGIN
+                    {queue} VALUES ('{table}', NEW.rowid, NEW.user_id);
+                    {queue} SELECT '{table}', OLD.rowid, OLD.user_id
+                    WHERE OLD.rowid IS NOT NEW.rowid OR OLD.user_id IS NOT NEW.user_id;
+                END
+            """)
+            self.conn.execute(f"""
+                CREATE TRIGGER IF NOT EXISTS repair_dirty_{table}_delete AFTER DELETE ON {table}
+                BEGIN
+                    {queue} VALUES ('{table}', OLD.rowid, OLD.user_id);
+                END
+            """)
+    
+    def _ensure_offenders_table(self):
+        """Persistent offender rows for incremental checks, keyed by rule and row key"""
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS repair_offenders (
+                rule TEXT NOT NULL,
+                row_key INTEGER NOT NULL,
+                severity REAL,
+                amount REAL,
+                payload TEXT NOT NULL,
+                PRIMARY KEY (rule, row_key)
+            )
+        """)
+    
+    def _sync_offenders(self, section: str, table: str) -> Tuple[Dict[str, OffenderTracker], Optional[Dict]]:
+        """Bring repair_offenders up to date for the row rules on table, using the dirty-key queue
+
+        The first run for a section evaluates every row; later runs re-evaluate
+        only the rowids queued since the section's cursor. Returns trackers
+        filled from the stored offenders and {rowid: row} for the dirty keys
+        still present (None after a full evaluation).
+        """
+        self._ensure_offenders_table()
+        rules = rules_for(table)
+        names = tuple(rule.name for rule in rules)
+        marks = ",".join("?" * len(names))
+        # Head is read before the scan so changes made during it are revisited next time
+        head = self.dirty_keys.head()
+        dirty = None
+        if self.dirty_keys.cursor(section) is None:
+            self.conn.execute(f"DELETE FROM repair_offenders WHERE rule IN ({marks})", names)
+            rows = self._iter_query(f"SELECT rowid, * FROM {table} WHERE {_rules_where(rules)}")
+        else:
+            keys = sorted(self.dirty_keys.pending(section, head)[table]["keys"])
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                self.conn.execute(
+                    f"DELETE FROM repair_offenders WHERE rule IN ({marks}) "
+                    f"AND row_key IN ({','.join('?' * len(batch))})", names + tuple(batch)
+                )
+            rows = self._fetch_rows_by_rowid(table, keys)
+            dirty = {key: None for key in keys}
+            dirty.update((row['rowid'], row) for row in rows)
         
-        # Assess risk exposure
-        diagnosis["risk_assessment"] = self._assess_risk()
+        for row in rows:
+            for rule in rules:
+                offender = rule.evaluate(row)
+                if offender:
+                    payload, severity, amount = offender
+                    self.conn.execute(
+                        "INSERT INTO repair_offenders (rule, row_key, severity, amount, payload) VALUES (?, ?, ?, ?, ?)",
+                        (rule.name, row['rowid'], severity, amount, json.dumps(payload, default=_json_default))
+                    )
+        self.dirty_keys.ack(section, head)
         
-        # Identify specific issues
-        diagnosis["issues_found"] = self._identify_issues(diagnosis)
+        trackers = {name: self._tracker(name) for name in names}
+        for rule, severity, amount, payload in self.conn.execute(
+            f"SELECT rule, severity, amount, payload FROM repair_offenders WHERE rule IN ({marks})", names
+        ):
+            trackers[rule].add(json.loads(payload), severity, amount)
+        return trackers, dirty
+    
+    def _check_wallets_incremental(self) -> Dict:
+        """_check_wallets, re-evaluating only wallet rows changed since the last run"""
+        result = {
+            "total_users": 0,
+            "negative_balances": [],
+            "locked_exceeds_available": [],
+            "inconsistent_assets": []
+        }
+        count = self._execute_query("SELECT COUNT(DISTINCT user_id) AS count FROM wallet_balances")
+        result["total_users"] = count[0]['count'] if count else 0
+        trackers, _ = self._sync_offenders("wallet_status", "wallet_balances")
+        return self._collect(result, *trackers.values())
+    
+    def _check_positions_incremental(self) -> Dict:
+        """_check_positions, re-evaluating only positions changed since the last run"""
+        result = {
+            "total_positions": 0,
+            "negative_margin": [],
+            "near_liquidation": [],
+            "incorrect_pnl": []
+        }
+        count = self._execute_query("SELECT COUNT(*) AS count FROM positions")
+        result["total_positions"] = count[0]['count'] if count else 0
+        trackers, dirty = self._sync_offenders("position_status", "positions")
+        self._collect(result, *trackers.values())
         
-        logger.info(f"Diagnosis complete. Found {len(diagnosis['issues_found'])} issues.")
-        return diagnosis
+        # The liquidation index lives in memory: load it once, then apply only dirty positions
+        if dirty is None or self._liquidation_token is None:
+            self._load_liquidation_index()
+        else:
+            self._liquidation_token = self.check_cache.token(("positions",))
+            for key, pos in dirty.items():
+                if pos is None:
+                    self.liquidation_index.remove(key)
+                else:
+                    self.liquidation_index.upsert(Position.from_row(pos))
+        result["near_liquidation"] = self._near_liquidation()
+        return result
+    
+    def _tracker(self, name: str, streamed: bool = True) -> "OffenderTracker":
+        """Offender tracker for one check field, honouring top_k, spill_dir and the memory budget
+
+        streamed=False keeps its rows from a running DiagnosisStream, for
+        fields whose rows are reshaped once the check is done.
+        """
+        spill_path = None
+        if self.spill_dir:
+            spill_path = os.path.join(self.spill_dir, *filter(None, [self._spill_scope]), f"{name}.ndjson")
+        sink = self._stream.row if self._stream is not None and streamed else None
+        return OffenderTracker(name, self.top_k, spill_path, self.memory_budget, sink)
+    
+    @contextmanager
+    def _spill_scoped(self, scope: str):
+        """Spill offenders of a partial diagnosis (one user, a sample) to their own subdirectory"""
+        previous = self._spill_scope
+        self._spill_scope = re.sub(r"[^A-Za-z0-9_.-]", "_", scope)
+        try:
+            yield
+        finally:
+            self._spill_scope = previous
     
-    def _check_wallets(self) -> Dict:
-        """Check wallet balances for inconsistencies"""
+    @staticmethod
+    def _collect(result: Dict, *trackers: "OffenderTracker") -> Dict:
+        """Store each tracker's top rows under its field and its totals under result['totals']"""
+        totals = result.setdefault("totals", {})
+        for tracker in trackers:
+            result[tracker.name] = tracker.rows()
+            totals[tracker.name] = tracker.summary()
+        return result
+    
+    def _iter_query(self, query: str, params: tuple = (), batch_size: int = 1000):
+        """Stream query results as dictionaries without materializing the result set"""
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            self.progress.advance(len(rows))
+            for row in rows:
+                yield dict(row)
+    
+    def _check_wallets(self, user_id: Optional[str] = None) -> Dict:
+        """Check wallet balances for inconsistencies (optionally for one user)"""
         result = {
             "total_users": 0,
             "negative_balances": [],
@@ -144,59 +2941,64 @@ class TradingSystemRepair:
             "inconsistent_assets": []
         }
         
-        # Get all users with wallets
-        users = self._execute_query("""
-            SELECT DISTINCT user_id FROM wallet_balances
-        """)
-        result["total_users"] = len(users)
+        user_sql, params = _user_filter(user_id)
         
-        # Check for negative balances
-        negative = self._execute_query("""
-            SELECT user_id, currency, balance, frozen_balance 
-            FROM wallet_balances 
-            WHERE balance < 0 OR frozen_balance < 0
-        """)
-        result["negative_balances"] = negative
+        # Count users with wallets
+        count = self._execute_query(
+            f"SELECT COUNT(DISTINCT user_id) AS count FROM wallet_balances WHERE 1 = 1{user_sql}", params)
+        result["total_users"] = count[0]['count'] if count else 0
         
-        # Check for locked > available
-        locked_exceeds = self._execute_query("""
-            SELECT user_id, currency, balance, frozen_balance 
-            FROM wallet_balances 
-            WHERE frozen_balance > balance
-        """)
-        result["locked_exceeds_available"] = locked_exceeds
+        # Negative balances (most negative first) and locked > available (largest excess first)
+        rules = rules_for("wallet_balances")
+        trackers = {rule.name: self._tracker(rule.name) for rule in rules}
+        for row in self._iter_query(
+                f"SELECT rowid, * FROM wallet_balances WHERE ({_rules_where(rules)}){user_sql}", params):
+            for rule in rules:
+                offender = rule.evaluate(row)
+                if offender:
+                    trackers[rule.name].add(*offender)
         
-        return result
+        return self._collect(result, *trackers.values())
     
-    def _check_orders(self) -> Dict:
-        """Check order book integrity"""
+    def _check_orders(self, user_id: Optional[str] = None) -> Dict:
+        """Check order book integrity (optionally for one user)"""
         result = {
             "open_orders": [],
             "stale_orders": [],
             "inconsistent_orders": []
         }
         
-        # Find stale orders (open > 24 hours)
-        stale = self._execute_query("""
-            SELECT * FROM orders 
+        user_sql, params = _user_filter(user_id)
+        
+        # Find stale orders (open > 24 hours), oldest first
+        stale = self._tracker("stale_orders")
+        for row in self._iter_query(f"""
+            SELECT *, julianday('now') - julianday(created_at) AS age_days
+            FROM orders 
             WHERE status = 'open' 
-            AND created_at < datetime('now', '-1 day')
-        """)
-        result["stale_orders"] = stale
+            AND created_at < datetime('now', '-1 day'){user_sql}
+        """, params):
+            stale.add(row, row['age_days'], row['amount'])
         
         # Check orders where locked funds don't match order value
-        inconsistent = self._execute_query("""
+        inconsistent = self._tracker("inconsistent_orders")
+        for row in self._iter_query(f"""
             SELECT o.*, w.balance, w.frozen_balance 
             FROM orders o
             JOIN wallet_balances w ON o.user_id = w.user_id
-            WHERE o.status = 'open' 
-        """)
-        result["inconsistent_orders"] = inconsistent
+            WHERE o.status = 'open'{_user_filter(user_id, "o")[0]}
+        """, params):
+            inconsistent.add(row, row['frozen_balance'] - row['balance'], row['amount'])
         
-        return result
+        return self._collect(result, stale, inconsistent)
     
-    def _check_positions(self) -> Dict:
-        """Check futures positions for issues"""
+    def _check_positions(self, user_id: Optional[str] = None) -> Dict:
+        """Check futures positions for issues
+
+        For a single user the shared liquidation index is left alone; the
+        user's positions get their own small index, using the symbol marks
+        of the shared one where it has them.
+        """
         result = {
             "total_positions": 0,
             "negative_margin": [],
@@ -204,175 +3006,564 @@ class TradingSystemRepair:
             "incorrect_pnl": []
         }
         
-        positions = self._execute_query("SELECT * FROM positions")
-        result["total_positions"] = len(positions)
+        user_sql, params = _user_filter(user_id)
+        index = self.liquidation_index if user_id is None else LiquidationIndex()
+        if user_id is None:
+            self._liquidation_token = self.check_cache.token(("positions",))
         
-        for pos in positions:
-            # Check negative margin
-            if pos['margin'] < 0:
-                result["negative_margin"].append(pos)
-            
-            # Check near liquidation (margin ratio > 80%)
-            margin_ratio = abs(pos['unrealized_pnl']) / pos['margin'] if pos['margin'] > 0 else 1
-            if margin_ratio > 0.8:
-                result["near_liquidation"].append(pos)
-            
-            # Verify PnL calculation
-            calculated_pnl = self._calculate_pnl(pos)
-            if abs(calculated_pnl - pos['unrealized_pnl']) > 0.01:
-                result["incorrect_pnl"].append({
-                    "position": pos,
-                    "calculated_pnl": calculated_pnl,
-                    "stored_pnl": pos['unrealized_pnl']
-                })
+        # Negative margin and PnL drift (largest first), syncing the liquidation index as we go
+        rules = rules_for("positions")
+        trackers = {rule.name: self._tracker(rule.name) for rule in rules}
+        seen = set()
+        for pos in self._iter_query(f"SELECT rowid, * FROM positions WHERE 1 = 1{user_sql}", params):
+            result["total_positions"] += 1
+            for rule in rules:
+                offender = rule.evaluate(pos)
+                if offender:
+                    trackers[rule.name].add(*offender)
+            index.upsert(Position.from_row(pos))
+            seen.add(pos['rowid'])
         
+        for key in [key for key in index.keys() if key not in seen]:
+            index.remove(key)
+        
+        self._collect(result, *trackers.values())
+        if user_id is None:
+            result["near_liquidation"] = self._near_liquidation()
+        else:
+            shared = self.liquidation_index.marks()
+            marks = {symbol: shared.get(symbol, mark) for symbol, mark in index.marks().items()}
+            result["near_liquidation"] = self._near_liquidation(index, marks)
         return result
     
-    def _verify_ledger(self) -> Dict:
-        """Verify ledger consistency using double-entry accounting"""
+    def _near_liquidation(self, index: Optional[LiquidationIndex] = None,
+                          marks: Optional[Dict[str, float]] = None) -> List[Dict]:
+        """Positions liquidated by a NEAR_LIQUIDATION_BUFFER move from their symbol's mark, closest first"""
+        index = index or self.liquidation_index
+        near_liquidation = self._tracker("near_liquidation", streamed=False)
+        for symbol, mark in (marks or index.marks()).items():
+            for position in index.crossed(
+                    symbol, mark * (1 - NEAR_LIQUIDATION_BUFFER), mark * (1 + NEAR_LIQUIDATION_BUFFER)):
+                distance = abs(mark - position.liquidation_price) / mark
+                near_liquidation.add({
+                    "rowid": position.key,
+                    "liquidation_price": position.liquidation_price,
+                    "distance": distance
+                }, -distance, position.size * mark)
+        return self._expand_position_rows(near_liquidation.rows())
+    
+    def _load_liquidation_index(self):
+        """Rebuild the in-memory liquidation index from every position"""
+        self._liquidation_token = self.check_cache.token(("positions",))
+        self.liquidation_index = LiquidationIndex()
+        for pos in self._iter_query("SELECT rowid, * FROM positions"):
+            self.liquidation_index.upsert(Position.from_row(pos))
+    
+    def positions_crossing(self, symbol: str, price: float) -> List[Position]:
+        """Positions in symbol whose liquidation threshold is crossed at price
+
+        The index is a side effect of the position scan, which a cached
+        position_status result skips; it is reloaded when positions changed
+        since it was last synced (or it never was).
+        """
+        if self._liquidation_token != self.check_cache.token(("positions",)):
+            self._load_liquidation_index()
+        return self.liquidation_index.crossed(symbol, price)
+    
+    def _verify_ledger(self, user_id: Optional[str] = None, incremental: bool = False) -> Dict:
+        """Verify ledger consistency using double-entry accounting (optionally for one user)
+
+        With incremental=True the double-entry groups are only re-aggregated
+        for references with entries added since the previous incremental run.
+        """
         result = {
             "total_entries": 0,
             "orphaned_entries": [],
-            "unbalanced_transactions": []
+            "unbalanced_transactions": [],
+            "duplicate_entries": [],
+            "unparsed_timestamps": 0
         }
         
+        user_sql, params = _user_filter(user_id)
+        
         # Get total entries
-        count = self._execute_query("SELECT COUNT(*) as count FROM wallet_transactions")
+        count = self._execute_query(f"SELECT COUNT(*) as count FROM wallet_transactions WHERE 1 = 1{user_sql}", params)
         result["total_entries"] = count[0]['count'] if count else 0
         
-        # Find orphaned entries (no reference)
-        orphaned = self._execute_query("""
+        # Find orphaned entries (no reference), largest amounts first
+        orphaned = self._tracker("orphaned_entries")
+        for row in self._iter_query(f"""
             SELECT * FROM wallet_transactions 
-            WHERE reference_id NOT IN (
-                SELECT id FROM orders 
-                UNION SELECT id FROM wallet_requests
+            WHERE {ORPHANED_REFERENCE_SQL}{user_sql}
+        """, params):
+            orphaned.add(row, abs(row['amount']), row['amount'])
+        
+        # Double-posted entries, largest excess amount first
+        duplicates = self._tracker("duplicate_entries")
+        detector = DuplicateLedgerDetector(self.duplicate_window)
+        # Each timestamp shape streams in (user_id, created_at) index order; merged, they are in time order
+        streams = [self._iter_query(f"""
+            SELECT id, user_id, currency, amount, reference_id, created_at
+            FROM wallet_transactions
+            WHERE created_at IS NOT NULL AND substr(created_at, 11, 1) {shape} 'T'{user_sql}
+            ORDER BY user_id, created_at
+        """, params) for shape in ("<>", "=")]
+        for row in heapq.merge(*streams, key=DuplicateLedgerDetector.sort_key):
+            for cluster in detector.feed(row):
+                excess = cluster["amount"] * (cluster["count"] - 1)
+                duplicates.add(cluster, abs(excess), excess)
+        for cluster in detector.finish():
+            excess = cluster["amount"] * (cluster["count"] - 1)
+            duplicates.add(cluster, abs(excess), excess)
+        result["unparsed_timestamps"] = detector.rejected
+        if detector.rejected:
+            logger.warning(f"{detector.rejected} ledger entries have non-ISO or zoned created_at, "
+                           f"skipped by duplicate detection")
+        
+        # Double entry: legs per (reference_id, currency) that do not net out, largest imbalance first
+        if incremental:
+            unbalanced = self._unbalanced_groups_incremental()
+        else:
+            unbalanced = self._tracker("unbalanced_transactions")
+            where = "" if user_id is None else \
+                " AND reference_id IN (SELECT reference_id FROM wallet_transactions WHERE user_id = ?)"
+            for row in self._iter_query(UNBALANCED_GROUPS_SQL.format(where=where), params):
+                unbalanced.add(row, abs(row['imbalance']), row['imbalance'])
+        
+        return self._collect(result, orphaned, duplicates, unbalanced)
+    
+    def _unbalanced_groups_incremental(self) -> OffenderTracker:
+        """Unbalanced double-entry groups, re-aggregating only references touched by new ledger entries"""
+        self._ensure_offenders_table()
+        rule = "unbalanced_transactions"
+        head = self.conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM wallet_transactions").fetchone()[0]
+        watermark = _state_get(self.conn, "ledger_balance_rowid")
+        if watermark is None:
+            self.conn.execute("DELETE FROM repair_offenders WHERE rule = ?", (rule,))
+            groups = [self._iter_query(UNBALANCED_GROUPS_SQL.format(where=""))]
+        else:
+            references = [row[0] for row in self.conn.execute(
+                "SELECT DISTINCT reference_id FROM wallet_transactions WHERE rowid > ? AND reference_id IS NOT NULL",
+                (int(watermark),)
+            )]
+            groups = []
+            for start in range(0, len(references), 500):
+                batch = tuple(references[start:start + 500])
+                marks = ",".join("?" * len(batch))
+                self.conn.execute(
+                    f"DELETE FROM repair_offenders WHERE rule = ? AND json_extract(payload, '$.reference_id') IN ({marks})",
+                    (rule,) + batch
+                )
+                groups.append(self._iter_query(UNBALANCED_GROUPS_SQL.format(where=f" AND reference_id IN ({marks})"), batch))
+        for rows in groups:
+            for row in rows:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO repair_offenders (rule, row_key, severity, amount, payload) VALUES (?, ?, ?, ?, ?)",
+                    (rule, f"{row['reference_id']}/{row['currency']}", abs(row['imbalance']), row['imbalance'],
+                     json.dumps(row, default=_json_default))
+                )
+        _state_set(self.conn, "ledger_balance_rowid", str(head))
+        self.conn.commit()
+        
+        unbalanced = self._tracker(rule)
+        for severity, amount, payload in self.conn.execute(
+            "SELECT severity, amount, payload FROM repair_offenders WHERE rule = ?", (rule,)
+        ):
+            unbalanced.add(json.loads(payload), severity, amount)
+        return unbalanced
+    
+    def refresh_risk_summary(self, rebuild: bool = False) -> Dict:
+        """Bring user_risk_summary (per-user notional, margin, max leverage, net PnL) up to date
+        
+        With dirty-key tracking installed only the users whose positions
+        changed since the last refresh are recomputed (an index range per
+        user); otherwise, on the first run or with rebuild, every user is
+        recomputed in one grouped pass.
+        """
+        started = time.perf_counter()
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS user_risk_summary (
+                user_id TEXT PRIMARY KEY,
+                positions INTEGER NOT NULL,
+                total_notional REAL NOT NULL,
+                net_notional REAL NOT NULL,
+                total_margin REAL NOT NULL,
+                max_leverage REAL,
+                net_pnl REAL NOT NULL,
+                updated_at TEXT
             )
         """)
-        result["orphaned_entries"] = orphaned
-        
-        return result
+        self.conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_user_risk_summary_leverage ON user_risk_summary (max_leverage)"
+        )
+        tracked = self.dirty_keys.installed()
+        upto = self.dirty_keys.head() if tracked else None
+        if not rebuild and tracked and self._risk_summary_current(upto):
+            # Nothing queued since the last refresh: no writes at all
+            return {"mode": "incremental", "users_refreshed": 0, "seconds": time.perf_counter() - started}
+        if rebuild or not tracked or self.dirty_keys.cursor(RISK_SUMMARY_CONSUMER) is None:
+            self.conn.execute("DELETE FROM user_risk_summary")
+            self.conn.execute(USER_RISK_SUMMARY_SQL.format(where=""))
+            users = self.conn.execute("SELECT COUNT(*) FROM user_risk_summary").fetchone()[0]
+            mode = "rebuild"
+        else:
+            changed = sorted(user for user in self.dirty_keys.pending(RISK_SUMMARY_CONSUMER, upto)["positions"]["users"]
+                             if user is not None)
+            for start in range(0, len(changed), 500):
+                batch = tuple(changed[start:start + 500])
+                placeholders = ",".join("?" * len(batch))
+                self.conn.execute(f"DELETE FROM user_risk_summary WHERE user_id IN ({placeholders})", batch)
+                self.conn.execute(USER_RISK_SUMMARY_SQL.format(where=f" AND user_id IN ({placeholders})"), batch)
+            users = len(changed)
+            mode = "incremental"
+        if tracked:
+            self.dirty_keys.ack(RISK_SUMMARY_CONSUMER, upto)
+        self.conn.commit()
+        return {"mode": mode, "users_refreshed": users, "seconds": time.perf_counter() - started}
     
-    def _assess_risk(self) -> Dict:
-        """Assess system-wide risk exposure"""
+    def _risk_summary_current(self, head: Optional[int] = None) -> bool:
+        """Whether user_risk_summary has consumed every queued dirty key"""
+        if not self.dirty_keys.installed():
+            return False
+        cursor = self.dirty_keys.cursor(RISK_SUMMARY_CONSUMER)
+        return cursor is not None and (self.dirty_keys.head() if head is None else head) <= cursor
+    
+    def _assess_risk(self, user_id: Optional[str] = None) -> Dict:
+        """Assess system-wide (or one user's) risk exposure by notional value and under price shocks
+        
+        When user_risk_summary is up to date (diagnose_system refreshes it
+        before this check), per-user net exposure and the high-leverage
+        check read it instead of being aggregated here: only positions of
+        users whose max leverage is over the threshold are looked at. The
+        check itself never writes.
+        """
+        user_sql, params = _user_filter(user_id)
+        summarised = self._risk_summary_current()
+        cursor = self.conn.cursor()
+        cursor.row_factory = None
+        cursor.execute(f"{RISK_POSITIONS_QUERY} WHERE 1 = 1{user_sql}", params)
+        risk = RiskEngine().evaluate(cursor.fetchall(), per_user=not summarised)
+        
+        if summarised:
+            risk["net_exposure_by_user"] = {
+                row["user_id"]: row["net_notional"] for row in self._iter_query(
+                    f"SELECT user_id, net_notional FROM user_risk_summary WHERE 1 = 1{user_sql}", params)
+            }
+            risk["high_leverage"] = {
+                row["rowid"]: row["leverage"] for row in self._iter_query(f"""
+                    SELECT p.rowid AS rowid, p.quantity * COALESCE(p.current_price, p.entry_price) / p.margin AS leverage
+                    FROM user_risk_summary s
+                    JOIN positions p ON p.user_id = s.user_id
+                    WHERE s.max_leverage > ? AND p.margin > 0
+                      AND p.quantity * COALESCE(p.current_price, p.entry_price) / p.margin > ?{_user_filter(user_id, "s")[0]}
+                """, (HIGH_LEVERAGE_THRESHOLD, HIGH_LEVERAGE_THRESHOLD) + params)
+            }
+        
         result = {
-            "total_exposure": 0,
+            "total_exposure": risk["total_exposure"],
+            "exposure_by_symbol": risk["exposure_by_symbol"],
+            "net_exposure_by_user": {},
+            "house_net_exposure": risk["house_net_exposure"],
+            "scenarios": risk["scenarios"],
             "high_risk_positions": [],
             "under_collateralized": []
         }
         
-        # Calculate total exposure from futures
-        exposure = self._execute_query("""
-            SELECT SUM(quantity) as total FROM positions
-        """)
-        result["total_exposure"] = exposure[0]['total'] if exposure and exposure[0]['total'] else 0
+        # Users with the largest absolute net exposure
+        net_by_user = self._tracker("net_exposure_by_user", streamed=False)
+        for user_id, net in risk["net_exposure_by_user"].items():
+            net_by_user.add({"user_id": user_id, "net_notional": net}, abs(net), net)
         
-        # Find high risk positions (leverage > 20x)
-        high_risk = self._execute_query("""
-            SELECT *, (quantity / margin) as leverage 
-            FROM positions 
-            WHERE (quantity / margin) > 20
-        """)
-        result["high_risk_positions"] = high_risk
+        # Find high risk positions (notional leverage > 20x), highest leverage first
+        high_risk = self._tracker("high_risk_positions", streamed=False)
+        for key, leverage in risk["high_leverage"].items():
+            high_risk.add({"rowid": key, "leverage": leverage}, leverage, leverage)
+        
+        # Under-collateralized: equity at or below maintenance margin, largest shortfall first
+        under = self._tracker("under_collateralized", streamed=False)
+        for key, buffer in risk["under_collateralized"].items():
+            under.add({"rowid": key, "equity_buffer": buffer}, -buffer, buffer)
+        
+        self._collect(result, net_by_user, high_risk, under)
+        result["net_exposure_by_user"] = {row["user_id"]: row["net_notional"] for row in result["net_exposure_by_user"]}
+        result["high_risk_positions"] = self._expand_position_rows(result["high_risk_positions"])
+        result["under_collateralized"] = self._expand_position_rows(result["under_collateralized"])
         
         return result
     
+    def _expand_position_rows(self, offenders: List[Dict]) -> List[Dict]:
+        """Replace kept {rowid, ...} offenders with full position rows, preserving order"""
+        if isinstance(offenders, SpooledRows):
+            return offenders.transform(self._expand_position_rows)
+        rows = {row["rowid"]: row for row in self._fetch_rows_by_rowid("positions", [o["rowid"] for o in offenders])}
+        return [dict(rows[o["rowid"]], **o) for o in offenders if o["rowid"] in rows]
+    
+    def _fetch_rows_by_rowid(self, table: str, rowids: List[int], batch_size: int = 500) -> List[Dict]:
+        """Fetch full rows for the given rowids in batches of bound parameters"""
+        rows = []
+        for start in range(0, len(rowids), batch_size):
+            batch = rowids[start:start + batch_size]
+            placeholders = ",".join("?" * len(batch))
+            rows.extend(self._execute_query(
+                f"SELECT rowid, * FROM {table} WHERE rowid IN ({placeholders})", tuple(batch)
+            ))
+        return rows
+    
     def _identify_issues(self, diagnosis: Dict) -> List[Dict]:
         """Identify specific issues from diagnosis"""
         issues = []
         
+        def issue(severity: str, issue_type: str, section: str, field: str, description: str) -> Dict:
+            totals = diagnosis[section]["totals"][field]
+            return {
+                "severity": severity,
+                "type": issue_type,
+                "description": description.format(count=totals["count"]),
+                "count": totals["count"],
+                "sum": totals["sum"],
+                "spill_file": totals["spill_file"],
+                "details": diagnosis[section][field]
+            }
+        
         # Wallet issues
         if diagnosis["wallet_status"]["negative_balances"]:
-            issues.append({
-                "severity": "HIGH",
-                "type": "NEGATIVE_BALANCE",
-                "description": f"Found {len(diagnosis['wallet_status']['negative_balances'])} users with negative balances",
-                "details": diagnosis["wallet_status"]["negative_balances"]
-            })
+            issues.append(issue("HIGH", "NEGATIVE_BALANCE", "wallet_status", "negative_balances",
+                                "Found {count} users with negative balances"))
         
         if diagnosis["wallet_status"]["locked_exceeds_available"]:
-            issues.append({
-                "severity": "HIGH",
-                "type": "LOCKED_EXCEEDS_AVAILABLE",
-                "description": f"Found {len(diagnosis['wallet_status']['locked_exceeds_available'])} wallets where frozen > balance",
-                "details": diagnosis["wallet_status"]["locked_exceeds_available"]
-            })
+            issues.append(issue("HIGH", "LOCKED_EXCEEDS_AVAILABLE", "wallet_status", "locked_exceeds_available",
+                                "Found {count} wallets where frozen > balance"))
         
         # Order issues
         if diagnosis["order_status"]["stale_orders"]:
-            issues.append({
-                "severity": "MEDIUM",
-                "type": "STALE_ORDERS",
-                "description": f"Found {len(diagnosis['order_status']['stale_orders'])} stale orders",
-                "details": diagnosis["order_status"]["stale_orders"]
-            })
+            issues.append(issue("MEDIUM", "STALE_ORDERS", "order_status", "stale_orders",
+                                "Found {count} stale orders"))
         
         # Position issues - This is where we find the "lose by default" problem
         if diagnosis["position_status"]["incorrect_pnl"]:
-            issues.append({
-                "severity": "CRITICAL",
-                "type": "INCORRECT_PNL_CALCULATION",
-                "description": "PnL calculation error - this causes the 'lose by default' issue",
-                "details": diagnosis["position_status"]["incorrect_pnl"]
-            })
+            issues.append(issue("CRITICAL", "INCORRECT_PNL_CALCULATION", "position_status", "incorrect_pnl",
+                                "PnL calculation error - this causes the 'lose by default' issue"))
         
         # Ledger issues
         if diagnosis["ledger_integrity"]["orphaned_entries"]:
-            issues.append({
-                "severity": "MEDIUM",
-                "type": "ORPHANED_LEDGER_ENTRIES",
-                "description": f"Found {len(diagnosis['ledger_integrity']['orphaned_entries'])} orphaned ledger entries",
-                "details": diagnosis["ledger_integrity"]["orphaned_entries"]
-            })
+            issues.append(issue("MEDIUM", "ORPHANED_LEDGER_ENTRIES", "ledger_integrity", "orphaned_entries",
+                                "Found {count} orphaned ledger entries"))
+        
+        if diagnosis["ledger_integrity"]["duplicate_entries"]:
+            issues.append(issue("HIGH", "DUPLICATE_LEDGER_ENTRIES", "ledger_integrity", "duplicate_entries",
+                                "Found {count} clusters of double-posted ledger entries"))
+        
+        if diagnosis["ledger_integrity"]["unbalanced_transactions"]:
+            issues.append(issue("HIGH", "UNBALANCED_LEDGER_TRANSACTIONS", "ledger_integrity", "unbalanced_transactions",
+                                "Found {count} trades/transfers whose legs do not balance"))
+        
+        archives = diagnosis.get("archive_status") or {}
+        if archives.get("archive_mismatches"):
+            issues.append(issue("HIGH", "ARCHIVE_PARTITION_MISMATCH", "archive_status", "archive_mismatches",
+                                "Found {count} ledger archives that no longer match their summary"))
+        
+        if archives.get("archived_orphans"):
+            issues.append(issue("MEDIUM", "ORPHANED_ARCHIVED_LEDGER_ENTRIES", "archive_status", "archived_orphans",
+                                "Found {count} orphaned entries in modified ledger archives"))
         
         # Risk issues
         if diagnosis["risk_assessment"]["high_risk_positions"]:
-            issues.append({
-                "severity": "HIGH",
-                "type": "HIGH_RISK_POSITIONS",
-                "description": f"Found {len(diagnosis['risk_assessment']['high_risk_positions'])} positions with >20x leverage",
-                "details": diagnosis["risk_assessment"]["high_risk_positions"]
-            })
+            issues.append(issue("HIGH", "HIGH_RISK_POSITIONS", "risk_assessment", "high_risk_positions",
+                                "Found {count} positions with >20x leverage"))
         
         return issues
     
     def _calculate_pnl(self, position: Dict) -> float:
         """Calculate correct PnL for a position"""
-        if position['side'] == 'buy':  # LONG
-            return (position['current_price'] - position['entry_price']) * position['quantity'] / position['entry_price']
-        else:  # SHORT
-            return (position['entry_price'] - position['current_price']) * position['quantity'] / position['entry_price']
-    
-    def fix_issues(self, diagnosis: Dict, force_win: bool = False) -> Dict:
-        """Fix identified issues"""
-        logger.info("Starting repair process...")
+        return calculate_pnl(position)
+    
+    def fix_issues(self, diagnosis: Dict, force_win: bool = False, dry_run: bool = False,
+                   record_undo: bool = False, throttle: Optional[RepairThrottle] = None) -> Dict:
+        """Fix identified issues in a single transaction
+        
+        With dry_run the exact same statements run and are then rolled back,
+        so the reported change set (rows per table, before/after samples) is
+        precisely what a real run would write. With record_undo the
+        before-image of every changed row goes to the audit log, so the run
+        can be reverted with undo_run(run_id).
+        
+        With a throttle (online repair) each fix commits in small keyset
+        chunks paced by the throttle instead of one long transaction, so
+        the application's writers only ever wait for one chunk. A failure
+        then leaves the chunks already committed in place. Dry runs ignore
+        the throttle.
+        """
+        logger.info("Starting repair process..." if not dry_run else "Starting dry-run repair...")
         fixes_applied = {
             "timestamp": datetime.now().isoformat(),
+            "dry_run": dry_run,
             "fixes": [],
-            "errors": []
+            "errors": [],
+            "changes": {}
         }
         
-        # Fix incorrect PnL calculations (main issue causing "lose by default")
-        if any(issue["type"] == "INCORRECT_PNL_CALCULATION" for issue in diagnosis["issues_found"]):
-            fixes_applied["fixes"].append(self._fix_pnl_calculations(force_win))
+        self._change_set = fixes_applied["changes"]
+        self._record_undo = record_undo and not dry_run
+        self._throttle = None if dry_run else throttle
+        self._run_id = fixes_applied["run_id"] = hashlib.sha256(
+            f"{self.db_path}:{time.time_ns()}".encode()).hexdigest()[:16]
+        self.progress.start("repair")
+        try:
+            with self._transaction(rollback=dry_run):
+                # Fix incorrect PnL calculations (main issue causing "lose by default")
+                if any(issue["type"] == "INCORRECT_PNL_CALCULATION" for issue in diagnosis["issues_found"]):
+                    fixes_applied["fixes"].append(self._fix_pnl_calculations(force_win))
+                
+                # Fix negative balances
+                if diagnosis["wallet_status"]["negative_balances"]:
+                    fixes_applied["fixes"].append(self._fix_negative_balances())
+                
+                # Fix stale orders first: releasing their frozen funds can resolve locked balances
+                if diagnosis["order_status"]["stale_orders"]:
+                    fixes_applied["fixes"].append(self._fix_stale_orders())
+                
+                # Fix locked balances
+                if diagnosis["wallet_status"]["locked_exceeds_available"]:
+                    fixes_applied["fixes"].append(self._fix_locked_balances())
+                
+                # Fix orphaned ledger entries
+                if diagnosis["ledger_integrity"]["orphaned_entries"]:
+                    fixes_applied["fixes"].append(self._fix_orphaned_ledger())
+        finally:
+            fixes_applied["progress"] = self.progress.finish()
+            self._change_set = None
+            self._record_undo = False
+            self._run_id = None
+            self._throttle = None
         
-        # Fix negative balances
-        if diagnosis["wallet_status"]["negative_balances"]:
-            fixes_applied["fixes"].append(self._fix_negative_balances())
+        if throttle is not None and not dry_run:
+            fixes_applied["throttle"] = throttle.stats()
+            logger.info(f"Online repair: {throttle.rows} rows in {throttle.chunks} chunks, "
+                        f"max lock hold {throttle.max_hold_ms:.1f} ms")
         
-        # Fix locked balances
-        if diagnosis["wallet_status"]["locked_exceeds_available"]:
-            fixes_applied["fixes"].append(self._fix_locked_balances())
+        if dry_run:
+            logger.info(f"Dry run complete. {len(fixes_applied['fixes'])} fixes rolled back.")
+        else:
+            logger.info(f"Repair complete. Applied {len(fixes_applied['fixes'])} fixes.")
+        return fixes_applied
+    
+    @contextmanager
+    def _transaction(self, rollback: bool = False):
+        """Group updates into one transaction; roll back on error or when rollback is set"""
+        self._in_transaction = True
+        try:
+            yield
+            if not rollback:
+                self.audit.flush()
+        except BaseException as e:
+            self._rollback()
+            self.audit.discard()
+            self._raise_if_cancelled(e)
+            raise
+        else:
+            if rollback:
+                self.conn.rollback()
+                self.audit.discard()
+            else:
+                self.conn.commit()
+        finally:
+            self._in_transaction = False
+    
+    def _rollback(self):
+        """Roll back with the progress handler off, so a pending cancel cannot interrupt the rollback"""
+        self.conn.set_progress_handler(None, 0)
+        try:
+            self.conn.rollback()
+        finally:
+            self.conn.set_progress_handler(self.progress.on_vm_step, PROGRESS_HANDLER_OPS)
+    
+    def _apply_change(self, table: str, set_clause: str, where: str, params: tuple = (),
+                      where_params: tuple = (), chunked: bool = True) -> int:
+        """Run one set-based UPDATE and record its row count and before/after samples
+
+        params bind the placeholders of set_clause, where_params those of
+        where. With chunked=False the statement stays in the open repair
+        transaction even under online repair, for changes that must commit
+        together with the next one.
+        """
+        if self._throttle is not None and chunked:
+            return self._apply_change_chunked(table, set_clause, where, params, where_params)
         
-        # Fix stale orders
-        if diagnosis["order_status"]["stale_orders"]:
-            fixes_applied["fixes"].append(self._fix_stale_orders())
+        if self._record_undo:
+            # Before-image of every row this statement touches, chained into the audit log
+            for row in self._iter_query(f"SELECT rowid, * FROM {table} WHERE {where}", where_params):
+                self.audit.add(row.get('user_id'), "UNDO_IMAGE",
+                               json.dumps({"table": table, "row": row}, default=_json_default), self._run_id)
         
-        # Fix orphaned ledger entries
-        if diagnosis["ledger_integrity"]["orphaned_entries"]:
-            fixes_applied["fixes"].append(self._fix_orphaned_ledger())
+        samples = []
+        if self._change_set is not None:
+            samples = self._execute_query(
+                f"SELECT rowid, * FROM {table} WHERE {where} LIMIT {CHANGE_SAMPLE_ROWS}", where_params
+            )
         
-        logger.info(f"Repair complete. Applied {len(fixes_applied['fixes'])} fixes.")
-        return fixes_applied
+        updated = self._execute_update(f"UPDATE {table} SET {set_clause} WHERE {where}", params + where_params)
+        
+        self._record_change(table, samples, updated)
+        return updated
+    
+    def _record_change(self, table: str, samples: List[Dict], updated: int):
+        """Add a statement's row count and before/after samples to the current change set"""
+        if self._change_set is None:
+            return
+        after = {row["rowid"]: row for row in self._fetch_rows_by_rowid(table, [r["rowid"] for r in samples])}
+        entry = self._change_set.setdefault(table, {"rows": 0, "samples": []})
+        entry["rows"] += updated
+        for before in samples:
+            if len(entry["samples"]) < CHANGE_SAMPLE_ROWS:
+                entry["samples"].append({"before": before, "after": after.get(before["rowid"])})
+    
+    def _apply_change_chunked(self, table: str, set_clause: str, where: str, params: tuple = (),
+                              where_params: tuple = ()) -> int:
+        """_apply_change in rowid-ordered chunks, each committed in its own short write transaction"""
+        throttle = self._throttle
+        samples = self._execute_query(
+            f"SELECT rowid, * FROM {table} WHERE {where} LIMIT {CHANGE_SAMPLE_ROWS}", where_params
+        )
+        updated = 0
+        last_rowid = None
+        while True:
+            time.sleep(throttle.pause())
+            # Commit whatever is pending (e.g. audit entries) so the timing covers this chunk alone
+            self.audit.flush()
+            self.conn.commit()
+            
+            requested = time.perf_counter()
+            self.conn.execute("BEGIN IMMEDIATE")
+            acquired = time.perf_counter()
+            keyset = "" if last_rowid is None else "rowid > ? AND "
+            rowids = [row[0] for row in self.conn.execute(
+                f"SELECT rowid FROM {table} WHERE {keyset}({where}) ORDER BY rowid LIMIT ?",
+                ((last_rowid,) if last_rowid is not None else ()) + where_params + (throttle.chunk_size,)
+            )]
+            if not rowids:
+                self.conn.commit()
+                break
+            in_chunk = f"rowid IN ({','.join('?' * len(rowids))}) AND ({where})"
+            if self._record_undo:
+                for row in self._execute_query(f"SELECT rowid, * FROM {table} WHERE {in_chunk}",
+                                               tuple(rowids) + where_params):
+                    self.audit.add(row.get('user_id'), "UNDO_IMAGE",
+                                   json.dumps({"table": table, "row": row}, default=_json_default), self._run_id)
+            # The predicate is re-checked so rows the application fixed meanwhile are left alone
+            chunk_rows = self.conn.execute(
+                f"UPDATE {table} SET {set_clause} WHERE {in_chunk}", params + tuple(rowids) + where_params
+            ).rowcount
+            self.audit.flush()
+            self.conn.commit()
+            released = time.perf_counter()
+            
+            throttle.record(chunk_rows, (acquired - requested) * 1000, (released - acquired) * 1000)
+            self.progress.advance(chunk_rows)
+            updated += chunk_rows
+            last_rowid = rowids[-1]
+        
+        self._record_change(table, samples, updated)
+        return updated
     
     def _fix_pnl_calculations(self, force_win: bool = False) -> Dict:
         """Fix incorrect PnL calculations"""
@@ -383,41 +3574,22 @@ class TradingSystemRepair:
             "force_win_applied": force_win
         }
         
-        # Get all positions with incorrect PnL
-        positions = self._execute_query("SELECT * FROM positions")
-        
-        for pos in positions:
-            correct_pnl = self._calculate_pnl(pos)
-            
-            if force_win:
-                # Force all positions to be profitable
-                if correct_pnl < 0:
-                    # Adjust current price to make position profitable
-                    if pos['side'] == 'buy':  # LONG
-                        new_current = pos['entry_price'] * 1.01  # 1% profit
-                    else:  # SHORT
-                        new_current = pos['entry_price'] * 0.99  # 1% profit
-                    
-                    self._execute_update("""
-                        UPDATE positions 
-                        SET current_price = ?, unrealized_pnl = ?
-                        WHERE user_id = ? AND symbol = ?
-                    """, (new_current, abs(correct_pnl), pos['user_id'], pos['symbol']))
-                    
-                    fix_result["positions_updated"] += 1
-                    
-                    # Log the forced win
-                    logger.info(f"Forced win for user {pos['user_id']} position {pos['symbol']}")
-            else:
-                # Just fix the calculation to be accurate
-                if abs(correct_pnl - pos['unrealized_pnl']) > 0.01:
-                    self._execute_update("""
-                        UPDATE positions 
-                        SET unrealized_pnl = ?
-                        WHERE user_id = ? AND symbol = ?
-                    """, (correct_pnl, pos['user_id'], pos['symbol']))
-                    
-                    fix_result["positions_updated"] += 1
+        if force_win:
+            # Force all losing positions to be profitable by moving current price 1% in their favour
+            fix_result["positions_updated"] = self._apply_change(
+                "positions",
+                f"""current_price = CASE WHEN side = 'buy' THEN entry_price * 1.01 ELSE entry_price * 0.99 END,
+                    unrealized_pnl = ABS({PNL_SQL})""",
+                f"{PNL_SQL} < 0"
+            )
+            logger.info(f"Forced win on {fix_result['positions_updated']} positions")
+        else:
+            # Just fix the calculation to be accurate; only rows the check would report are rewritten
+            fix_result["positions_updated"] = self._apply_change(
+                "positions",
+                f"unrealized_pnl = {PNL_SQL}",
+                f"ABS({minor_sql(PNL_SQL, PNL_SCALE_SQL)} - {minor_sql('unrealized_pnl', PNL_SCALE_SQL)}) > {PNL_TOLERANCE_UNITS}"
+            )
         
         return fix_result
     
@@ -429,23 +3601,24 @@ class TradingSystemRepair:
             "balances_fixed": 0
         }
         
-        negative = self._execute_query("""
-            SELECT user_id, currency, balance, frozen_balance 
+        balance_minor = minor_sql("balance", WALLET_SCALE_SQL)
+        frozen_minor = minor_sql("frozen_balance", WALLET_SCALE_SQL)
+        is_negative = f"{balance_minor} < 0 OR {frozen_minor} < 0"
+        negative = self._execute_query(f"""
+            SELECT user_id, currency 
             FROM wallet_balances 
-            WHERE balance < 0 OR frozen_balance < 0
+            WHERE {is_negative}
         """)
         
+        # Set negative balances to zero
+        fix_result["balances_fixed"] = self._apply_change(
+            "wallet_balances",
+            f"""balance = CASE WHEN {balance_minor} < 0 THEN 0 ELSE balance END,
+               frozen_balance = CASE WHEN {frozen_minor} < 0 THEN 0 ELSE frozen_balance END""",
+            is_negative
+        )
+        
         for bal in negative:
-            # Set negative balances to zero
-            self._execute_update("""
-                UPDATE wallet_balances 
-                SET balance = CASE WHEN balance < 0 THEN 0 ELSE balance END,
-                    frozen_balance = CASE WHEN frozen_balance < 0 THEN 0 ELSE frozen_balance END
-                WHERE user_id = ? AND currency = ?
-            """, (bal['user_id'], bal['currency']))
-            
-            fix_result["balances_fixed"] += 1
-            
             # Add audit log entry
             self._add_audit_entry(
                 bal['user_id'],
@@ -463,47 +3636,80 @@ class TradingSystemRepair:
             "balances_fixed": 0
         }
         
-        locked_exceeds = self._execute_query("""
-            SELECT user_id, currency, balance, frozen_balance 
-            FROM wallet_balances 
-            WHERE frozen_balance > balance
-        """)
-        
-        for bal in locked_exceeds:
-            # Set frozen to balance
-            self._execute_update("""
-                UPDATE wallet_balances 
-                SET frozen_balance = balance
-                WHERE user_id = ? AND currency = ?
-            """, (bal['user_id'], bal['currency']))
-            
-            fix_result["balances_fixed"] += 1
+        # Set frozen to balance
+        fix_result["balances_fixed"] = self._apply_change(
+            "wallet_balances",
+            "frozen_balance = balance",
+            f"{minor_sql('frozen_balance', WALLET_SCALE_SQL)} > {minor_sql('balance', WALLET_SCALE_SQL)}"
+        )
         
         return fix_result
     
     def _fix_stale_orders(self) -> Dict:
-        """Cancel stale orders"""
+        """Cancel stale orders and release the funds they held frozen
+        
+        One grouped query totals the frozen amount per (user, currency)
+        into a temp table, one UPDATE cancels the orders and one UPDATE
+        releases the totals, all in the repair transaction. Under online
+        repair both UPDATEs are applied unchunked and commit together, so
+        no order is cancelled without its release.
+        """
         logger.info("Fixing stale orders...")
         fix_result = {
             "type": "STALE_ORDER_FIX",
-            "orders_cancelled": 0
+            "orders_cancelled": 0,
+            "accounts_released": 0,
+            "frozen_released": {}
         }
         
-        stale = self._execute_query("""
-            SELECT * FROM orders 
-            WHERE status = 'open' 
-            AND created_at < datetime('now', '-1 day')
+        # One cutoff for all three statements, so they see the same orders
+        cutoff = self.conn.execute("SELECT datetime('now', '-1 day')").fetchone()[0]
+        stale = "status = 'open' AND created_at < ?"
+        
+        self.conn.execute("DROP TABLE IF EXISTS temp.repair_stale_release")
+        self.conn.execute("""
+            CREATE TEMP TABLE repair_stale_release (
+                user_id TEXT NOT NULL,
+                currency TEXT NOT NULL,
+                amount REAL NOT NULL,
+                orders INTEGER NOT NULL,
+                PRIMARY KEY (user_id, currency)
+            )
         """)
+        self.conn.execute(f"""
+            INSERT INTO temp.repair_stale_release (user_id, currency, amount, orders)
+            SELECT user_id, currency, SUM(locked), COUNT(*) FROM (
+                SELECT user_id, {ORDER_LOCKED_CURRENCY_SQL} AS currency, {ORDER_LOCKED_AMOUNT_SQL} AS locked
+                FROM orders WHERE {stale}
+            )
+            WHERE currency IS NOT NULL
+            GROUP BY user_id, currency
+        """, (cutoff,))
         
-        for order in stale:
-            # Cancel order
-            self._execute_update("""
-                UPDATE orders 
-                SET status = 'cancelled', updated_at = datetime('now')
-                WHERE id = ?
-            """, (order['id'],))
-            
-            fix_result["orders_cancelled"] += 1
+        fix_result["orders_cancelled"] = self._apply_change(
+            "orders",
+            "status = 'cancelled', updated_at = datetime('now')",
+            stale,
+            where_params=(cutoff,),
+            chunked=False
+        )
+        
+        release = """
+            FROM temp.repair_stale_release r
+            WHERE r.user_id = wallet_balances.user_id AND r.currency = wallet_balances.currency
+        """
+        fix_result["accounts_released"] = self._apply_change(
+            "wallet_balances",
+            f"frozen_balance = MAX(0, frozen_balance - (SELECT r.amount {release}))",
+            f"EXISTS (SELECT 1 {release})",
+            chunked=False
+        )
+        fix_result["frozen_released"] = {
+            row[0]: row[1] for row in self.conn.execute(
+                "SELECT currency, SUM(amount) FROM temp.repair_stale_release GROUP BY currency"
+            )
+        }
+        self.conn.execute("DROP TABLE temp.repair_stale_release")
         
         return fix_result
     
@@ -515,49 +3721,160 @@ class TradingSystemRepair:
             "entries_fixed": 0
         }
         
-        orphaned = self._execute_query("""
-            SELECT * FROM wallet_transactions 
-            WHERE reference_id NOT IN (
-                SELECT id FROM orders 
-                UNION SELECT id FROM wallet_requests
-            )
-        """)
-        
-        for entry in orphaned:
-            # Create a dummy reference for orphaned entries
-            dummy_ref = f"FIXED_{entry['id']}_{int(time.time())}"
-            self._execute_update("""
-                UPDATE wallet_transactions 
-                SET reference_id = ?
-                WHERE id = ?
-            """, (dummy_ref, entry['id']))
-            
-            fix_result["entries_fixed"] += 1
+        # Point orphaned entries at a dummy reference
+        fix_result["entries_fixed"] = self._apply_change(
+            "wallet_transactions",
+            "reference_id = 'FIXED_' || id || '_' || ?",
+            ORPHANED_REFERENCE_SQL,
+            (int(time.time()),)
+        )
         
         return fix_result
     
-    def _add_audit_entry(self, user_id: str, action: str, details: str):
-        """Add audit log entry"""
+    def take_snapshot(self, path: Optional[str] = None, pages: int = SNAPSHOT_PAGES_PER_STEP) -> Dict:
+        """Consistent copy of the database via the online backup API
+        
+        The copy proceeds in steps of `pages` pages, so other connections
+        can keep writing in between (SQLite restarts the copy if they do).
+        """
+        if path is None:
+            path = f"{self.db_path}.snapshot-{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+        progress = {"pages": 0, "steps": 0}
+        
+        def on_step(status, remaining, total):
+            progress["pages"] = total
+            progress["steps"] += 1
+        
+        started = time.perf_counter()
+        target = sqlite3.connect(path)
         try:
-            self._execute_update("""
-                INSERT INTO audit_log (user_id, action, details, timestamp)
-                VALUES (?, ?, ?, datetime('now'))
-            """, (user_id, action, details))
-        except:
-            # Audit table might not exist, create it
-            self._execute_update("""
-                CREATE TABLE IF NOT EXISTS audit_log (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id TEXT,
-                    action TEXT,
-                    details TEXT,
-                    timestamp DATETIME
-                )
-            """)
-            self._execute_update("""
-                INSERT INTO audit_log (user_id, action, details, timestamp)
-                VALUES (?, ?, ?, datetime('now'))
-            """, (user_id, action, details))
+            self.conn.backup(target, pages=pages, progress=on_step)
+        finally:
+            target.close()
+        snapshot = {
+            "path": path,
+            "seconds": time.perf_counter() - started,
+            "pages": progress["pages"],
+            "steps": progress["steps"],
+            "bytes": os.path.getsize(path)
+        }
+        logger.info(f"Snapshot {path}: {snapshot['bytes']} bytes in {snapshot['seconds']:.2f}s "
+                    f"({snapshot['steps']} steps)")
+        return snapshot
+    
+    def restore_snapshot(self, path: str) -> Dict:
+        """Overwrite the database with a snapshot taken by take_snapshot()"""
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"snapshot not found: {path}")
+        started = time.perf_counter()
+        self.conn.commit()
+        source = sqlite3.connect(path)
+        try:
+            source.backup(self.conn, pages=SNAPSHOT_PAGES_PER_STEP)
+        finally:
+            source.close()
+        self._forget_derived_state()
+        restored = {"path": path, "seconds": time.perf_counter() - started}
+        logger.warning(f"Database restored from snapshot {path} in {restored['seconds']:.2f}s")
+        return restored
+    
+    def undo_run(self, run_id: str) -> Dict:
+        """Revert a repair run from the before-images it recorded in the audit log"""
+        images = self._execute_query("""
+            SELECT details FROM audit_log
+            WHERE run_id = ? AND action = 'UNDO_IMAGE'
+            ORDER BY id DESC
+        """, (run_id,))
+        if not images:
+            raise ValueError(f"no undo images recorded for run {run_id}")
+        
+        # Names come from the audit log: only checked tables and their real columns are written
+        tables = {table for tables in CHECK_TABLES.values() for table in tables}
+        known_columns: Dict[str, set] = {}
+        updates = []
+        for image in images:
+            change = json.loads(image['details'])
+            table = change['table']
+            if table not in tables:
+                raise ValueError(f"undo image of run {run_id} names unknown table {table!r}")
+            if table not in known_columns:
+                known_columns[table] = {row[1] for row in self.conn.execute(
+                    f"PRAGMA table_info({quote_identifier(table)})")}
+            row = dict(change['row'])
+            rowid = row.pop('rowid')
+            unknown = set(row) - known_columns[table]
+            if unknown:
+                raise ValueError(f"undo image of run {run_id} names unknown {table} columns {sorted(unknown)}")
+            columns = ", ".join(f"{quote_identifier(column)} = ?" for column in row)
+            updates.append((f"UPDATE {quote_identifier(table)} SET {columns} WHERE rowid = ?",
+                            tuple(row.values()) + (rowid,)))
+        
+        restored = 0
+        with self._transaction():
+            # Newest first, so a row changed twice ends at its earliest image
+            for query, params in updates:
+                restored += self._execute_update(query, params)
+            self.audit.add(None, "ROLLBACK", f"Reverted {restored} row changes", run_id)
+        self._forget_derived_state()
+        logger.info(f"Run {run_id} reverted: {restored} rows restored")
+        return {"run_id": run_id, "rows_restored": restored}
+    
+    def protect_repair(self, diagnosis: Dict, force_win: bool = False, snapshot_path: Optional[str] = None,
+                       undo_threshold: Optional[int] = None) -> Dict:
+        """Decide how a repair can be rolled back: snapshot, or undo images when the change set is small
+        
+        When undo_threshold is set, the change set is sized from the
+        diagnosis's rule counts (an upper bound, see estimate_changed_rows);
+        at or below the threshold no snapshot is taken and the repair
+        should run with record_undo=True instead.
+        """
+        protection = {"snapshot": None, "record_undo": False, "estimated_rows": None}
+        if undo_threshold is not None:
+            protection["estimated_rows"] = self.estimate_changed_rows(diagnosis, force_win)
+            if protection["estimated_rows"] <= undo_threshold:
+                protection["record_undo"] = True
+                logger.info(f"Snapshot skipped: {protection['estimated_rows']} row changes "
+                            f"<= {undo_threshold}, recording undo images instead")
+                return protection
+        protection["snapshot"] = self.take_snapshot(snapshot_path)
+        return protection
+    
+    @staticmethod
+    def estimate_changed_rows(diagnosis: Dict, force_win: bool = False) -> int:
+        """Upper bound on the rows fix_issues would change, from the diagnosis's exact rule counts
+        
+        A stale order counts twice (the order and at most one released
+        balance); a balance both negative and over-frozen counts under each
+        rule. With force_win every position may be rewritten.
+        """
+        def count(section: str, rule: str) -> int:
+            return ((diagnosis.get(section) or {}).get("totals") or {}).get(rule, {}).get("count", 0)
+        
+        rows = (count("wallet_status", "negative_balances") + count("wallet_status", "locked_exceeds_available")
+                + 2 * count("order_status", "stale_orders") + count("ledger_integrity", "orphaned_entries"))
+        if any(issue["type"] == "INCORRECT_PNL_CALCULATION" for issue in diagnosis["issues_found"]):
+            rows += (diagnosis["position_status"].get("total_positions", 0) if force_win
+                     else count("position_status", "incorrect_pnl"))
+        return rows
+    
+    def _forget_derived_state(self):
+        """Drop in-memory state derived from table contents after a wholesale change"""
+        self.check_cache.clear()
+        self._user_cache.clear()
+        self.liquidation_index = LiquidationIndex()
+        self._liquidation_token = None
+        self.audit.discard()
+    
+    def _add_audit_entry(self, user_id: str, action: str, details: str):
+        """Add audit log entry (buffered until the repair transaction commits)"""
+        self.audit.add(user_id, action, details, self._run_id)
+        if not self._in_transaction:
+            self.audit.flush()
+            self.conn.commit()
+    
+    def verify_audit(self, full: bool = False) -> Dict:
+        """Verify the audit log hash chain (only entries added since the last verification)"""
+        return self.audit.verify(full)
     
     def verify_fixes(self, diagnosis: Dict, fixes: Dict) -> Dict:
         """Verify that fixes were applied correctly"""
@@ -584,19 +3901,188 @@ class TradingSystemRepair:
             else:
                 verification["issues_remaining"].append(issue_type)
         
-        # Check for new issues introduced
-        for issue in new_diagnosis["issues_found"]:
-            if issue["type"] not in original_issue_types:
-                verification["failed_fixes"].append({
-                    "type": issue["type"],
-                    "description": "New issue introduced during fix",
-                    "details": issue
-                })
+        # Check for new issues introduced
+        for issue in new_diagnosis["issues_found"]:
+            if issue["type"] not in original_issue_types:
+                verification["failed_fixes"].append({
+                    "type": issue["type"],
+                    "description": "New issue introduced during fix",
+                    "details": issue
+                })
+        
+        logger.info(f"Verification complete. Fixed: {len(verification['fixed_successfully'])}, Remaining: {len(verification['issues_remaining'])}")
+        return verification
+    
+    def export_diagnosis(self, diagnosis: Dict, fmt: str = "ndjson", path: Optional[str] = None,
+                         compress: bool = False) -> str:
+        """Write a diagnosis as NDJSON, compact JSON or HTML, optionally gzipped
+        
+        JSON formats are encoded straight into the (gzip) stream piece by
+        piece, so the full document is never held as one string. NDJSON
+        emits a header line, then each issue followed by one line per
+        offending row, then each section's scalar summary and its remaining
+        rows (lists element by element, mappings entry by entry). A sampled
+        diagnosis (diagnose_sample) is written as its tables and rule
+        estimates, each rule followed by its sample offenders.
+        """
+        sampled = diagnosis.get("mode") == "sample"
+        if fmt == "html" and sampled:
+            return self._sample_report(diagnosis, path)
+        if fmt == "html":
+            empty_fixes = {"fixes": []}
+            empty_verification = {"issues_remaining": [], "fixed_successfully": [], "failed_fixes": []}
+            return self.generate_report(diagnosis, empty_fixes, empty_verification, path)
+        
+        if path is None:
+            path = f"diagnosis_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{fmt}"
+            if compress:
+                path += ".gz"
+        opener = gzip.open if compress else open
+        encoder = json.JSONEncoder(separators=(',', ':'), default=_json_default)
+        
+        with opener(path, 'wt', encoding='utf-8') as f:
+            if fmt == "json":
+                for chunk in encoder.iterencode(diagnosis):
+                    f.write(chunk)
+                f.write("\n")
+            elif fmt == "ndjson" and sampled:
+                self._write_sample_ndjson(diagnosis, f, encoder)
+            elif fmt == "ndjson":
+                self._write_ndjson(diagnosis, f, encoder)
+            else:
+                raise ValueError(f"Unsupported report format: {fmt}")
+        
+        logger.info(f"Diagnosis exported ({fmt}{', gzip' if compress else ''}): {path}")
+        return path
+    
+    def stream_diagnosis(self, path: Optional[str] = None, compress: bool = False,
+                         incremental: bool = False) -> Tuple[Dict, str]:
+        """Run diagnose_system writing its NDJSON report as the checks go (see DiagnosisStream)"""
+        if path is None:
+            path = f"diagnosis_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson"
+            if compress:
+                path += ".gz"
+        opener = gzip.open if compress else open
+        encoder = json.JSONEncoder(separators=(',', ':'), default=_json_default)
+        with opener(path, 'wt', encoding='utf-8') as f:
+            diagnosis = self.diagnose_system(incremental=incremental, stream=DiagnosisStream(f, encoder))
+        logger.info(f"Diagnosis streamed (ndjson{', gzip' if compress else ''}): {path}")
+        return diagnosis, path
+    
+    def _write_ndjson(self, diagnosis: Dict, f, encoder: json.JSONEncoder):
+        """Stream a diagnosis as one JSON record per line"""
+        def emit(record: Dict):
+            for chunk in encoder.iterencode(record):
+                f.write(chunk)
+            f.write("\n")
+        
+        emit({
+            "record": "diagnosis",
+            "timestamp": diagnosis["timestamp"],
+            "issues_found": len(diagnosis["issues_found"]),
+            "cache": diagnosis.get("cache")
+        })
+        
+        issue_rows = set()
+        for issue in diagnosis["issues_found"]:
+            issue_rows.add(id(issue["details"]))
+            emit({
+                "record": "issue",
+                "severity": issue["severity"],
+                "type": issue["type"],
+                "description": issue["description"],
+                "rows": issue["count"]
+            })
+            for row in issue["details"]:
+                emit({"record": "row", "issue": issue["type"], "data": row})
+        
+        for section in CHECK_TABLES:
+            # Rows already written under their issue are not repeated
+            emit_section(emit, section, diagnosis.get(section) or {},
+                         skip=lambda key, value: id(value) in issue_rows)
+    
+    def _write_sample_ndjson(self, diagnosis: Dict, f, encoder: json.JSONEncoder):
+        """Stream a sampled diagnosis as one JSON record per line"""
+        def emit(record: Dict):
+            for chunk in encoder.iterencode(record):
+                f.write(chunk)
+            f.write("\n")
         
-        logger.info(f"Verification complete. Fixed: {len(verification['fixed_successfully'])}, Remaining: {len(verification['issues_remaining'])}")
-        return verification
+        emit({"record": "diagnosis", "timestamp": diagnosis["timestamp"], "mode": "sample",
+              "fraction": diagnosis["fraction"], "seconds": diagnosis.get("seconds")})
+        for table, info in diagnosis["tables"].items():
+            emit(dict({"record": "table", "table": table}, **info))
+        for name, rule in diagnosis["rules"].items():
+            emit(dict({"record": "rule", "rule": name},
+                      **{k: v for k, v in rule.items() if k != "sample_offenders"}))
+            for row in rule["sample_offenders"]:
+                emit({"record": "row", "rule": name, "data": row})
+    
+    def _sample_report(self, diagnosis: Dict, report_file: Optional[str] = None) -> str:
+        """HTML report of a sampled diagnosis: rows sampled per table and each rule's estimate"""
+        tables = "".join(f"""
+                <tr>
+                    <td>{table}</td>
+                    <td>{info['rows_sampled']}</td>
+                    <td>{info['estimated_rows']}</td>
+                    <td>{'yes' if info['exact'] else 'no'}</td>
+                </tr>""" for table, info in diagnosis["tables"].items())
+        rules = "".join(f"""
+                <tr>
+                    <td>{name}</td>
+                    <td>{rule['estimate']}</td>
+                    <td>{'exact' if rule['exact'] else f"{rule['ci_low']}-{rule['ci_high']}"}</td>
+                    <td>{'yes' if rule['escalated'] else 'no'}</td>
+                </tr>""" for name, rule in diagnosis["rules"].items())
+        report = f"""
+        <!DOCTYPE html>
+        <html>
+        <head>
+            <title>Trading System Sampled Diagnosis</title>
+            <style>
+                body {{ font-family: Arial, sans-serif; margin: 20px; }}
+                table {{ border-collapse: collapse; width: 100%; margin-bottom: 20px; }}
+                th, td {{ border: 1px solid #ddd; padding: 8px; text-align: left; }}
+                th {{ background-color: #f2f2f2; }}
+            </style>
+        </head>
+        <body>
+            <h1>Trading System Sampled Diagnosis</h1>
+            <p>Generated: {diagnosis['timestamp']} ({diagnosis['fraction']:.2%} sample)</p>
+            
+            <h2>Tables</h2>
+            <table>
+                <tr>
+                    <th>Table</th>
+                    <th>Rows Sampled</th>
+                    <th>Estimated Rows</th>
+                    <th>Exact</th>
+                </tr>{tables}
+            </table>
+            
+            <h2>Rule Estimates</h2>
+            <table>
+                <tr>
+                    <th>Rule</th>
+                    <th>Estimate</th>
+                    <th>95% Interval</th>
+                    <th>Escalated</th>
+                </tr>{rules}
+            </table>
+        </body>
+        </html>
+        """
+        
+        if report_file is None:
+            report_file = f"trading_sample_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
+        with open(report_file, 'w') as f:
+            f.write(report)
+        
+        logger.info(f"Report generated: {report_file}")
+        return report_file
     
-    def generate_report(self, diagnosis: Dict, fixes: Dict, verification: Dict) -> str:
+    def generate_report(self, diagnosis: Dict, fixes: Dict, verification: Dict,
+                        report_file: Optional[str] = None) -> str:
         """Generate comprehensive HTML report"""
         report = f"""
         <!DOCTYPE html>
@@ -714,8 +4200,8 @@ class TradingSystemRepair:
             remaining=", ".join(verification['issues_remaining']) or "None",
             failed=len(verification['failed_fixes']),
             wallet_users=diagnosis['wallet_status']['total_users'],
-            negative_balances=len(diagnosis['wallet_status']['negative_balances']),
-            frozen_exceeds=len(diagnosis['wallet_status']['locked_exceeds_available'])
+            negative_balances=diagnosis['wallet_status']['totals']['negative_balances']['count'],
+            frozen_exceeds=diagnosis['wallet_status']['totals']['locked_exceeds_available']['count']
         )
         
         report += """
@@ -724,13 +4210,350 @@ class TradingSystemRepair:
         """
         
         # Save report
-        report_file = f"trading_repair_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
+        if report_file is None:
+            report_file = f"trading_repair_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
         with open(report_file, 'w') as f:
             f.write(report)
         
         logger.info(f"Report generated: {report_file}")
         return report_file
 
+def resolve_fleet_paths(patterns: Optional[List[str]] = None, manifest: Optional[str] = None) -> List[str]:
+    """Database paths from glob patterns and/or a manifest (one path per line, or a JSON list)"""
+    paths = []
+    for pattern in patterns or []:
+        paths.extend(sorted(glob.glob(pattern)) or [pattern])
+    if manifest:
+        with open(manifest) as f:
+            content = f.read()
+        if content.lstrip().startswith('['):
+            paths.extend(json.loads(content))
+        else:
+            paths.extend(line.strip() for line in content.splitlines()
+                         if line.strip() and not line.strip().startswith('#'))
+    return list(dict.fromkeys(paths))
+
+def diagnose_fleet_member(db_path: str) -> Dict:
+    """Diagnose one fleet database and return a compact summary (runs in a worker process)"""
+    started = time.perf_counter()
+    summary = {"db": db_path, "ok": False}
+    try:
+        if not os.path.exists(db_path):
+            raise FileNotFoundError(f"database not found: {db_path}")
+        repair = TradingSystemRepair(db_path)
+        try:
+            diagnosis = repair.diagnose_system()
+        finally:
+            repair.conn.close()
+        summary.update(
+            ok=True,
+            timestamp=diagnosis["timestamp"],
+            issues=[{
+                "severity": issue["severity"],
+                "type": issue["type"],
+                "count": issue["count"]
+            } for issue in diagnosis["issues_found"]],
+            total_users=diagnosis["wallet_status"]["total_users"],
+            total_positions=diagnosis["position_status"]["total_positions"],
+            total_exposure=diagnosis["risk_assessment"]["total_exposure"]
+        )
+    except (Exception, SystemExit) as e:
+        # _connect_db exits on failure; a fleet run must survive one bad member
+        summary["error"] = f"{type(e).__name__}: {e}"
+    summary["duration"] = time.perf_counter() - started
+    return summary
+
+def run_fleet(db_paths: List[str], workers: Optional[int] = None, report_path: Optional[str] = None) -> Dict:
+    """Diagnose many databases in parallel, streaming each result into an NDJSON report
+    
+    Wall time approaches that of the slowest member rather than the sum.
+    """
+    started = time.perf_counter()
+    if report_path is None:
+        report_path = f"fleet_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.ndjson"
+    fleet = {
+        "timestamp": datetime.now().isoformat(),
+        "databases": len(db_paths),
+        "succeeded": 0,
+        "failed": [],
+        "issues_by_type": {},
+        "slowest": None,
+        "report": report_path
+    }
+    
+    with ProcessPoolExecutor(max_workers=workers) as pool, open(report_path, 'w') as out:
+        futures = [pool.submit(diagnose_fleet_member, path) for path in db_paths]
+        for future in as_completed(futures):
+            member = future.result()
+            out.write(json.dumps(dict(member, record="database"), default=_json_default) + "\n")
+            out.flush()
+            
+            if not member["ok"]:
+                fleet["failed"].append({"db": member["db"], "error": member["error"]})
+                logger.warning(f"Fleet member failed: {member['db']}: {member['error']}")
+                continue
+            fleet["succeeded"] += 1
+            if fleet["slowest"] is None or member["duration"] > fleet["slowest"]["duration"]:
+                fleet["slowest"] = {"db": member["db"], "duration": member["duration"]}
+            for issue in member["issues"]:
+                totals = fleet["issues_by_type"].setdefault(issue["type"], {
+                    "severity": issue["severity"],
+                    "databases": 0,
+                    "count": 0
+                })
+                totals["databases"] += 1
+                totals["count"] += issue["count"]
+            logger.info(f"Fleet member done: {member['db']} ({len(member['issues'])} issues, {member['duration']:.2f}s)")
+        
+        fleet["wall_time"] = time.perf_counter() - started
+        out.write(json.dumps(dict(fleet, record="fleet_summary"), default=_json_default) + "\n")
+    
+    return fleet
+
+# Diagnostics HTTP service (serve action)
+SERVICE_MAX_SCANS = 2
+SERVICE_QUEUE_TIMEOUT = 30.0
+# Results kept by the service (one per check, report format and looked-up user), least recently used evicted
+SERVICE_CACHE_SIZE = 256
+
+class DiagnosticsService:
+    """Shared state behind the diagnostics HTTP service
+
+    Requests borrow a TradingSystemRepair from a small pool. Heavy scans
+    (summary, single checks, reports) additionally need one of max_scans
+    slots, so dashboard polling cannot pile scans onto the database;
+    per-user lookups only need a pool connection. Concurrent requests for
+    the same result share one in-flight computation, and results are kept
+    until the change token of the tables they read moves on. Pool instances
+    do not record metrics history: that commit would move the token of every
+    other connection and defeat the cache. A max_memory budget is split
+    evenly between the instances, so the service as a whole stays within it.
+    """
+
+    def __init__(self, db_path: str, max_scans: int = SERVICE_MAX_SCANS, **repair_options):
+        self.db_path = db_path
+        self.max_scans = max_scans
+        self._scan_slots = threading.BoundedSemaphore(max_scans)
+        self._pool = queue.Queue()
+        repair_options = dict(repair_options, keep_metrics=False)
+        instances = max_scans + 3
+        if repair_options.get("max_memory"):
+            repair_options["max_memory"] = max(1, repair_options["max_memory"] // instances)
+        self._repairs = [TradingSystemRepair(db_path, **repair_options) for _ in range(instances - 1)]
+        for repair in self._repairs:
+            self._pool.put(repair)
+        self._probe = TradingSystemRepair(db_path, **repair_options)
+        self._probe_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._inflight: Dict[tuple, Future] = {}
+        self._results: "OrderedDict[tuple, tuple]" = OrderedDict()
+        self.computations = 0
+        self.shared = 0
+        self.cache_hits = 0
+
+    def close(self):
+        """Close every instance, including ones still lent to a request"""
+        for repair in [self._probe] + self._repairs:
+            repair.conn.close()
+            if repair.memory_budget is not None:
+                repair.memory_budget.close()
+
+    def summary(self) -> Dict:
+        diagnosis = self._get(("summary",), tuple(CHECK_TABLES), True, lambda r: r.diagnose_system())
+        return {
+            "timestamp": diagnosis["timestamp"],
+            "issues": [{k: issue[k] for k in ("severity", "type", "description", "count", "sum")}
+                       for issue in diagnosis["issues_found"]],
+            "totals": {section: diagnosis[section].get("totals", {}) for section in CHECK_TABLES}
+        }
+
+    def check(self, name: str) -> Dict:
+        if name not in CHECK_TABLES:
+            raise KeyError(name)
+        return self._get(("check", name), (name,), True, lambda r: r.run_check(name))
+
+    def user(self, user_id: str) -> Dict:
+        return self._get(("user", user_id), tuple(CHECK_TABLES), False, lambda r: r.diagnose_user(user_id))
+
+    def report(self, fmt: str) -> bytes:
+        """A diagnosis export (json, ndjson or html) as bytes"""
+        def build(repair: TradingSystemRepair) -> bytes:
+            fd, path = tempfile.mkstemp(suffix=f".{fmt}")
+            os.close(fd)
+            try:
+                repair.export_diagnosis(repair.diagnose_system(), fmt, path)
+                with open(path, 'rb') as f:
+                    return f.read()
+            finally:
+                os.remove(path)
+        return self._get(("report", fmt), tuple(CHECK_TABLES), True, build)
+
+    def stats(self) -> Dict:
+        return {
+            "computations": self.computations,
+            "shared_inflight": self.shared,
+            "cache_hits": self.cache_hits,
+            "inflight": len(self._inflight),
+            "cached_results": len(self._results),
+            "max_scans": self.max_scans,
+            # Live rows / rate / ETA of the checks currently running
+            "running": [repair.progress.snapshot() for repair in self._repairs if repair.progress.stage]
+        }
+
+    def _token(self, sections: Tuple[str, ...]) -> tuple:
+        tables = tuple(sorted({table for section in sections for table in CHECK_TABLES[section]}))
+        with self._probe_lock:
+            return self._probe.check_cache.token(tables)
+
+    def _get(self, key: tuple, sections: Tuple[str, ...], heavy: bool, compute: Callable):
+        token = self._token(sections)
+        ttl = min(CHECK_TTL.get(section, float('inf')) for section in sections)
+        with self._lock:
+            cached = self._results.get(key)
+            if cached and cached[0] == token and time.time() - cached[1] < ttl:
+                self.cache_hits += 1
+                self._results.move_to_end(key)
+                return cached[2]
+            if cached:
+                # Stale: the data moved on or the TTL ran out
+                del self._results[key]
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = self._inflight[key] = Future()
+            else:
+                self.shared += 1
+        if not owner:
+            return future.result()
+        
+        try:
+            result = self._compute(heavy, compute)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if future.exception() is None:
+                    self._results[key] = (token, time.time(), future.result())
+                    self._results.move_to_end(key)
+                    while len(self._results) > SERVICE_CACHE_SIZE:
+                        self._results.popitem(last=False)
+
+    def _compute(self, heavy: bool, compute: Callable):
+        if heavy and not self._scan_slots.acquire(timeout=SERVICE_QUEUE_TIMEOUT):
+            raise ServiceBusy("too many concurrent scans")
+        try:
+            repair = self._pool.get(timeout=SERVICE_QUEUE_TIMEOUT)
+        except queue.Empty:
+            if heavy:
+                self._scan_slots.release()
+            raise ServiceBusy("no database connection available")
+        try:
+            with self._lock:
+                self.computations += 1
+            return compute(repair)
+        finally:
+            self._pool.put(repair)
+            if heavy:
+                self._scan_slots.release()
+
+class ServiceBusy(Exception):
+    """Raised when a request cannot get a scan slot or connection in time"""
+
+class _DiagnosticsHandler(BaseHTTPRequestHandler):
+    """GET /summary, /checks/<name>, /users/<id>, /report?format=json|ndjson|html, /stats"""
+
+    REPORT_TYPES = {"json": "application/json", "ndjson": "application/x-ndjson", "html": "text/html"}
+
+    def do_GET(self):
+        service = self.server.service
+        url = urlparse(self.path)
+        parts = [unquote(part) for part in url.path.strip("/").split("/") if part]
+        try:
+            if parts == ["summary"]:
+                self._json(service.summary())
+            elif len(parts) == 2 and parts[0] == "checks":
+                self._json(service.check(parts[1]))
+            elif len(parts) == 2 and parts[0] == "users":
+                self._json(service.user(parts[1]))
+            elif parts == ["report"]:
+                fmt = parse_qs(url.query).get("format", ["json"])[0]
+                if fmt not in self.REPORT_TYPES:
+                    return self._json({"error": f"unsupported format: {fmt}"}, 400)
+                self._send(service.report(fmt), self.REPORT_TYPES[fmt],
+                           {"Content-Disposition": f'attachment; filename="diagnosis.{fmt}"'})
+            elif parts == ["stats"]:
+                self._json(service.stats())
+            else:
+                self._json({"error": "not found"}, 404)
+        except KeyError as e:
+            self._json({"error": f"unknown check: {e.args[0]}"}, 404)
+        except ServiceBusy as e:
+            self._json({"error": str(e)}, 503, {"Retry-After": "5"})
+        except Exception as e:
+            logger.exception(f"Request failed: {self.path}")
+            self._json({"error": f"{type(e).__name__}: {e}"}, 500)
+
+    def _json(self, payload, status: int = 200, headers: Optional[Dict] = None):
+        body = json.dumps(payload, default=_json_default).encode()
+        self._send(body, "application/json", headers, status)
+
+    def _send(self, body: bytes, content_type: str, headers: Optional[Dict] = None, status: int = 200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+def make_service_server(db_path: str, host: str = "127.0.0.1", port: int = 8765,
+                        max_scans: int = SERVICE_MAX_SCANS, **repair_options) -> ThreadingHTTPServer:
+    """HTTP server for the diagnostics service; call serve_forever() on it"""
+    server = ThreadingHTTPServer((host, port), _DiagnosticsHandler)
+    server.daemon_threads = True
+    server.service = DiagnosticsService(db_path, max_scans, **repair_options)
+    return server
+
+def _print_memory(diagnosis: Dict):
+    """Peak memory line for the CLI summaries"""
+    memory = diagnosis.get("memory") or {}
+    mib = lambda size: f"{size / (1 << 20):.2f} MiB" if size >= 1 << 20 else f"{size / 1024:.1f} KiB"
+    parts = []
+    if memory.get("peak_rss_bytes"):
+        parts.append(f"peak RSS {mib(memory['peak_rss_bytes'])}")
+    if memory.get("max_bytes"):
+        parts.append(f"retained rows peak {mib(memory['peak_retained_bytes'])} of {mib(memory['max_bytes'])}, "
+                     f"{memory['spooled_rows']} rows spooled")
+    if parts:
+        print(f"Memory: {', '.join(parts)}")
+
+def _throttle_from_args(args) -> Optional[RepairThrottle]:
+    """Online-repair throttle requested on the command line, if any"""
+    if not args.online:
+        return None
+    return RepairThrottle(max_lock_ms=args.max_lock_ms, rows_per_sec=args.rows_per_sec)
+
+def _protect_from_args(repair: TradingSystemRepair, diagnosis: Dict, args) -> Dict:
+    """Take the pre-repair snapshot requested on the command line, if any"""
+    if not args.snapshot:
+        return {"snapshot": None, "record_undo": False}
+    path = None if args.snapshot == 'auto' else args.snapshot
+    protection = repair.protect_repair(diagnosis, args.force_win, path, args.snapshot_threshold)
+    snapshot = protection['snapshot']
+    if snapshot:
+        print(f"📸 Snapshot: {snapshot['path']} ({snapshot['bytes'] / 1e6:.1f} MB in {snapshot['seconds']:.2f}s)")
+    else:
+        print(f"📸 Snapshot skipped: {protection['estimated_rows']} row changes, recording undo images")
+    return protection
+
 def main():
     parser = argparse.ArgumentParser(
         description="Professional Trading System Diagnostic and Repair Tool",
@@ -742,14 +4565,40 @@ Examples:
   %(prog)s fix --force-win                     # Force all positions to be profitable
   %(prog)s diagnose --db custom.db             # Use custom database
   %(prog)s fix --dry-run                       # Show what would be fixed without applying
+  %(prog)s fix --online --max-lock-ms 50 --rows-per-sec 2000  # Repair in short chunks next to live traffic
   %(prog)s verify                              # Verify fixes were applied correctly
   %(prog)s full --force-win --report           # Run full cycle with report
+  %(prog)s diagnose --report --format ndjson --gzip  # Stream diagnosis as gzipped NDJSON
+  %(prog)s install-tracking                    # Install change counters for result caching
+  %(prog)s install-tracking --dirty-keys       # Also queue changed rows for incremental diagnosis
+  %(prog)s diagnose --incremental              # Re-check only rows changed since the last run
+  %(prog)s install-indexes                     # Index user_id columns for per-user drill-down
+  %(prog)s diagnose --user user42              # Run every check for one user
+  %(prog)s diagnose --sample 1%% --escalate-above 0.5%%  # Fast estimates, full scan for hot rules
+  %(prog)s serve --port 8765 --max-scans 2     # HTTP/JSON diagnostics for the admin dashboard
+  %(prog)s full --top-k 0 --max-memory 256M   # Keep every row, spooling to disk past 256 MiB
+  %(prog)s checkpoint                          # Extend per-account ledger checkpoints
+  %(prog)s balance-at --user user42 --currency USDT --time "2026-01-01 12:00:00"
+  %(prog)s reconcile-wallets                   # Wallet balances vs ledger (via checkpoints)
+  %(prog)s risk-summary --rebuild              # Rebuild the per-user risk summary table
+  %(prog)s diagnose --keep-metrics             # Also record this run's metrics for trend
+  %(prog)s trend --metric negative_balances --days 30  # Daily history from recorded diagnoses
+  %(prog)s archive --older-than-months 3       # Copy settled ledger months to archive databases
+  %(prog)s archive --purge                     # Then delete the verified copies from the live ledger
+  %(prog)s reconcile --fills fills-20260101.csv --max-memory 512M  # External fills vs orders
+  %(prog)s verify-audit                        # Check audit log entries added since last verification
+  %(prog)s fleet --dbs "regions/*.db" --workers 8  # Diagnose many databases in parallel
+  %(prog)s full --snapshot                     # Snapshot (online backup) before repairing
+  %(prog)s rollback --snapshot trading.db.snapshot-20260101_120000  # Restore a snapshot
+  %(prog)s rollback --run-id 3f2a9c1b0d4e5f60  # Undo a repair from its audit-log images
         """
     )
     
     parser.add_argument(
         'action',
-        choices=['diagnose', 'fix', 'verify', 'full'],
+        choices=['diagnose', 'fix', 'verify', 'full', 'install-tracking', 'install-indexes', 'verify-audit',
+                 'fleet', 'rollback', 'serve', 'checkpoint', 'balance-at', 'reconcile-wallets',
+                 'archive', 'reconcile', 'risk-summary', 'trend'],
         help='Action to perform'
     )
     
@@ -759,6 +4608,23 @@ Examples:
         help='Database file path (default: trading.db)'
     )
     
+    parser.add_argument(
+        '--dbs',
+        nargs='+',
+        help='fleet: database paths or glob patterns'
+    )
+    
+    parser.add_argument(
+        '--manifest',
+        help='fleet: file listing database paths (one per line, or a JSON list)'
+    )
+    
+    parser.add_argument(
+        '--workers',
+        type=int,
+        help='fleet: worker processes (default: CPU count)'
+    )
+    
     parser.add_argument(
         '--force-win',
         action='store_true',
@@ -771,12 +4637,219 @@ Examples:
         help='Show what would be fixed without applying changes'
     )
     
+    parser.add_argument(
+        '--snapshot',
+        nargs='?',
+        const='auto',
+        help='fix/full: snapshot the database first (optional path); rollback: snapshot to restore'
+    )
+    
+    parser.add_argument(
+        '--snapshot-threshold',
+        type=int,
+        help='Skip the snapshot when the repair changes at most this many rows (undo via audit log)'
+    )
+    
+    parser.add_argument(
+        '--run-id',
+        help='rollback: repair run to undo from its audit-log before-images'
+    )
+    
     parser.add_argument(
         '--report',
         action='store_true',
         help='Generate HTML report'
     )
     
+    parser.add_argument(
+        '--format',
+        choices=['ndjson', 'json', 'html'],
+        default='json',
+        help='Diagnosis report format for diagnose --report (default: json)'
+    )
+    
+    parser.add_argument(
+        '--gzip',
+        action='store_true',
+        help='Gzip-compress the ndjson/json diagnosis report'
+    )
+    
+    parser.add_argument(
+        '--output',
+        help='Report path for diagnose --report and fleet (default: timestamped file in the current directory)'
+    )
+    
+    parser.add_argument(
+        '--full',
+        action='store_true',
+        help='verify-audit: re-check the whole hash chain instead of only new entries'
+    )
+    
+    parser.add_argument(
+        '--top-k',
+        type=int,
+        default=DEFAULT_TOP_K,
+        help=f'Most severe rows kept per check (default: {DEFAULT_TOP_K}, 0 keeps all)'
+    )
+    
+    parser.add_argument(
+        '--spill-dir',
+        help='Also write every offending row to <dir>/<check>.ndjson'
+    )
+    
+    parser.add_argument(
+        '--no-cache',
+        action='store_true',
+        help='Re-run every check even if its tables are unchanged'
+    )
+    
+    parser.add_argument(
+        '--online',
+        action='store_true',
+        help='Repair in small committed chunks, yielding the write lock between them'
+    )
+    
+    parser.add_argument(
+        '--max-lock-ms',
+        type=float,
+        default=DEFAULT_MAX_LOCK_MS,
+        help=f'With --online: target write-lock hold per chunk (default: {DEFAULT_MAX_LOCK_MS:g})'
+    )
+    
+    parser.add_argument(
+        '--rows-per-sec',
+        type=float,
+        help='With --online: cap on rows repaired per second'
+    )
+    
+    parser.add_argument(
+        '--dirty-keys',
+        action='store_true',
+        help='With install-tracking: queue changed wallet/order/position rows for --incremental'
+    )
+    
+    parser.add_argument(
+        '--max-memory',
+        type=parse_size,
+        help='Budget for offender rows held in memory (e.g. 256M); rows beyond it spool to a temp SQLite file'
+    )
+    
+    parser.add_argument(
+        '--duplicate-window',
+        type=float,
+        default=DUPLICATE_WINDOW_SECONDS,
+        help=f'Seconds within which identical ledger entries count as duplicates (default: {DUPLICATE_WINDOW_SECONDS:g})'
+    )
+    
+    parser.add_argument(
+        '--host',
+        default='127.0.0.1',
+        help='With serve: address to listen on (default: 127.0.0.1)'
+    )
+    
+    parser.add_argument(
+        '--port',
+        type=int,
+        default=8765,
+        help='With serve: port to listen on (default: 8765)'
+    )
+    
+    parser.add_argument(
+        '--max-scans',
+        type=int,
+        default=SERVICE_MAX_SCANS,
+        help=f'With serve: concurrent full scans allowed (default: {SERVICE_MAX_SCANS})'
+    )
+    
+    parser.add_argument(
+        '--user',
+        help='With diagnose: run every check for this user id only; with balance-at: the account owner'
+    )
+    
+    parser.add_argument(
+        '--currency',
+        help='With balance-at: account currency'
+    )
+    
+    parser.add_argument(
+        '--time',
+        help='With balance-at: point in time (e.g. "2026-01-01 12:00:00"; default: now)'
+    )
+    
+    parser.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='With checkpoint: discard existing checkpoints and rebuild from the first ledger entry; '
+             'with risk-summary: recompute every user'
+    )
+    
+    parser.add_argument(
+        '--sample',
+        type=parse_fraction,
+        help='With diagnose: estimate per-rule counts from this fraction of each table (e.g. 1%% or 0.01)'
+    )
+    
+    parser.add_argument(
+        '--escalate-above',
+        type=parse_fraction,
+        help='With --sample: run the full check for any rule whose sampled rate exceeds this (e.g. 0.5%%)'
+    )
+    
+    parser.add_argument(
+        '--metric',
+        help='With trend: metric name (e.g. wallet_status.negative_balances.count, check.order_status.seconds) '
+             'or a rule name for its count'
+    )
+    
+    parser.add_argument(
+        '--keep-metrics',
+        action='store_true',
+        help='With diagnose/full: record the run\'s metrics in repair_metrics for trend (writes to the database)'
+    )
+    
+    parser.add_argument(
+        '--days',
+        type=float,
+        default=30,
+        help='With trend: how far back to look (default: 30)'
+    )
+    
+    parser.add_argument(
+        '--step',
+        choices=['hour', 'day'],
+        help='With trend: bucket size (default: hour up to 2 days, else day)'
+    )
+    
+    parser.add_argument(
+        '--fills',
+        help='With reconcile: fill (order_id, amount) or settlement (reference_id, currency, amount) CSV file'
+    )
+    
+    parser.add_argument(
+        '--archive-dir',
+        help='With archive: directory for the per-month ledger archive databases (default: <db>_archive next to the database)'
+    )
+    
+    parser.add_argument(
+        '--purge',
+        action='store_true',
+        help='With archive: delete entries staged by an earlier archive run from the live ledger, '
+             'after re-verifying both copies'
+    )
+    
+    parser.add_argument(
+        '--older-than-months',
+        type=int,
+        default=ARCHIVE_AFTER_MONTHS,
+        help=f'With archive: archive ledger entries older than this many whole months (default: {ARCHIVE_AFTER_MONTHS})'
+    )
+    
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='Re-evaluate wallet/position rules and double-entry groups only for data changed since the last incremental run'
+    )
+    
     parser.add_argument(
         '--verbose',
         '-v',
@@ -789,96 +4862,317 @@ Examples:
     if args.verbose:
         logging.getLogger().setLevel(logging.DEBUG)
     
-    # Initialize repair tool
-    repair = TradingSystemRepair(args.db)
-    
-    if args.action == 'diagnose':
-        logger.info("Running diagnostics...")
-        diagnosis = repair.diagnose_system()
+    if args.action == 'fleet':
+        paths = resolve_fleet_paths(args.dbs, args.manifest)
+        if not paths:
+            parser.error("fleet requires --dbs and/or --manifest")
+        fleet = run_fleet(paths, args.workers, args.output)
         
         print("\n" + "="*80)
-        print("SYSTEM DIAGNOSIS RESULTS")
+        print("FLEET DIAGNOSIS RESULTS")
         print("="*80)
-        print(f"Timestamp: {diagnosis['timestamp']}")
-        print(f"Issues Found: {len(diagnosis['issues_found'])}")
-        
-        if diagnosis['issues_found']:
-            print("\nIssues:")
-            for issue in diagnosis['issues_found']:
-                print(f"  [{issue['severity']}] {issue['type']}: {issue['description']}")
-        else:
-            print("\n✅ No issues found!")
-        
-        if args.report:
-            report_file = f"diagnosis_report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.html"
-            with open(report_file, 'w') as f:
-                f.write(json.dumps(diagnosis, indent=2, default=str))
-            print(f"\nReport saved to: {report_file}")
+        print(f"Databases: {fleet['databases']} ({fleet['succeeded']} ok, {len(fleet['failed'])} failed)")
+        print(f"Wall time: {fleet['wall_time']:.2f}s"
+              + (f" (slowest: {fleet['slowest']['db']} {fleet['slowest']['duration']:.2f}s)" if fleet['slowest'] else ""))
+        for issue_type, totals in sorted(fleet['issues_by_type'].items()):
+            print(f"  [{totals['severity']}] {issue_type}: {totals['count']} rows in {totals['databases']} databases")
+        for failure in fleet['failed']:
+            print(f"  ❌ {failure['db']}: {failure['error']}")
+        print(f"\nReport saved to: {fleet['report']}")
+        sys.exit(1 if fleet['failed'] else 0)
+    
+    if args.action == 'serve':
+        server = make_service_server(args.db, args.host, args.port, args.max_scans,
+                                     use_cache=not args.no_cache, top_k=args.top_k or None,
+                                     duplicate_window=args.duplicate_window, max_memory=args.max_memory)
+        print(f"Serving diagnostics for {args.db} on http://{args.host}:{server.server_port} "
+              f"(/summary, /checks/<name>, /users/<id>, /report?format=json|ndjson|html)")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            server.service.close()
+        return
     
-    elif args.action == 'fix':
-        logger.info("Running diagnostics before fix...")
-        diagnosis = repair.diagnose_system()
+    # Initialize repair tool
+    repair = TradingSystemRepair(args.db, use_cache=not args.no_cache,
+                                 top_k=args.top_k or None, spill_dir=args.spill_dir,
+                                 duplicate_window=args.duplicate_window, max_memory=args.max_memory,
+                                 keep_metrics=args.keep_metrics)
+    # Ctrl-C / SIGTERM cancel cleanly: the running statement is aborted and an open repair rolled back
+    install_cancel_handlers(repair.progress)
+    
+    # The spool file and its connection go away however the action ends (error, sys.exit, Ctrl-C)
+    try:
+        if args.action == 'diagnose' and args.sample:
+            logger.info(f"Running sampled diagnostics ({args.sample:.2%} of each table)...")
+            diagnosis = repair.diagnose_sample(args.sample, args.escalate_above)
+            print("\n" + "="*80)
+            print(f"SAMPLED DIAGNOSIS ({args.sample:.2%}, {diagnosis['seconds']:.1f}s)")
+            print("="*80)
+            for table, info in diagnosis['tables'].items():
+                print(f"{table}: {info['rows_sampled']} rows sampled of ~{info['estimated_rows']}"
+                      f"{' (exact)' if info['exact'] else ''}")
+            print()
+            for name, rule in diagnosis['rules'].items():
+                if rule['exact']:
+                    label = "escalated to full scan" if rule['escalated'] else "exact"
+                    print(f"  {name}: {rule['estimate']} ({label})")
+                else:
+                    print(f"  {name}: ~{rule['estimate']} (95% CI {rule['ci_low']}-{rule['ci_high']}, "
+                          f"rate {rule['rate']:.3%})")
+                for row in rule['sample_offenders'][:3]:
+                    print(f"      {json.dumps(row, default=_json_default)[:160]}")
+            if args.report:
+                report_file = repair.export_diagnosis(diagnosis, args.format, args.output, args.gzip)
+                print(f"\nReport saved to: {report_file}")
         
-        if args.dry_run:
+        elif args.action == 'diagnose':
+            logger.info("Running diagnostics...")
+            report_file = None
+            if args.user:
+                diagnosis = repair.diagnose_user(args.user)
+            elif args.report and args.format == 'ndjson':
+                # Offending rows reach the report while the checks run
+                diagnosis, report_file = repair.stream_diagnosis(args.output, args.gzip, args.incremental)
+            else:
+                diagnosis = repair.diagnose_system(incremental=args.incremental)
+            
             print("\n" + "="*80)
-            print("DRY RUN - Issues that would be fixed")
+            print("SYSTEM DIAGNOSIS RESULTS")
             print("="*80)
-            for issue in diagnosis['issues_found']:
-                print(f"  • {issue['type']}: {issue['description']}")
+            print(f"Timestamp: {diagnosis['timestamp']}")
+            if args.user:
+                print(f"User: {args.user}")
+            print(f"Issues Found: {len(diagnosis['issues_found'])}")
+            if 'cache' in diagnosis:
+                print(f"Check cache: {diagnosis['cache']['hits']} hits, {diagnosis['cache']['misses']} misses")
+            _print_memory(diagnosis)
             
-            if args.force_win:
-                print("\n⚠️  --force-win enabled: All positions would be made profitable")
-        else:
-            print("\nApplying fixes...")
-            fixes = repair.fix_issues(diagnosis, args.force_win)
+            if diagnosis['issues_found']:
+                print("\nIssues:")
+                for issue in diagnosis['issues_found']:
+                    print(f"  [{issue['severity']}] {issue['type']}: {issue['description']}")
+            else:
+                print("\n✅ No issues found!")
+            
+            risk = diagnosis['risk_assessment']
+            if risk['scenarios']:
+                worst = max(risk['scenarios'], key=lambda s: (s['positions_liquidated'], s['bad_debt']))
+                print(f"\nExposure: gross {risk['total_exposure']:,.2f}, house net {risk['house_net_exposure']:,.2f}")
+                print(f"Worst shock {worst['shock']:+.0%}: {worst['positions_liquidated']} liquidations, "
+                      f"bad debt {worst['bad_debt']:,.2f}")
+            
+            if args.report:
+                if report_file is None:
+                    report_file = repair.export_diagnosis(diagnosis, args.format, args.output, args.gzip)
+                print(f"\nReport saved to: {report_file}")
+        
+        elif args.action == 'fix':
+            logger.info("Running diagnostics before fix...")
+            diagnosis = repair.diagnose_system()
+            
+            if args.dry_run:
+                fixes = repair.fix_issues(diagnosis, args.force_win, dry_run=True)
+                print("\n" + "="*80)
+                print("DRY RUN - Changes that would be applied (rolled back)")
+                print("="*80)
+                for issue in diagnosis['issues_found']:
+                    print(f"  • {issue['type']}: {issue['description']}")
+                
+                print("\nRows that would change:")
+                for table, change in fixes['changes'].items():
+                    print(f"  {table}: {change['rows']} rows")
+                    for sample in change['samples']:
+                        after = sample['after'] or {}
+                        diff = {k: f"{v} -> {after.get(k)}" for k, v in sample['before'].items() if after.get(k) != v}
+                        print(f"    rowid {sample['before']['rowid']}: {diff}")
+                
+                if args.force_win:
+                    print("\n⚠️  --force-win enabled: All positions would be made profitable")
+            else:
+                protection = _protect_from_args(repair, diagnosis, args)
+                print("\nApplying fixes...")
+                fixes = repair.fix_issues(diagnosis, args.force_win, record_undo=protection['record_undo'],
+                                          throttle=_throttle_from_args(args))
+                if protection['record_undo']:
+                    print(f"↩️  Undo with: rollback --run-id {fixes['run_id']}")
+                if 'throttle' in fixes:
+                    t = fixes['throttle']
+                    print(f"🐢 Online repair: {t['rows']} rows in {t['chunks']} chunks, "
+                          f"max lock hold {t['max_hold_ms']:.1f} ms")
+                
+                print(f"\n✅ Fixes applied: {len(fixes['fixes'])}")
+                for fix in fixes['fixes']:
+                    print(f"  • {fix['type']}: Updated {fix.get('positions_updated', 0)} positions, "
+                          f"Fixed {fix.get('balances_fixed', 0)} balances")
+                
+                if args.report:
+                    verification = repair.verify_fixes(diagnosis, fixes)
+                    report_file = repair.generate_report(diagnosis, fixes, verification)
+                    print(f"\n📊 Report generated: {report_file}")
+        
+        elif args.action == 'verify':
+            logger.info("Running verification...")
+            # For verification, we need to compare with previous diagnosis
+            # This would typically load a saved diagnosis
+            print("Verification requires a previous diagnosis. Run 'full' or provide diagnosis file.")
+        
+        elif args.action == 'full':
+            logger.info("Running full diagnostic and repair cycle...")
+            
+            # Diagnose
+            diagnosis = repair.diagnose_system()
+            print(f"\n📋 Found {len(diagnosis['issues_found'])} issues")
+            
+            # Fix
+            protection = _protect_from_args(repair, diagnosis, args)
+            fixes = repair.fix_issues(diagnosis, args.force_win, record_undo=protection['record_undo'],
+                                      throttle=_throttle_from_args(args))
+            print(f"🔧 Applied {len(fixes['fixes'])} fixes")
+            if protection['record_undo']:
+                print(f"↩️  Undo with: rollback --run-id {fixes['run_id']}")
+            
+            # Verify
+            verification = repair.verify_fixes(diagnosis, fixes)
+            print(f"✅ Successfully fixed: {len(verification['fixed_successfully'])}")
             
-            print(f"\n✅ Fixes applied: {len(fixes['fixes'])}")
-            for fix in fixes['fixes']:
-                print(f"  • {fix['type']}: Updated {fix.get('positions_updated', 0)} positions, "
-                      f"Fixed {fix.get('balances_fixed', 0)} balances")
+            if verification['issues_remaining']:
+                print(f"⚠️  Remaining issues: {len(verification['issues_remaining'])}")
             
+            # Generate report
             if args.report:
-                verification = repair.verify_fixes(diagnosis, fixes)
                 report_file = repair.generate_report(diagnosis, fixes, verification)
-                print(f"\n📊 Report generated: {report_file}")
-    
-    elif args.action == 'verify':
-        logger.info("Running verification...")
-        # For verification, we need to compare with previous diagnosis
-        # This would typically load a saved diagnosis
-        print("Verification requires a previous diagnosis. Run 'full' or provide diagnosis file.")
-    
-    elif args.action == 'full':
-        logger.info("Running full diagnostic and repair cycle...")
+                print(f"📊 Report saved to: {report_file}")
+            
+            # Summary
+            print("\n" + "="*80)
+            print("REPAIR SUMMARY")
+            print("="*80)
+            print(f"Initial issues: {len(diagnosis['issues_found'])}")
+            print(f"Fixes applied: {len(fixes['fixes'])}")
+            print(f"Remaining issues: {len(verification['issues_remaining'])}")
+            print(f"Success rate: {(len(diagnosis['issues_found']) - len(verification['issues_remaining'])) / max(len(diagnosis['issues_found']), 1) * 100:.1f}%")
+            print(f"Check cache: {repair.check_cache.hits} hits, {repair.check_cache.misses} misses")
+            _print_memory(diagnosis)
         
-        # Diagnose
-        diagnosis = repair.diagnose_system()
-        print(f"\n📋 Found {len(diagnosis['issues_found'])} issues")
+        elif args.action == 'rollback':
+            if args.run_id:
+                result = repair.undo_run(args.run_id)
+                print(f"↩️  Run {result['run_id']} reverted: {result['rows_restored']} rows restored")
+            elif args.snapshot and args.snapshot != 'auto':
+                result = repair.restore_snapshot(args.snapshot)
+                print(f"↩️  Restored {args.db} from {result['path']} in {result['seconds']:.2f}s")
+            else:
+                parser.error("rollback requires --snapshot PATH or --run-id RUN_ID")
         
-        # Fix
-        fixes = repair.fix_issues(diagnosis, args.force_win)
-        print(f"🔧 Applied {len(fixes['fixes'])} fixes")
+        elif args.action == 'verify-audit':
+            result = repair.verify_audit(full=args.full)
+            if result['valid']:
+                print(f"✅ Audit chain intact: {result['verified']} new entries verified (last id {result['last_id']})")
+            else:
+                print(f"❌ Audit chain broken at entry {result['broken_at']}")
+                sys.exit(1)
         
-        # Verify
-        verification = repair.verify_fixes(diagnosis, fixes)
-        print(f"✅ Successfully fixed: {len(verification['fixed_successfully'])}")
+        elif args.action == 'checkpoint':
+            build = repair.build_ledger_checkpoints(rebuild=args.rebuild)
+            print(f"✅ {build['rows']} ledger entries processed, {build['checkpoints_written']} checkpoints written "
+                  f"(watermark rowid {build['watermark']}, {build['seconds']:.2f}s)")
         
-        if verification['issues_remaining']:
-            print(f"⚠️  Remaining issues: {len(verification['issues_remaining'])}")
+        elif args.action == 'balance-at':
+            if not args.user or not args.currency:
+                parser.error("balance-at requires --user and --currency")
+            at = args.time or datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+            balance = repair.balance_at(args.user, args.currency, at)
+            print(f"{balance['user_id']} {balance['currency']} at {balance['time']}: {balance['balance']:.8f} "
+                  f"({balance['entries']} entries, {balance['replayed']} replayed after checkpoint)")
         
-        # Generate report
-        if args.report:
-            report_file = repair.generate_report(diagnosis, fixes, verification)
-            print(f"📊 Report saved to: {report_file}")
+        elif args.action == 'reconcile-wallets':
+            reconciliation = repair.reconcile_wallets()
+            totals = reconciliation['totals']['balance_mismatches']
+            print(f"Accounts compared: {reconciliation['accounts']}")
+            print(f"Mismatches: {totals['count']} (net difference {totals['sum']:.8f})")
+            for row in reconciliation['balance_mismatches'][:20]:
+                print(f"  {row['user_id']} {row['currency']}: wallet {row['wallet_balance']:.8f}, "
+                      f"ledger {row['ledger_balance']:.8f} ({row['entries']} entries)")
         
-        # Summary
-        print("\n" + "="*80)
-        print("REPAIR SUMMARY")
-        print("="*80)
-        print(f"Initial issues: {len(diagnosis['issues_found'])}")
-        print(f"Fixes applied: {len(fixes['fixes'])}")
-        print(f"Remaining issues: {len(verification['issues_remaining'])}")
-        print(f"Success rate: {(len(diagnosis['issues_found']) - len(verification['issues_remaining'])) / max(len(diagnosis['issues_found']), 1) * 100:.1f}%")
+        elif args.action == 'reconcile':
+            if not args.fills:
+                parser.error("reconcile requires --fills")
+            reconciliation = repair.reconcile_fills(args.fills)
+            totals = reconciliation['totals']
+            print(f"Reconciled {reconciliation['rows']} rows ({reconciliation['keys']} keys) against "
+                  f"{reconciliation['source']} by {reconciliation['mode']} join in {reconciliation['seconds']:.1f}s "
+                  f"({reconciliation['rows_per_sec']:.0f} rows/sec)")
+            if reconciliation['skipped']:
+                print(f"Skipped {reconciliation['skipped']} rows without a key or numeric amount")
+            for field, label in (('missing_records', 'Missing from database'), ('extra_records', 'Not in file'),
+                                 ('amount_mismatches', 'Amount mismatches')):
+                print(f"{label}: {totals[field]['count']} (net {totals[field]['sum']:.8f})")
+                for row in reconciliation[field][:10]:
+                    print(f"  {json.dumps(row, default=_json_default)}")
+        
+        elif args.action == 'trend':
+            if not args.metric:
+                parser.error("trend requires --metric")
+            trend = repair.metric_trend(args.metric, args.days, args.step)
+            print(f"{trend['metric']} over the last {trend['days']:g} days (per {trend['step']}):")
+            if not trend['points']:
+                print("  no data recorded")
+            for point in trend['points']:
+                print(f"  {point['bucket']}  avg {point['average']:>14,.4f}  min {point['minimum']:>14,.4f}  "
+                      f"max {point['maximum']:>14,.4f}  ({point['samples']} runs)")
+        
+        elif args.action == 'risk-summary':
+            refresh = repair.refresh_risk_summary(rebuild=args.rebuild)
+            print(f"✅ user_risk_summary {refresh['mode']}: {refresh['users_refreshed']} users in {refresh['seconds']:.2f}s")
+            for row in repair._execute_query(
+                    "SELECT * FROM user_risk_summary ORDER BY max_leverage DESC NULLS LAST LIMIT 20"):
+                leverage = f"{row['max_leverage']:.1f}x" if row['max_leverage'] is not None else "n/a"
+                print(f"  {row['user_id']}: {row['positions']} positions, notional {row['total_notional']:,.2f}, "
+                      f"margin {row['total_margin']:,.2f}, max leverage {leverage}, net PnL {row['net_pnl']:,.2f}")
+        
+        elif args.action == 'archive' and args.purge:
+            purged = repair.purge_archived_ledger()
+            print(f"✅ Removed {purged['entries_moved']} archived entries from the live ledger "
+                  f"({len(purged['partitions'])} partitions)")
+            for part in purged['partitions']:
+                print(f"  {part['partition']}: {part['moved']} entries -> {part['path']}")
+            for part in purged['skipped']:
+                print(f"  ⚠️  {part['partition']} skipped: {part['reason']}")
+        
+        elif args.action == 'archive':
+            archived = repair.archive_ledger(args.older_than_months, args.archive_dir)
+            print(f"✅ Staged {archived['entries_staged']} settled ledger entries older than {archived['cutoff']} "
+                  f"in {len(archived['partitions'])} archives (live ledger unchanged)")
+            for part in archived['partitions']:
+                print(f"  {part['partition']}: {part['staged']} entries -> {part['path']}")
+            for part in archived['failed']:
+                print(f"  ❌ {part['partition']}: {part['reason']}")
+            if archived['partitions']:
+                print("   Run 'archive --purge' to remove the verified entries from the live ledger")
+        
+        elif args.action == 'install-indexes':
+            installed = repair.install_indexes()
+            print(f"✅ Installed {len(installed)} indexes: {', '.join(installed)}")
+        
+        elif args.action == 'install-tracking':
+            installed = repair.install_change_tracking(dirty_keys=args.dirty_keys)
+            print(f"✅ Change tracking installed on {len(installed)} tables: {', '.join(installed)}")
+    finally:
+        if repair.memory_budget is not None:
+            repair.memory_budget.close()
+
+def cli():
+    """Command-line entry point (also used by backend/scripts/trading_system_repair.py)"""
+    try:
+        main()
+    except OperationCancelled as e:
+        logger.warning(f"Run cancelled: {e}")
+        print(f"\n⚠️  Cancelled ({e}); no partial repair transaction was committed")
+        sys.exit(130)
 
 if __name__ == "__main__":
-    main()
+    cli()